@@ -7,64 +7,848 @@ TFserver - 新版无UI控制台服务端
 完全适配client_gui.py和client_lite.py客户端
 """
 
+import time
+STARTUP_TIME = time.perf_counter()  # 用于 --startup-profile 统计导入耗时
+
 import socket
 import threading
-import json
 import os
 import sys
 import datetime
-import time
+import re
+import collections
+import struct
+import itertools
+import queue
+import selectors
+import bisect
+import stat
+import hmac
+import hashlib
+from array import array
+try:
+    import resource  # 调整文件描述符上限，只有 Unix 有
+except ImportError:
+    resource = None
+# json 只在读写封禁数据时才导入，减少启动时间
+
+MAX_LINE_BYTES = 65536  # 单帧最大长度，超过时按一帧处理，防止缓冲区无限增长
+RECV_BUFFER_SIZE = 4096  # 每个会话的接收缓冲区大小（recv_into 直接写入，遇到超长帧时临时扩大）
+RECV_POOL_SIZE = 128  # 断开的会话留下的接收缓冲区最多保留这么多个，供新会话复用
+MAX_USERNAME_LENGTH = 32  # 用户名最大长度
+HISTORY_SIZE = 10000  # 服务器保留的最近消息数，用于组播丢包补发
+MAX_DATAGRAM_BYTES = 60000  # 超过此长度的消息不走组播，直接用TCP发送
+MAX_NACK_RANGE = 1000  # 单次补发请求最多补发的消息数
+RECEIVE_IDLE_TIMEOUT = 0.5  # 接收线程没有事件时最多等待的秒数（之后检查排队、诊断等）
+RECEIVE_BACKLOG_TIMEOUT = 0.01  # 有客户端发送积压时接收线程的等待秒数（尽快继续发送）
+PRESENCE_INTERVAL = 0.5  # 在线名单变化最多每隔这么多秒广播一次，期间的多次进出合并成一帧
+WORKER_THREADS = 2  # 后台工作线程数（写磁盘、打印日志等可能阻塞的工作）
+WORKER_QUEUE_SIZE = 1000  # 后台任务队列上限，满了由提交者自己执行
+SEARCH_MAX_MESSAGES = 200000  # 搜索索引保留的最近消息数（机房里约几天的聊天记录）
+SEARCH_MAX_RESULTS = 500  # 一次搜索最多返回的匹配数
+SEARCH_PAGE_SIZE = 20  # 搜索结果每页条数
+SEARCH_INTERVAL = 1  # 同一客户端两次搜索的最短间隔（秒）
+# 中日韩文字没有空格分词，按单字和相邻两字建索引；其他文字按单词
+SEARCH_TOKEN_PATTERN = re.compile(r"([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]+)"
+                                  r"|([^\W\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]+)")
+SEARCH_SENDER_PREFIX = "\0"  # 发送者也作为索引词（加上不会出现在文本中的前缀），from: 条件直接查倒排表
+BOT_TOKENS_FILE = "tf_bots.txt"  # 机器人令牌：每行 "机器人名 令牌"，通过本机套接字连接的机器人不需要令牌
+BOT_BULK_MAX = 1000  # 机器人一次批量发送的最多条数
+# 各类连接的内核接收/发送缓冲区上限 SO_RCVBUF/SO_SNDBUF（字节），0 表示使用系统默认
+# 上千个空闲连接时调小可以限制最坏情况下的内核内存；发送缓冲区太小时待发数据会积压在服务器的发送队列中
+SOCKET_BUFFERS = {"client": (0, 0), "local": (0, 0), "bot": (0, 0), "peer": (0, 0)}
+UNIX_SOCKET_MODE = 0o660  # Unix 域套接字文件的权限：只有同一用户和同组的程序可以连接
+WAITING_ROOM_SIZE = 100  # 聊天室满员时最多排队等候的连接数
+MAX_CONNECTIONS_LIMIT = 1000  # maxconn 命令允许设置的最大连接数
+# 大规模模式（--high-scale）：上万个连接同时在线
+HIGH_SCALE_MAX_CONNECTIONS = 20000  # 大规模模式下允许的最大连接数
+HIGH_SCALE_WAITING_ROOM = 2000      # 大规模模式下的排队人数上限
+HIGH_SCALE_BACKLOG = 4096           # 大规模模式下的监听队列长度（实际还受系统 somaxconn 限制）
+FD_RESERVE = 256  # 除客户端连接外，文件传输、信箱、日志等需要预留的文件描述符数
+MAX_CONNECTIONS_PER_IP = 0  # 默认每个IP最多同时占用的连接数（含排队），0表示不限制（机房共用一个出口IP时不能限制）
+TRACE_SAMPLES = 1000  # 延迟追踪时每个客户端保留的最近样本数
+
+SLOW_BACKLOG_BYTES = 256 * 1024  # 客户端待发送数据超过此值时，跳过较早的聊天消息
+SLOW_KEEP_MESSAGES = 200  # 跳过时最多保留的最新聊天消息数
+SLOW_DISCONNECT_BYTES = 1024 * 1024  # 跳过后待发送数据仍超过此值时断开连接
+SLOW_STALL_TIMEOUT = 30  # 有待发送数据但持续这么多秒没有发出任何数据时断开连接
+SLOW_WARN_BYTES = 64 * 1024  # list 命令中标记为慢速客户端的积压量
+PEER_MAX_UNSENT = 4 * 1024 * 1024  # 互联连接积压超过此值时断开（之后自动重连）
+
+# 传输模式：latency 每条消息立即写给各客户端；throughput 把一个短窗口内的消息合并，每个客户端只写一次
+TRANSPORT_PROFILES = ("latency", "throughput")
+BATCH_WINDOW_MS = 5  # throughput 模式默认的合并窗口（毫秒）
+BATCH_WINDOW_MAX_MS = 100  # 合并窗口的上限（毫秒）
+FED_BATCH_INTERVAL = 0.02  # 服务器互联：攒批发送给其他服务器的间隔（秒）
+FED_LOAD_INTERVAL = 2  # 服务器互联：广播本机负载的间隔（秒）
+FED_RETRY_INTERVAL = 5  # 服务器互联：主动连接断开后重连的间隔（秒）
+FED_RETRY_MAX = 60  # 服务器互联：连续连不上时重连间隔逐次加倍，最长的间隔（秒）
+FED_CONNECT_TIMEOUT = 3  # 服务器互联：主动连接的超时（秒），在后台线程中等待
+FED_SEEN_SIZE = 10000  # 服务器互联：用于去重的最近消息编号数
+
+CAPTURE_MAGIC = b"TFCAP1\n"  # 流量录制文件的文件头
+# 录制记录: 距开始录制的微秒数, 会话编号, 类型, 数据长度，后跟数据
+CAPTURE_RECORD = struct.Struct("<QIBI")
+CAPTURE_OPEN, CAPTURE_LINE, CAPTURE_CLOSE = 1, 2, 3  # 记录类型：新连接（数据为地址）/ 收到一帧 / 连接关闭
+
+PROFILE_DIR = "tf_profile"  # profile/mem/threads 命令输出文件的目录
+# cProfile、pstats、tracemalloc、traceback 只在使用诊断命令时才导入
+
+FILE_SPOOL_DIR = "tf_files"  # 上传文件的暂存目录
+MAX_FILE_SIZE = 50 * 1024 * 1024  # 单个文件大小上限
+MAX_USER_STORAGE = 200 * 1024 * 1024  # 每个用户的文件总量上限
+MAX_ROOM_STORAGE = 1024 * 1024 * 1024  # 聊天室的文件总量上限
+MAX_TRANSFERS = 8  # 同时进行的上传/下载数
+TRANSFER_CHUNK = 64 * 1024  # 上传时每次读取的大小（内存占用固定）
+TRANSFER_TIMEOUT = 30  # 传输连接无数据的超时时间（秒）
+UPLOAD_START_TIMEOUT = 60  # 获准上传后必须在此时间内开始上传（秒）
+
+FILTER_FILE = "tf_filter.txt"  # 敏感词表：每行一个词，可加 block:/mask:/flag: 前缀指定动作（默认 mask），# 开头为注释
+FILTER_ACTIONS = ("block", "mask", "flag")  # 拦截整条消息 / 把词替换为* / 照常转发但在控制台标记
+FILTER_CHECK_INTERVAL = 2  # 检查词表文件是否修改的间隔（秒），修改后自动重新编译
+
+MAILBOX_DIR = "tf_mailbox"  # 离线信箱目录：每个用户一个文件（按用户名的哈希命名），投递时只读这一个文件
+MAILBOX_USERS_FILE = "users.txt"  # 注册过的用户名（只有注册过的用户才会收到离线消息）
+MAILBOX_QUOTA = 64 * 1024  # 每个用户离线信箱的大小上限（字节），满了之后的新消息不再保存
+MAILBOX_EXPIRY = 7 * 86400  # 离线消息的保存期限（秒）
+
+def escape_line(text):
+    """把消息编码为单行帧（转义反斜杠和换行符）"""
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+def unescape_line(line):
+    """还原escape_line编码的单行帧"""
+    return re.sub(r"\\(.)", lambda m: "\n" if m.group(1) == "n" else m.group(1), line)
+
+def format_size(size):
+    """把字节数格式化为易读的大小"""
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+def split_payload(text):
+    """把转发的消息内容拆成 (发送者, 正文)；文件消息 /file offer <编号> <字节数> <上传者>:<文件名> 的正文是 [文件] 文件名"""
+    if text.startswith("/file offer "):
+        parts = text.split(" ", 4)
+        if len(parts) == 5:
+            owner, _, name = parts[4].partition(":")
+            return owner, f"[文件] {name}"
+    sender, _, text = text.partition(": ")
+    return sender, text
+
+def now_ms():
+    """当前时间（毫秒时间戳），写入消息帧供客户端计算延迟"""
+    return int(time.time() * 1000)
+
+def latency_summary(samples):
+    """把延迟样本（毫秒）汇总为 中位数/P90/P99/最大值 的文字"""
+    if not samples:
+        return "无数据"
+    ordered = sorted(samples)
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+    return f"{len(ordered)}条 中位 {pick(0.5)} / P90 {pick(0.9)} / P99 {pick(0.99)} / 最大 {ordered[-1]} ms"
+
+def parse_transport(text):
+    """解析传输模式 latency 或 throughput[:合并窗口毫秒]，返回 (模式, 窗口秒)；格式错误时抛出ValueError"""
+    profile, _, window = text.partition(":")
+    if profile not in TRANSPORT_PROFILES or (profile == "latency" and window):
+        raise ValueError("传输模式必须是 latency 或 throughput[:毫秒]")
+    if profile == "latency":
+        return ("latency", 0)
+    try:
+        ms = float(window) if window else BATCH_WINDOW_MS
+    except ValueError:
+        raise ValueError("合并窗口必须是数字（毫秒）") from None
+    if not 0 < ms <= BATCH_WINDOW_MAX_MS:
+        raise ValueError(f"合并窗口必须在 0-{BATCH_WINDOW_MAX_MS} 毫秒之间")
+    return ("throughput", ms / 1000)
+
+def format_transport(transport):
+    """传输模式的显示文字"""
+    profile, window = transport
+    return profile if profile == "latency" else f"{profile}（合并窗口 {window * 1000:g} ms）"
+
+def search_tokens(text, query=False):
+    """把文本切分为索引词：中日韩文字取单字和相邻两字，其他文字取小写单词
+    query=True 时用于搜索词，两字以上的中日韩文字只取相邻两字"""
+    tokens = set()
+    for cjk, word in SEARCH_TOKEN_PATTERN.findall(text.lower()):
+        if word:
+            tokens.add(word)
+            continue
+        if len(cjk) == 1 or not query:
+            tokens.update(cjk)
+        tokens.update(cjk[i:i + 2] for i in range(len(cjk) - 1))
+    return tokens
+
+def parse_search_time(value):
+    """解析搜索的时间条件，返回毫秒时间戳: 30m/2h/3d（多久以前）、HH:MM（今天）、YYYY-MM-DD、YYYY-MM-DDTHH:MM"""
+    now = datetime.datetime.now()
+    units = {"m": "minutes", "h": "hours", "d": "days"}
+    if value[-1:] in units and value[:-1].isdigit():
+        moment = now - datetime.timedelta(**{units[value[-1]]: int(value[:-1])})
+    else:
+        for fmt in ("%H:%M", "%Y-%m-%d", "%Y-%m-%dT%H:%M"):
+            try:
+                moment = datetime.datetime.strptime(value, fmt)
+            except ValueError:
+                continue
+            if fmt == "%H:%M":
+                moment = now.replace(hour=moment.hour, minute=moment.minute, second=0, microsecond=0)
+            break
+        else:
+            raise ValueError(f"无法识别的时间: {value}（可用 30m、2h、3d、08:00、2025-09-01、2025-09-01T08:00）")
+    return int(moment.timestamp() * 1000)
+
+def parse_search_query(text):
+    """解析搜索条件: 关键词 from:用户名 after:时间 before:时间 page:页码，返回 (关键词列表, 条件字典)"""
+    terms = []
+    options = {"from": None, "after": None, "before": None, "page": 1}
+    for word in text.split():
+        key, sep, value = word.partition(":")
+        key = key.lower()
+        if not sep or not value or key not in options:
+            terms.append(word.lower())
+        elif key == "from":
+            options["from"] = value
+        elif key == "page":
+            if not value.isdigit() or int(value) < 1:
+                raise ValueError("页码必须是正整数")
+            options["page"] = int(value)
+        else:
+            options[key] = parse_search_time(value)
+    if not terms and options["from"] is None and options["after"] is None and options["before"] is None:
+        raise ValueError("请输入关键词，或 from:用户名、after:时间、before:时间")
+    return terms, options
+
+def report_startup_profile(stages):
+    """输出启动各阶段相对脚本开始执行的耗时（--startup-profile）"""
+    print("启动耗时统计:")
+    for name, t in stages:
+        print(f"  {name}: {(t - STARTUP_TIME) * 1000:.1f} ms")
+
+class Session:
+    """一个客户端连接的会话状态
+    大量空闲连接时每个会话的内存要尽量小：用 __slots__，发送队列和延迟样本用到时才分配，接收缓冲区在没有未完成的帧时还回缓冲池"""
+    ids = itertools.count(1)
+    __slots__ = (
+        "id", "conn", "address", "username", "prefix", "inbuf", "inview", "inlen", "multicast", "last_search",
+        "presence", "bot", "bulk", "bot_events", "bot_batches", "waiting", "outq", "out_bytes", "out_offset",
+        "last_progress", "sent_bytes", "drain_rate", "rate_mark", "skipped", "unsent_skips", "peer", "peer_id",
+        "peer_auth", "outbox", "unsent", "one_way", "round_trip",
+    )
+    
+    def __init__(self, conn, address):
+        self.id = next(Session.ids)  # 会话编号，用于流量录制
+        self.conn = conn
+        self.address = address
+        self.username = ""   # 注册后由服务器确定，之后不再改变
+        self.prefix = b""    # 转发消息时加在正文前的发送者 "用户名: "（已转义，UTF-8编码）
+        self.inbuf = None    # 接收缓冲区（bytearray，由接收线程从缓冲池取得），未凑成完整一行的数据留在开头
+        self.inview = None   # inbuf 的 memoryview，切出的帧不复制数据
+        self.inlen = 0       # 缓冲区中已收到的字节数
+        self.multicast = False  # 已加入组播，不再通过TCP接收聊天消息
+        self.last_search = 0    # 上次搜索的时间
+        self.presence = False   # 订阅了在线名单（发过 /roster），之后接收名单的增量变化
+        self.bot = None         # 机器人会话的订阅条件 [BotFilter]，普通客户端为None（不直接接收聊天消息）
+        self.bulk = None        # 机器人批量发送中: [类型, 剩余行数, 已收到的行]
+        self.bot_events = 0     # 已发给机器人的事件数
+        self.bot_batches = 0    # 发送这些事件用的写入次数
+        self.waiting = False    # 在等候队列中，尚未放行
+        # 发送队列：socket发不完的数据排队等待，不阻塞其他客户端
+        self.outq = None        # 待发送的帧 deque[(是否重要, 数据)]，聊天消息不重要，可以跳过；没有积压时为None
+        self.out_bytes = 0      # 队列中待发送的字节数
+        self.out_offset = 0     # 队首的帧已发出的字节数
+        self.last_progress = time.time()  # 最近一次发出数据（或队列为空）的时间
+        self.sent_bytes = 0     # 累计发出的字节数
+        self.drain_rate = 0.0   # 有积压时的发送速度（字节/秒）
+        self.rate_mark = (0, time.time())  # 计算发送速度的起点 (累计字节数, 时间)
+        self.skipped = 0        # 因积压被跳过的聊天消息数
+        self.unsent_skips = 0   # 队列中尚未发出的"已跳过"提示所包含的条数（多次跳过合并成一条提示）
+        self.peer = False       # 是其他服务器的互联连接，不是聊天客户端
+        self.peer_id = ""       # 对方服务器的编号（握手验证通过后确定）
+        self.peer_auth = None   # 互联握手进行中的状态：主动连接方为本方随机数，被连接方为 (对方编号, 期望的应答)
+        self.outbox = None      # 互联连接待攒批发送的帧（成为互联连接时分配）
+        self.unsent = b""       # 互联连接上次没发完的数据
+        # 延迟追踪样本（毫秒）：单向 = 客户端收到时间 - 服务器发出时间（含两端时钟偏差）
+        # 往返 = 服务器收到回执时间 - 服务器发出时间；收到第一个回执时才分配
+        self.one_way = None
+        self.round_trip = None
+
+class WorkerPool:
+    """后台工作线程池：把写磁盘、打印日志等可能阻塞的工作移出收发消息的线程
+    任务的完成回调通过唤醒socket交回接收线程执行"""
+    
+    def __init__(self, size, limit):
+        self.size = size
+        self.tasks = queue.Queue(limit)
+        self.completions = collections.deque()  # 待接收线程执行的 (回调, 结果, 异常)
+        self.serial = {}  # {键: 是否需要再执行一次}，同一键的任务不会并发，多次提交合并
+        self.deferred = collections.deque()  # 队列满时推迟的合并任务（每个键最多一个），工作线程空出来后执行
+        self.lock = threading.Lock()
+        self.threads = []
+        # 唤醒socket：接收线程在它和所有客户端连接上一起等待
+        self.wake_recv, self.wake_send = socket.socketpair()
+        self.wake_recv.setblocking(0)
+        self.wake_send.setblocking(0)
+        # 统计
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.postponed = 0  # 队列满时推迟的合并任务数
+        self.dropped = 0    # 队列满时丢弃的任务数
+        self.peak = 0       # 队列最大长度
+        self.busy_time = 0.0
+        
+    def start(self):
+        """启动工作线程"""
+        for i in range(self.size):
+            thread = threading.Thread(target=self.worker, name=f"worker-{i + 1}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+            
+    def stop(self, timeout=2):
+        """执行完已排队的任务后停止工作线程"""
+        for _ in self.threads:
+            try:
+                self.tasks.put(None, timeout=timeout)
+            except queue.Full:
+                break
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+        
+    def submit(self, func, *args, done=None):
+        """提交后台任务；done(结果, 异常) 会在接收线程中执行"""
+        with self.lock:
+            self.submitted += 1
+        if self.enqueue((func, args, done)):
+            return
+        # 队列满了说明磁盘等严重卡顿，提交者可能是接收线程，不能自己执行也不能等待：丢弃任务
+        # 有回调的照常回调（异常为 queue.Full），让提交者收尾
+        with self.lock:
+            self.dropped += 1
+        if done is not None:
+            self.completions.append((done, None, queue.Full()))
+            self.wake()
+            
+    def enqueue(self, task):
+        """把任务放入队列，队列满时返回False"""
+        try:
+            self.tasks.put_nowait(task)
+        except queue.Full:
+            return False
+        self.peak = max(self.peak, self.tasks.qsize())
+        return True
+        
+    def submit_serial(self, key, func):
+        """提交需要按顺序执行的任务（如写同一个文件）：同一键的任务在排队或执行时只记下再执行一次"""
+        with self.lock:
+            if key in self.serial:
+                self.serial[key] = True
+                return
+            self.serial[key] = False
+            self.submitted += 1
+        if not self.enqueue((self.run_serial, (key, func), None)):
+            # 合并任务的数据留在各自的缓冲区中，推迟执行不会丢失
+            with self.lock:
+                self.postponed += 1
+                self.deferred.append((self.run_serial, (key, func), None))
+        
+    def run_serial(self, key, func):
+        """执行合并的任务，执行期间有新的提交则再执行一次"""
+        while True:
+            try:
+                func()
+            except Exception as e:
+                print(f"❌ [ERROR] 后台任务 {key} 失败: {e}")
+                with self.lock:
+                    self.failed += 1
+            with self.lock:
+                if not self.serial[key]:
+                    del self.serial[key]
+                    return
+                self.serial[key] = False
+                
+    def run(self, func, args, done):
+        """执行一个任务并记录统计"""
+        start = time.perf_counter()
+        result = error = None
+        try:
+            result = func(*args)
+        except Exception as e:
+            error = e
+        with self.lock:
+            self.completed += 1
+            self.busy_time += time.perf_counter() - start
+            if error is not None:
+                self.failed += 1
+        if done is not None:
+            self.completions.append((done, result, error))
+            self.wake()
+        elif error is not None:
+            print(f"❌ [ERROR] 后台任务 {getattr(func, '__name__', func)} 失败: {error}")
+            
+    def worker(self):
+        """工作线程主循环"""
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            self.run(*task)
+            while self.deferred:
+                try:
+                    task = self.deferred.popleft()
+                except IndexError:
+                    break
+                self.run(*task)
+            
+    def wake(self):
+        """唤醒在 select 中等待的接收线程"""
+        try:
+            self.wake_send.send(b"\0")
+        except OSError:
+            pass  # 缓冲区已满说明接收线程已经会被唤醒
+            
+    def run_completions(self):
+        """在接收线程中执行已完成任务的回调（唤醒socket可读时调用）"""
+        try:
+            while self.wake_recv.recv(4096):
+                pass
+        except OSError:
+            pass
+        while self.completions:
+            done, result, error = self.completions.popleft()
+            try:
+                done(result, error)
+            except Exception as e:
+                print(f"❌ [ERROR] 后台任务回调失败: {e}")
+                
+    def summary(self):
+        """统计信息的文字"""
+        with self.lock:
+            average = self.busy_time / self.completed * 1000 if self.completed else 0
+            return (f"{self.size} 线程，排队 {self.tasks.qsize()} (最多 {self.peak})，已完成 {self.completed}，"
+                    f"失败 {self.failed}，队列满时推迟 {self.postponed}、丢弃 {self.dropped}，平均耗时 {average:.2f} ms")
+
+class SearchIndex:
+    """聊天记录的全文索引（倒排索引），只保留最近 limit 条消息
+    消息编号按转发顺序递增，倒排表是编号的递增数组，时间条件用二分查找转换为编号范围"""
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self.first = 0            # 仍保留的最早一条消息的编号
+        self.swept = 0            # 上次清理倒排表时的 first
+        self.times = array("q")   # 各消息的时间（毫秒）
+        self.senders = []
+        self.texts = []
+        self.postings = {}        # {索引词: array("I") 消息编号}
+        self.lock = threading.Lock()
+        
+    def __len__(self):
+        return len(self.texts)
+        
+    def add(self, messages):
+        """批量加入消息 [(时间毫秒, 发送者, 内容)]"""
+        with self.lock:
+            for sent, sender, text in messages:
+                message_id = self.first + len(self.texts)
+                self.times.append(sent)
+                self.senders.append(sender)
+                self.texts.append(text)
+                for token in search_tokens(text) | {SEARCH_SENDER_PREFIX + sender.lower()}:
+                    postings = self.postings.get(token)
+                    if postings is None:
+                        postings = self.postings[token] = array("I")
+                    postings.append(message_id)
+            overflow = len(self.texts) - self.limit
+            if overflow > 0:
+                # 丢弃最早的消息；倒排表中过期的编号在查询时跳过，累计一轮后统一清理
+                del self.times[:overflow]
+                del self.senders[:overflow]
+                del self.texts[:overflow]
+                self.first += overflow
+                if self.first - self.swept >= self.limit:
+                    self.sweep()
+                    
+    def sweep(self):
+        """从倒排表中删除过期的编号和不再出现的词（调用者持有锁）"""
+        for token in list(self.postings):
+            postings = self.postings[token]
+            index = bisect.bisect_left(postings, self.first)
+            if index == len(postings):
+                del self.postings[token]
+            elif index:
+                del postings[:index]
+        self.swept = self.first
+        
+    def search(self, terms, sender=None, after=None, before=None):
+        """返回匹配的消息 [(时间毫秒, 发送者, 内容)]，最新的在前，最多 SEARCH_MAX_RESULTS 条"""
+        tokens = set()
+        for term in terms:
+            tokens |= search_tokens(term, query=True)
+        if sender:
+            tokens.add(SEARCH_SENDER_PREFIX + sender.lower())
+        results = []
+        with self.lock:
+            low, high = self.first, self.first + len(self.texts)
+            if after is not None:
+                low += bisect.bisect_left(self.times, after)
+            if before is not None:
+                high = self.first + bisect.bisect_left(self.times, before)
+            if tokens:
+                lists = []
+                for token in tokens:
+                    postings = self.postings.get(token)
+                    if not postings:
+                        return []
+                    lists.append(postings)
+                # 从最短的倒排表出发，在其他表中二分查找
+                lists.sort(key=len)
+                shortest, others = lists[0], lists[1:]
+                positions = range(bisect.bisect_left(shortest, high) - 1, bisect.bisect_left(shortest, low) - 1, -1)
+                candidates = (shortest[i] for i in positions)
+            else:
+                candidates = range(high - 1, low - 1, -1)
+            for message_id in candidates:
+                if tokens and not all(self.contains(postings, message_id) for postings in others):
+                    continue
+                text = self.texts[message_id - self.first]
+                # 两字索引可能误匹配（如"中国人"匹配到分开出现的"中国"和"国人"），用原文确认
+                if terms and not all(term in text.lower() for term in terms):
+                    continue
+                results.append((self.times[message_id - self.first], self.senders[message_id - self.first], text))
+                if len(results) >= SEARCH_MAX_RESULTS:
+                    break
+        return results
+        
+    @staticmethod
+    def contains(postings, message_id):
+        """递增数组中是否有该编号"""
+        index = bisect.bisect_left(postings, message_id)
+        return index < len(postings) and postings[index] == message_id
+
+class ContentFilter:
+    """敏感词过滤器：词表编译成 Aho-Corasick 自动机，每条消息只扫描一遍
+    耗时只与消息长度有关，与词的数量无关；匹配不区分大小写（按 casefold 折叠）"""
+    
+    def __init__(self, entries):
+        self.patterns = []  # [(词, 动作)]，重复的词以最后一次为准
+        goto = [{}]         # 每个状态的转移 {字符: 状态}
+        terminal = {}       # {状态: 词编号}
+        for pattern, action in entries:
+            pattern = pattern.casefold()
+            state = 0
+            for char in pattern:
+                following = goto[state].get(char)
+                if following is None:
+                    following = goto[state][char] = len(goto)
+                    goto.append({})
+                state = following
+            if state in terminal:
+                self.patterns[terminal[state]] = (pattern, action)
+            else:
+                terminal[state] = len(self.patterns)
+                self.patterns.append((pattern, action))
+        # 按层次计算失败转移，每个状态的输出合并其失败状态的输出（较短的后缀词）
+        fail = [0] * len(goto)
+        output = [()] * len(goto)
+        for state, index in terminal.items():
+            output[state] = (index,)
+        pending = collections.deque(goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, following in goto[state].items():
+                target = fail[state]
+                while target and char not in goto[target]:
+                    target = fail[target]
+                fail[following] = goto[target].get(char, 0)
+                output[following] += output[fail[following]]
+                pending.append(following)
+        self.goto = goto
+        self.fail = fail
+        self.output = output
+        
+    def __len__(self):
+        return len(self.patterns)
+        
+    def scan(self, text):
+        """返回所有匹配 [(结束位置, 长度, 词编号)]，位置和长度按原文计算"""
+        goto, fail, output, patterns = self.goto, self.fail, self.output, self.patterns
+        folded = text.casefold()
+        origin = None
+        if len(folded) != len(text):
+            # 个别字符折叠后变长（如 ß → ss），记下折叠后每个字符对应的原文位置
+            origin = [start for start, char in enumerate(text) for _ in char.casefold()]
+        hits = []
+        state = 0
+        for position, char in enumerate(folded, 1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                if origin is None:
+                    hits.extend((position, len(patterns[index][0]), index) for index in output[state])
+                else:
+                    end = origin[position - 1] + 1
+                    hits.extend((end, end - origin[position - len(patterns[index][0])], index) for index in output[state])
+        return hits
+
+class BotFilter:
+    """机器人的一条订阅条件（/sub），其中各项同时满足才匹配
+    all、room:<local|服务器编号>、from:<用户名>、mention（@提到机器人）或 mention:<用户名>、re:<正则表达式>（必须放在最后）"""
+    
+    def __init__(self, text, bot_name):
+        self.text = text
+        self.room = None
+        self.sender = None
+        self.mention = None
+        self.pattern = None
+        rest = text.strip()
+        while rest:
+            word, _, remainder = rest.partition(" ")
+            lowered = word.lower()
+            if lowered.startswith("re:"):
+                try:
+                    self.pattern = re.compile(rest[3:])
+                except re.error as e:
+                    raise ValueError(f"正则表达式有误: {e}")
+                break
+            if lowered == "all":
+                pass
+            elif lowered.startswith("room:") and word[5:]:
+                self.room = word[5:]
+            elif lowered.startswith("from:") and word[5:]:
+                self.sender = word[5:]
+            elif lowered == "mention":
+                self.mention = self.mention_pattern(bot_name)
+            elif lowered.startswith("mention:") and word[8:]:
+                self.mention = self.mention_pattern(word[8:])
+            else:
+                raise ValueError(f"无法识别的订阅条件: {word}")
+            rest = remainder.strip()
+            
+    @staticmethod
+    def mention_pattern(name):
+        """@用户名 的正则：前后不能紧接英文字母、数字或下划线（@bot 不匹配 @bottle 和 a@bot），中文前后可以不加空格"""
+        return re.compile(r"(?<![0-9A-Za-z_])@" + re.escape(name) + r"(?![0-9A-Za-z_])")
+        
+    def match(self, room, sender, text):
+        """消息是否满足这条订阅条件"""
+        return ((self.room is None or self.room == room)
+                and (self.sender is None or self.sender == sender)
+                and (self.mention is None or self.mention.search(text) is not None)
+                and (self.pattern is None or self.pattern.search(text) is not None))
 
 class TFServer:
-    def __init__(self, ip, port, max_connections):
+    def __init__(self, ip, port, max_connections, startup_profile=False, multicast=None, peers=(), capture=None, unix_path=None,
+                 socket_buffers=None, high_scale=False, backlog=None, transport=None, max_per_ip=MAX_CONNECTIONS_PER_IP, peer_secret=""):
         self.ip = ip
         self.port = port
         self.max_connections = max_connections
         self.original_max_connections = max_connections    # 保存原始最大连接数
+        # 大规模模式：放宽连接数上限，启动时提高文件描述符上限、加长监听队列和排队人数
+        self.high_scale = high_scale
+        self.connection_limit = HIGH_SCALE_MAX_CONNECTIONS if high_scale else MAX_CONNECTIONS_LIMIT
+        self.waiting_room_size = HIGH_SCALE_WAITING_ROOM if high_scale else WAITING_ROOM_SIZE
+        self.listen_backlog = backlog or (HIGH_SCALE_BACKLOG if high_scale else socket.SOMAXCONN)
         
         self.socket = None
-        self.conn = []
-        self.address = []
-        self.usernames = []
+        # 本机程序（机器人、日志、桥接）可以改用 Unix 域套接字连接，协议和会话与TCP相同
+        self.unix_path = unix_path
+        self.unix_socket = None
+        self.socket_buffers = dict(SOCKET_BUFFERS, **(socket_buffers or {}))  # {连接类型: (接收, 发送)}
+        self.sessions = []  # 所有客户端会话（Session），包括排队中的
+        # 以下索引随会话增删维护，连接数很多时收发消息的路径不需要遍历所有会话
+        self.usernames = {}       # {用户名: 会话}，已注册的客户端和机器人
+        self.peer_sessions = []   # 服务器互联连接
+        self.ip_counts = collections.Counter()  # {IP: 连接数}，含互联连接
+        self.backlogged = set()   # 有待发送积压的会话（在 send_lock 内修改）
+        self.selector_changes = collections.deque()  # 接收线程待注册的会话 (True, 会话) / 待注销的连接 (False, 文件描述符或socket)，按发生顺序处理
+        self.waiting = collections.deque()  # 聊天室满员时排队等候的会话，按到达顺序放行
+        self.max_per_ip = max_per_ip
         self.banned_ips = []
         self.banned_ports = {}  # 存储被封禁的IP和端口 {ip: [ports]}
         self.server_running = False
         self.start_time = time.time()  # 记录服务器启动时间
+        self.startup_profile = startup_profile
+        self.startup_stages = [("模块导入完成", IMPORTS_DONE)]
+        
+        # 消息序号和历史记录（转发的每条消息都带序号和服务器时间戳）
+        # history 中每项为 (发出时间毫秒, 消息帧)
+        self.seq = 0
+        self.history = collections.deque(maxlen=HISTORY_SIZE)
+        # 延迟追踪：开启后客户端对每条消息回执收到时间
+        self.trace_enabled = False
+        self.server_delays = collections.deque(maxlen=TRACE_SAMPLES)  # 服务器收到到发出的耗时
+        self.relay_lock = threading.Lock()
+        self.echo_messages = not high_scale  # 在控制台显示聊天消息（由打印日志的后台线程解码，大规模模式默认关闭）
+        # 传输模式 (模式, 合并窗口秒)：服务器默认值和按聊天室（local 或互联服务器编号）单独设置的值
+        transport = dict(transport or {})
+        self.transport = transport.pop(None, ("latency", 0))
+        self.room_transport = transport
+        # throughput 模式等待合并发送的消息 [(数据, 帧数, 不发给的会话, 已组播)]，由接收线程在截止时间后发出（在 relay_lock 内修改）
+        self.batch = []
+        self.batch_started = 0
+        self.batch_deadline = None
+        # 各模式的效果统计：frames 写给客户端的帧数，writes 写入次数，batches 合并批数，held 合并等待的总秒数
+        self.transport_stats = {name: collections.Counter() for name in TRANSPORT_PROFILES}
+        self.recv_pool = []  # 空闲的接收缓冲区，只由接收线程使用，不需要加锁
+        # 写磁盘、打印日志等可能阻塞的工作交给后台线程，收发消息的线程只负责提交
+        self.workers = WorkerPool(WORKER_THREADS, WORKER_QUEUE_SIZE)
+        self.log_lines = collections.deque()  # 待后台线程打印的日志（聊天消息为未解码的元组）
+        
+        # 聊天记录搜索：转发时只把消息帧放入队列，由后台线程批量加入索引
+        self.search_index = SearchIndex(SEARCH_MAX_MESSAGES)
+        self.search_pending = collections.deque()
+        
+        # 在线名单：订阅的客户端先收到完整名单，之后只收到带版本号的增量变化
+        self.roster_version = 0
+        self.presence_pending = {}  # {用户名: "+" 或 "-"}，下次广播前的进出变化（按发生顺序）
+        self.presence_flushed = 0   # 上次广播的时间
+        self.presence_exposed = set()  # 本周期内已包含在完整名单中发出的待广播变化，之后不能再互相抵消
+        self.presence_lock = threading.Lock()
+        self.receive_thread = None
+        
+        # 离线信箱：@提到或私信不在线的用户时存到磁盘，对方注册用户名后一次发送
+        # 读写都由后台线程按提交顺序执行（mail_pending 中的操作）
+        self.known_users = set()  # 注册过的用户名
+        self.known_lengths = ()   # 注册过的用户名的各种长度（从长到短），用于匹配 @用户名
+        self.mail_pending = collections.deque()
+        self.mail_stored = 0
+        self.mail_delivered = 0
+        self.mail_dropped = 0  # 超出信箱配额没有保存的消息数
+        
+        # 机器人：不参与普通的逐条转发，新消息放入 bot_pending，由后台线程按订阅条件筛选后每个机器人一批发送
+        self.bots = []
+        self.bot_pending = collections.deque()  # [(聊天室, 消息帧)]，聊天室为 local 或来源服务器编号
+        self.bot_tokens = {}  # {机器人名: 令牌}
+        self.bot_tokens_mtime = None
         
-        # 尝试加载已封禁的IP和端口
-        self.load_banned_data()
+        # 内容过滤：没有词表时为None，转发时完全跳过；重新加载时在后台线程编译好再替换
+        self.content_filter = None
+        self.filter_mtime = None  # 已加载的词表文件的修改时间
+        self.filter_checked = 0   # 检查过的消息数
+        self.filter_actions = collections.Counter()  # {动作: 消息数}
+        self.filter_hits = collections.Counter()     # {词: 命中次数}
+        
+        # 组播分发（可选）：multicast 为 (组播地址, 端口)
+        self.multicast_group = multicast
+        self.multicast_socket = None
+        self.multicast_sent = 0
+        self.nack_repairs = 0
+        
+        # 文件传输：{文件编号: {"name", "size", "owner", "path", "state", "created"}}
+        # state: pending（已获准，等待上传）/ uploading / done
+        self.files = {}
+        self.files_lock = threading.Lock()
+        self.transfer_slots = threading.BoundedSemaphore(MAX_TRANSFERS)
+        
+        # 服务器互联：各服务器互相转发聊天消息和封禁，每条互联消息带 (来源服务器编号, 来源序号) 用于去重防环
+        self.server_id = os.urandom(4).hex()
+        self.peer_addresses = list(peers)  # 主动连接的其他服务器 [(ip, 端口)]
+        # 只接受互联地址中的服务器连过来，并且握手时口令必须一致
+        self.peer_secret = peer_secret
+        self.peer_ips = {ip: self.resolve_host(ip) for ip, _ in self.peer_addresses}  # {互联地址中的主机: IP}
+        self.peer_dialing = set()  # 正在后台线程中连接的互联地址
+        self.peer_retry = {}  # {互联地址: (下次重连时间, 重连间隔)}，握手成功后清除
+        self.fed_seq = 0
+        self.fed_seen = collections.OrderedDict()
+        self.fed_lock = threading.Lock()
+        self.peer_loads = {}  # {服务器编号: (ip, 端口, 已用名额, 最大连接数, 收到时间)}
+        
+        # 慢速客户端：所有发给客户端的数据都经过各自的发送队列
+        self.send_lock = threading.RLock()
+        self.slow_evictions = 0
+        
+        # 运行中诊断：cProfile 只能分析开启它的线程，所以由各服务线程在循环中自己开启/关闭
+        self.profiling = False
+        self.profilers = {}  # {线程名: cProfile.Profile}
+        self.active_profilers = set()  # 正在记录的线程名
+        self.profile_skipped = set()  # 无法开启分析器的线程名（本次分析中不再尝试）
+        self.mem_snapshot = None  # 上一次 mem snapshot 的快照
+        
+        # 流量录制：记录客户端发来的每一帧，可用 tf_replay.py 在新的服务器上重放
+        self.capture_file = None
+        self.capture_path = capture  # 启动时指定了 --capture 则立即开始录制
+        self.capture_start = 0
+        self.capture_records = 0
+        self.capture_lock = threading.Lock()
         
     def start(self):
         """启动服务器"""
         try:
+            if self.high_scale:
+                self.prepare_high_scale()
             self.socket = socket.socket()
             self.socket.bind((self.ip, self.port))
-            self.socket.listen(self.max_connections)
+            # 连接数由接受时的准入控制限制，监听队列只需吸收瞬间涌入的连接
+            self.socket.listen(self.listen_backlog)
             self.socket.setblocking(0)
+            self.startup_stages.append(("开始监听", time.perf_counter()))
+            
+            # 先绑定端口再加载封禁数据（在接受连接之前完成）
+            self.load_banned_data()
+            self.startup_stages.append(("封禁数据加载完成", time.perf_counter()))
+            
+            # 清理上次运行遗留的暂存文件
+            self.clear_file_spool()
+            
+            self.load_mailbox()
+            self.load_filter()
+            
+            if self.multicast_group:
+                self.open_multicast()
+            
+            if self.unix_path:
+                self.open_unix_listener()
+            
+            if self.capture_path:
+                self.start_capture(self.capture_path)
             
             self.server_running = True
             
             print(f"\nTouchFish服务器已启动！")
             print(f"监听地址: {self.ip}:{self.port}")
             print(f"最大连接数: {self.max_connections}")
+            if self.transport[0] != "latency" or self.room_transport:
+                rooms = "".join(f"，{room}: {format_transport(transport)}" for room, transport in self.room_transport.items())
+                print(f"传输模式: {format_transport(self.transport)}{rooms}")
+            if self.high_scale:
+                print(f"大规模模式: 监听队列 {self.listen_backlog}，排队上限 {self.waiting_room_size}，不显示聊天消息（echo on 开启）")
+            if self.multicast_socket is not None:
+                print(f"组播分发: {self.multicast_group[0]}:{self.multicast_group[1]}")
+            if self.unix_socket is not None:
+                print(f"本机套接字: {self.unix_path}")
+            print(f"服务器编号: {self.server_id}")
             print("\n输入 'help' 查看所有可用命令")
             print("按 Ctrl+C 或输入 'exit' 停止服务器\n")
             
             # 启动线程
-            t1 = threading.Thread(target=self.accept_connections)
-            t2 = threading.Thread(target=self.receive_messages)
+            self.workers.start()
+            t1 = threading.Thread(target=self.accept_connections, name="accept")
+            t2 = threading.Thread(target=self.receive_messages, name="receive")
+            self.receive_thread = t2
             t1.daemon = True
             t2.daemon = True
             t1.start()
             t2.start()
+            threading.Thread(target=self.federation_loop, name="federation", daemon=True).start()
             
             # 启动命令处理线程（非daemon，确保能正常处理命令）
-            t3 = threading.Thread(target=self.handle_commands)
+            t3 = threading.Thread(target=self.handle_commands, name="commands")
             t3.start()
             
+            if self.startup_profile:
+                self.startup_stages.append(("服务线程启动完成", time.perf_counter()))
+                report_startup_profile(self.startup_stages)
+            
             # 保持主线程运行
             try:
-                while True:
+                while self.server_running:
                     time.sleep(1)
             except KeyboardInterrupt:
                 print("\n🛑 正在停止服务器...")
@@ -73,143 +857,2010 @@ class TFServer:
         except Exception as e:
             print(f"❌ 启动服务器失败: {e}")
             
+    def prepare_high_scale(self):
+        """大规模模式的启动准备：提高文件描述符上限，预先分配接收缓冲区"""
+        needed = self.max_connections + self.waiting_room_size + FD_RESERVE
+        if resource is None:
+            # Windows 上 selectors 使用 select()，一次最多监听 512 个连接
+            print("⚠️  当前系统无法调整文件描述符上限，连接数受 select() 限制（Windows 约 500 个）")
+        else:
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if soft != resource.RLIM_INFINITY and soft < needed:
+                target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+                try:
+                    resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+                    soft = target
+                except (ValueError, OSError) as e:
+                    print(f"⚠️  无法提高文件描述符上限: {e}")
+            if soft != resource.RLIM_INFINITY and soft < needed:
+                # 描述符不够时排队人数恢复为普通模式的上限，其余留给聊天室
+                self.waiting_room_size = WAITING_ROOM_SIZE
+                usable = max(1, soft - self.waiting_room_size - FD_RESERVE)
+                print(f"⚠️  文件描述符上限只有 {soft}（系统硬上限 {hard}），最大连接数降为 {usable}；"
+                      f"可用 ulimit -n 或 /etc/security/limits.conf 提高")
+                self.max_connections = min(self.max_connections, usable)
+                self.original_max_connections = self.max_connections
+        try:
+            with open("/proc/sys/net/core/somaxconn") as f:
+                somaxconn = int(f.read())
+            if somaxconn < self.listen_backlog:
+                print(f"ℹ️  系统的 net.core.somaxconn 为 {somaxconn}，监听队列实际不超过这个值")
+        except (OSError, ValueError):
+            pass
+        # 大量连接同时登录时不必逐个分配接收缓冲区
+        while len(self.recv_pool) < RECV_POOL_SIZE:
+            self.recv_pool.append(bytearray(RECV_BUFFER_SIZE))
+        
+    def open_multicast(self):
+        """创建组播发送socket"""
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            # TTL=1：组播只在本局域网内传播
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, struct.pack("b", 1))
+            # 允许本机的客户端也收到（同时便于在回环地址上测试）
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            if self.ip not in ("", "0.0.0.0"):
+                # 从监听地址所在的网卡发出
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.ip))
+            self.multicast_socket = sock
+        except OSError as e:
+            print(f"❌ 组播初始化失败，将只使用TCP转发: {e}")
+            self.multicast_socket = None
+            
+    def open_unix_listener(self):
+        """在 Unix 域套接字上监听，本机程序不经过TCP协议栈，能否连接由套接字文件的权限决定"""
+        if not hasattr(socket, "AF_UNIX"):
+            print("⚠️  当前系统不支持 Unix 域套接字，忽略 --unix")
+            return
+        try:
+            if stat.S_ISSOCK(os.stat(self.unix_path).st_mode):
+                # 上次运行留下的套接字文件；能连上说明另一个服务器正在使用
+                probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    probe.connect(self.unix_path)
+                    print(f"❌ 本机套接字 {self.unix_path} 正被另一个服务器使用")
+                    return
+                except OSError:
+                    os.remove(self.unix_path)
+                finally:
+                    probe.close()
+        except FileNotFoundError:
+            pass
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(self.unix_path)
+            os.chmod(self.unix_path, UNIX_SOCKET_MODE)
+            sock.listen(self.listen_backlog)
+            sock.setblocking(0)
+        except OSError as e:
+            print(f"❌ 无法在本机套接字 {self.unix_path} 上监听: {e}")
+            return
+        self.unix_socket = sock
+        
     def stop(self):
         """停止服务器"""
         self.server_running = False
         
         # 关闭所有连接
-        for conn in self.conn:
+        for session in self.sessions:
             try:
-                conn.close()
+                session.conn.close()
             except:
                 pass
                 
-        self.conn.clear()
-        self.address.clear()
-        self.usernames.clear()
+        self.sessions.clear()
         
         try:
             self.socket.close()
         except:
             pass
+        
+        if self.multicast_socket is not None:
+            self.multicast_socket.close()
+        
+        if self.unix_socket is not None:
+            self.unix_socket.close()
+            try:
+                os.remove(self.unix_path)
+            except OSError:
+                pass
+        
+        self.clear_file_spool()
+        
+        if self.capture_file is not None:
+            self.stop_capture()
+        
+        # 等待后台任务（保存封禁数据、打印日志）完成
+        self.workers.stop()
+        self.workers.wake_send.close()
+        self.workers.wake_recv.close()
             
         print("✅ 服务器已停止")
         
     def accept_connections(self):
-        """接受客户端连接"""
+        """接受客户端连接（TCP和本机套接字），没有新连接时在 selector 上等待"""
+        selector = selectors.DefaultSelector()
+        selector.register(self.socket, selectors.EVENT_READ)
+        if self.unix_socket is not None:
+            selector.register(self.unix_socket, selectors.EVENT_READ)
         while self.server_running:
+            self.profile_checkpoint()
             try:
-                conn, addr = self.socket.accept()
-                
-                # 检查IP是否被封禁
-                if addr[0] in self.banned_ips:
-                    conn.send("您已被服务器封禁".encode("utf-8"))
-                    conn.close()
-                    continue
-                
-                # 检查IP和端口是否被封禁
-                if addr[0] in self.banned_ports and addr[1] in self.banned_ports[addr[0]]:
-                    conn.send("您已被服务器封禁".encode("utf-8"))
-                    conn.close()
-                    continue
-                
-                conn.setblocking(0)
-                self.conn.append(conn)
-                self.address.append(addr)
-                self.usernames.append("")
-                
-                print(f"[{self.get_timestamp()}] 🔗 新连接: {addr}")
-            except BlockingIOError:
-                # 正常的非阻塞socket行为，继续等待
-                continue
+                for key, _ in selector.select(RECEIVE_IDLE_TIMEOUT):
+                    self.accept_from(key.fileobj)
             except Exception as e:
+                if not self.server_running:
+                    break
                 print(f"❌ [ERROR] accept_connections: {e}")
                 time.sleep(0.1)
-                continue
+        selector.close()
                 
+    def accept_from(self, listener):
+        """接受一个监听socket上的新连接"""
+        try:
+            conn, addr = listener.accept()
+        except BlockingIOError:
+            # 别的连接请求已被取走（或对方已放弃）
+            return
+        local = listener is self.unix_socket
+        if local:
+            # 本机套接字没有IP和端口，用 ("unix", 对方进程号) 表示，可以用 ban unix 拒绝所有本机连接
+            addr = ("unix", self.peer_pid(conn))
+        
+        # 检查IP是否被封禁
+        if addr[0] in self.banned_ips:
+            conn.send("您已被服务器封禁\n".encode("utf-8"))
+            conn.close()
+            return
+        
+        # 检查IP和端口是否被封禁
+        if addr[0] in self.banned_ports and addr[1] in self.banned_ports[addr[0]]:
+            conn.send("您已被服务器封禁\n".encode("utf-8"))
+            conn.close()
+            return
+        
+        # 检查同一IP的连接数（本机套接字的连接由文件权限控制，不受限制）
+        if not local and self.max_per_ip and self.ip_counts[addr[0]] >= self.max_per_ip:
+            conn.send("来自您IP的连接数已达上限，请关闭其他客户端后再试\n".encode("utf-8"))
+            conn.close()
+            self.log(f"⛔ 拒绝连接: {addr} (同一IP连接数已达上限 {self.max_per_ip})")
+            return
+        
+        # 先记录再加入会话列表，接收线程处理该连接的断开时记录已经在前面
+        session = Session(conn, addr)
+        if not local:
+            self.set_nodelay(conn)
+        self.set_socket_buffers(session)
+        if not self.waiting and self.admitted_count() < self.max_connections:
+            conn.setblocking(0)
+            self.capture(session, CAPTURE_OPEN, f"{addr[0]}:{addr[1]}".encode("utf-8"))
+            self.log(f"🔗 新连接: {addr}")
+            self.add_session(session)
+        elif len(self.waiting) < self.waiting_room_size:
+            # 聊天室已满，进入等候队列，有空位时按顺序放行
+            conn.setblocking(0)
+            session.waiting = True
+            self.capture(session, CAPTURE_OPEN, f"{addr[0]}:{addr[1]}".encode("utf-8"))
+            self.log(f"⏳ 新连接排队: {addr} (第 {len(self.waiting) + 1} 位)")
+            self.waiting.append(session)
+            self.add_session(session)
+            self.send_wait_position(session, len(self.waiting))
+        else:
+            conn.send("服务器已满，请稍后再试\n".encode("utf-8"))
+            conn.close()
+            self.log(f"⛔ 拒绝连接: {addr} (等候队列已满)")
+            
+    def add_session(self, session):
+        """加入会话列表，通知接收线程开始监听该连接"""
+        self.ip_counts[session.address[0]] += 1
+        self.sessions.append(session)
+        self.selector_changes.append((True, session))
+        self.workers.wake()
+        
+    def detach_session(self, session):
+        """从会话列表和各项索引中移出（连接由调用者关闭或转交）
+        注销要在关闭连接之前排队：按文件描述符注销（关闭后的socket只能在selector中逐个查找），
+        并且新连接复用同一个文件描述符时不会先于注销被注册"""
+        self.sessions.remove(session)
+        fd = session.conn.fileno()
+        # 已被其他地方关闭的socket（fd 为 -1）只能按对象注销
+        self.selector_changes.append((False, fd if fd >= 0 else session.conn))
+        if session.peer and session in self.peer_sessions:
+            self.peer_sessions.remove(session)
+        ip = session.address[0]
+        self.ip_counts[ip] -= 1
+        if self.ip_counts[ip] <= 0:
+            del self.ip_counts[ip]
+        if session.username and self.usernames.get(session.username) is session:
+            del self.usernames[session.username]
+        with self.send_lock:
+            self.backlogged.discard(session)
+            
+    @staticmethod
+    def session_class(session):
+        """连接类型，用于选择内核缓冲区大小: client / local（本机套接字）/ bot / peer"""
+        if session.peer:
+            return "peer"
+        if session.bot is not None:
+            return "bot"
+        return "local" if session.address[0] == "unix" else "client"
+        
+    def set_socket_buffers(self, session):
+        """按连接类型设置内核收发缓冲区大小（接受连接时和连接类型确定后调用）"""
+        rcvbuf, sndbuf = self.socket_buffers[self.session_class(session)]
+        try:
+            if rcvbuf:
+                session.conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+            if sndbuf:
+                session.conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        except OSError:
+            pass  # 连接已关闭
+            
+    @staticmethod
+    def set_nodelay(conn):
+        """关闭TCP的Nagle算法：聊天帧很小，等待合并会让消息多等一个往返；需要合并时由 throughput 模式在服务器内完成"""
+        try:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass  # 连接已关闭
+            
+    @staticmethod
+    def peer_pid(conn):
+        """本机套接字对方的进程号（Linux 的 SO_PEERCRED），取不到时为0"""
+        try:
+            pid, _, _ = struct.unpack("3i", conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+            return pid
+        except (AttributeError, OSError):
+            return 0
+            
     def receive_messages(self):
-        """接收客户端消息"""
+        """接收客户端消息：在所有连接和后台任务的唤醒socket上等待，有数据时才处理"""
+        selector = selectors.DefaultSelector()
+        selector.register(self.workers.wake_recv, selectors.EVENT_READ)
         while self.server_running:
-            for i in range(len(self.conn)):
+            self.profile_checkpoint()
+            if self.waiting:
+                self.admit_waiting()
+            
+            # 注册新连接、注销已移除的连接（其他线程增删会话后通过唤醒socket通知），只处理变化的部分
+            while self.selector_changes:
+                add, item = self.selector_changes.popleft()
                 try:
-                    data = self.conn[i].recv(1024).decode('UTF-8')
-                    if not data:
-                        continue
+                    if add:
+                        selector.register(item.conn, selectors.EVENT_READ, item)
+                    else:
+                        selector.unregister(item)
+                except (KeyError, ValueError, OSError):
+                    pass  # 注册前已被关闭，或从未注册
+            
+            if self.presence_pending and time.time() - self.presence_flushed >= PRESENCE_INTERVAL:
+                self.flush_presence()
+            
+            if self.batch_deadline is not None and time.perf_counter() >= self.batch_deadline:
+                with self.relay_lock:
+                    self.flush_batch()
+            
+            with self.send_lock:
+                backlogged = list(self.backlogged)
+            for session in backlogged:
+                self.flush_backlog(session)
+            timeout = RECEIVE_BACKLOG_TIMEOUT if backlogged else RECEIVE_IDLE_TIMEOUT
+            deadline = self.batch_deadline
+            if deadline is not None:
+                timeout = max(0, min(timeout, deadline - time.perf_counter()))
+            if self.presence_pending:
+                timeout = min(timeout, PRESENCE_INTERVAL)
+            try:
+                events = selector.select(timeout)
+            except OSError:
+                # Windows 上有连接被其他线程关闭时 select 会失败，下一轮同步后恢复
+                time.sleep(RECEIVE_BACKLOG_TIMEOUT)
+                continue
+            for key, _ in events:
+                if key.data is None:
+                    self.workers.run_completions()
+                else:
+                    self.receive_from(key.data)
+        selector.close()
+        
+    def receive_from(self, session):
+        """读取一个连接上已到达的数据"""
+        try:
+            if session.inbuf is None:
+                self.attach_buffer(session)
+            elif session.inlen == len(session.inbuf):
+                self.grow_buffer(session)
+            count = session.conn.recv_into(session.inview[session.inlen:])
+            received = now_ms()
+            if not count:
+                # 客户端关闭了连接，释放名额
+                if session.peer:
+                    self.log(f"🌐 服务器互联已断开: {session.peer_id or '(握手中)'} {session.address}")
+                else:
+                    self.log(f"🔌 连接断开: {session.address} (用户: {session.username or '未注册'})")
+                self.remove_session(session)
+                return
+        except BlockingIOError:
+            return
+        except Exception as e:
+            print(f"❌ [ERROR] receive_messages (recv): {e}")
+            # 移除断开的连接
+            self.remove_session(session)
+            return
+        session.inlen += count
+        self.process_buffer(session, received)
+        
+    def attach_buffer(self, session):
+        """给会话分配接收缓冲区，优先复用缓冲池中的（只在接收线程中调用）"""
+        session.inbuf = self.recv_pool.pop() if self.recv_pool else bytearray(RECV_BUFFER_SIZE)
+        session.inview = memoryview(session.inbuf)
+        session.inlen = 0
+        
+    def grow_buffer(self, session):
+        """缓冲区被一个超长帧占满时扩大（最多到 MAX_LINE_BYTES 多一点）"""
+        size = min(len(session.inbuf) * 2, MAX_LINE_BYTES + RECV_BUFFER_SIZE)
+        buffer = bytearray(size)
+        buffer[:session.inlen] = session.inview[:session.inlen]
+        session.inbuf, session.inview = buffer, memoryview(buffer)
+        
+    def release_buffer(self, session):
+        """把会话的接收缓冲区放回缓冲池（只在接收线程中调用，其他线程移除的会话交给垃圾回收）"""
+        buffer = session.inbuf
+        if buffer is None:
+            return
+        session.inbuf = session.inview = None
+        session.inlen = 0
+        if len(buffer) == RECV_BUFFER_SIZE and len(self.recv_pool) < RECV_POOL_SIZE:
+            self.recv_pool.append(buffer)
+                    
+    def process_buffer(self, session, received):
+        """按换行符切分出完整的帧并处理，剩余部分移到缓冲区开头留到下次"""
+        buffer, view, length = session.inbuf, session.inview, session.inlen
+        if buffer is None:
+            return
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start, length)
+            if end < 0:
+                break
+            if session.waiting and not buffer.startswith((b"/file ", b"/peer "), start, length):
+                # 排队中的连接只处理文件传输和服务器互联请求，其余的帧（用户名）等放行后再处理
+                # 互联的其他服务器有空位时，直接把客户端转到那台服务器
+                if self.redirect_waiting(session):
+                    return
+                break
+            stop = end - 1 if end > start and buffer[end - 1] == 13 else end  # 去掉行尾的 \r
+            line = view[start:stop]
+            start = end + 1
+            if self.capture_file is not None:
+                self.capture(session, CAPTURE_LINE, line)
+            if self.handle_frame(session, line, received):
+                # 连接已转交给文件传输线程，剩余数据是文件内容
+                self.start_transfer(session, str(line, "utf-8", "replace"), bytes(view[start:length]))
+                return
+        
+        length -= start
+        if length > MAX_LINE_BYTES:
+            if session.waiting:
+                self.remove_session(session)
+                return
+            line = view[start:start + length]
+            if self.capture_file is not None:
+                self.capture(session, CAPTURE_LINE, line)
+            self.handle_frame(session, line, received)
+            length = 0
+        elif start and length:
+            view[:length] = view[start:start + length]
+        session.inlen = length
+        if not length and session.inbuf is buffer:
+            # 没有未完成的帧，缓冲区还回缓冲池（超长帧用的大缓冲区直接丢弃），空闲连接不占接收缓冲区
+            self.release_buffer(session)
+        
 
+    def admitted_count(self):
+        """已放行（占用聊天室名额）的连接数，不含排队的连接；服务器互联连接也占用名额"""
+        return len(self.sessions) - len(self.waiting)
+        
+    def admit_waiting(self):
+        """有空位时按排队顺序放行，并告知其余排队者新的位置"""
+        admitted = False
+        while self.waiting and self.admitted_count() < self.max_connections:
+            session = self.waiting.popleft()
+            session.waiting = False
+            admitted = True
+            self.log(f"✅ 放行排队连接: {session.address}")
+            # 处理排队期间收到的用户名
+            self.process_buffer(session, now_ms())
+        if admitted:
+            for position, session in enumerate(list(self.waiting), 1):
+                self.send_wait_position(session, position)
+                
+    def send_wait_position(self, session, position):
+        """告知排队的客户端当前位置: /wait <位置>"""
+        self.send_to(session, f"/wait {position}\n".encode("utf-8"))
+            
+    def send_to(self, session, data, critical=True):
+        """把数据放入客户端的发送队列并尽量立即发出；积压过多时按慢速客户端策略处理"""
+        with self.send_lock:
+            if session.outq is None:
+                # 没有积压时直接发送，通常一次就能全部发出，不必经过发送队列（转发给上万个客户端时省下不少时间）
+                try:
+                    sent = session.conn.send(data)
                 except BlockingIOError:
-                    # 正常的非阻塞socket行为，继续等待
+                    sent = 0
+                except OSError:
+                    return  # 连接已断开，由接收线程移除
+                session.sent_bytes += sent
+                if sent == len(data):
+                    return
+                session.out_offset = sent
+                session.outq = collections.deque([(critical, data)])
+                session.out_bytes += len(data)
+                session.last_progress = time.time()
+            else:
+                session.outq.append((critical, data))
+                session.out_bytes += len(data)
+                self.flush_session(session)
+            if session.out_bytes > SLOW_BACKLOG_BYTES:
+                self.shed_backlog(session)
+            backlog = bool(session.outq)
+            if backlog:
+                self.backlogged.add(session)
+        if backlog and threading.current_thread() is not self.receive_thread:
+            # 积压的数据由接收线程继续发送，叫醒它缩短等待时间
+            self.workers.wake()
+            
+    def log(self, text):
+        """把一行带时间戳的日志交给后台线程打印（控制台很慢时不拖慢收发消息）"""
+        self.log_lines.append(f"[{self.get_timestamp()}] {text}")
+        self.workers.submit_serial("log", self.flush_log)
+        
+    def flush_log(self):
+        """打印积攒的日志（后台线程）"""
+        lines = []
+        while self.log_lines:
+            line = self.log_lines.popleft()
+            if isinstance(line, tuple):
+                # 聊天消息 (收到时间, 发送者, 转义后的原始字节)
+                stamp, username, data = line
+                stamp = datetime.datetime.fromtimestamp(stamp).strftime("%H:%M:%S")
+                line = f"[{stamp}] 💬 消息: {username}: {unescape_line(str(data, 'utf-8', 'replace')).strip()}"
+            lines.append(line)
+        if lines:
+            print("\n".join(lines))
+                
+    def flush_session(self, session):
+        """尽量发送队列中的数据，socket写满时停止（调用者持有 send_lock）"""
+        while session.outq:
+            critical, data = session.outq[0]
+            try:
+                sent = session.conn.send(memoryview(data)[session.out_offset:])
+            except BlockingIOError:
+                return
+            except OSError:
+                # 连接已断开，由接收线程移除
+                session.outq = None
+                session.out_bytes = 0
+                return
+            session.sent_bytes += sent
+            session.last_progress = time.time()
+            session.out_offset += sent
+            if session.out_offset < len(data):
+                return
+            session.outq.popleft()
+            session.out_bytes -= len(data)
+            session.out_offset = 0
+            if critical == "notice":
+                session.unsent_skips = 0
+        session.outq = None  # 全部发出，释放队列
+            
+    def flush_backlog(self, session):
+        """接收线程每轮为有积压的客户端继续发送，并统计发送速度、处理长时间无进展的连接"""
+        with self.send_lock:
+            self.flush_session(session)
+            now = time.time()
+            mark_bytes, mark_time = session.rate_mark
+            if now - mark_time >= 1:
+                session.drain_rate = (session.sent_bytes - mark_bytes) / (now - mark_time)
+                session.rate_mark = (session.sent_bytes, now)
+            stalled = session.outq and now - session.last_progress > SLOW_STALL_TIMEOUT
+            if not session.outq:
+                self.backlogged.discard(session)
+        if stalled:
+            self.evict_slow(session, f"{SLOW_STALL_TIMEOUT}秒没有接收数据")
+            
+    def shed_backlog(self, session):
+        """积压过多时跳过较早的聊天消息，只保留最新的一部分；仍然过多时断开（调用者持有 send_lock）"""
+        # 队首的帧可能已发出一部分，必须保留以免破坏帧边界
+        head = [session.outq.popleft()] if session.out_offset else []
+        if head and head[0][0] == "notice":
+            session.unsent_skips = 0
+        frames = list(session.outq)
+        chat_count = sum(1 for critical, _ in frames if not critical)
+        out_bytes = session.out_bytes
+        kept = []
+        skipped = 0
+        for critical, data in frames:
+            if critical == "notice":
+                # 之前的提示还没发出，合并到新的提示中
+                out_bytes -= len(data)
+                continue
+            if not critical and (chat_count > SLOW_KEEP_MESSAGES or out_bytes > SLOW_BACKLOG_BYTES // 2):
+                chat_count -= 1
+                out_bytes -= len(data)
+                skipped += 1
+                continue
+            kept.append((critical, data))
+        if skipped or session.unsent_skips:
+            session.unsent_skips += skipped
+            notice = f"网络太慢，已跳过 {session.unsent_skips} 条消息\n".encode("utf-8")
+            kept.insert(0, ("notice", notice))
+            out_bytes += len(notice)
+            session.skipped += skipped
+            if session.skipped == skipped:
+                self.log(f"🐢 慢速客户端 {session.username or session.address}: 积压 {format_size(session.out_bytes)}，跳过了较早的消息")
+        session.outq = collections.deque(head + kept) if head or kept else None
+        session.out_bytes = out_bytes
+        if session.out_bytes > SLOW_DISCONNECT_BYTES:
+            self.evict_slow(session, f"积压 {format_size(session.out_bytes)}")
+            
+    def evict_slow(self, session, reason):
+        """断开跟不上的慢速客户端并告知原因"""
+        self.log(f"🐢 断开慢速客户端 {session.username or session.address}: {reason}")
+        self.slow_evictions += 1
+        try:
+            # 先用换行结束可能只发出一半的帧
+            session.conn.send("\n您的网络太慢，已被服务器断开连接\n".encode("utf-8"))
+        except:
+            pass
+        self.remove_session(session)
+        
+    def remove_session(self, session):
+        """关闭连接并移除会话"""
+        attached = session in self.sessions
+        if attached:
+            self.detach_session(session)
+        try:
+            session.conn.close()
+        except:
+            pass
+        if attached:
+            self.capture(session, CAPTURE_CLOSE, b"")
+            if session.username and not session.peer:
+                self.presence_changed(session.username, "-")
+        if session.bot is not None and session in self.bots:
+            self.bots.remove(session)
+        if session.waiting:
+            session.waiting = False
+            try:
+                self.waiting.remove(session)
+            except ValueError:
+                pass
+        if threading.current_thread() is self.receive_thread:
+            self.release_buffer(session)
+            
+    def handle_frame(self, session, line, received):
+        """处理一帧原始数据（memoryview），返回True表示该连接是文件传输连接
+        已注册客户端的普通聊天消息直接以字节转发，不解码"""
+        # 47 是 '/'，首尾字节都是空白时可能是空消息，交给 handle_line 判断
+        if (session.username and not session.peer and session.bulk is None and line and line[0] != 47
+                and (line[0] > 32 or line[-1] > 32)):
+            self.relay_chat(session, line, received)
+            return False
+        return self.handle_line(session, str(line, "utf-8", "replace"), received)
+        
+    def relay_chat(self, session, line, received):
+        """转发已注册客户端的聊天消息（line 为转义后的单行字节数据）"""
+        if self.content_filter is not None:
+            text = str(line, "utf-8", "replace")
+            filtered = self.filter_message(session, text)
+            if filtered is None:
+                return
+            if filtered is not text:
+                line = filtered.encode("utf-8")
+        if self.echo_messages:
+            # 只复制原始字节，解码和格式化交给打印日志的后台线程
+            self.log_lines.append((time.time(), session.username, bytes(line)))
+            self.workers.submit_serial("log", self.flush_log)
+        
+        # 由服务器加上注册时确定的发送者后转发给其他客户端（保持转义后的单行形式）
+        self.relay(line, exclude=session, received=received, prefix=session.prefix)
+        if self.peer_sessions:
+            self.federate("m " + str(session.prefix + line, "utf-8", "replace"))
+            
+    def handle_line(self, session, data, received=None):
+        """处理客户端发来的一帧消息，返回True表示该连接是文件传输连接"""
+        # 其他服务器的互联连接
+        if data.startswith("/peer ") and (session.peer or not session.username):
+            self.accept_peer(session, data[6:].strip())
+            return False
+        if data.startswith("/peerauth ") and session.peer and not session.peer_id:
+            self.finish_peer_auth(session, data[10:].strip())
+            return False
+        if session.peer:
+            # 握手完成（收到并核对了对方的 /peer）之前不处理互联消息
+            if session.peer_id:
+                self.handle_federation(session, data, received)
+            return False
+        if session.bulk is not None:
+            self.collect_bulk(session, data, received)
+            return False
+            
+        # 以'//'开头的是以'/'开头的聊天消息（客户端转义），去掉一个'/'后转发
+        if data.startswith("//") and session.username:
+            self.relay_chat(session, data[1:].encode("utf-8"), received)
+            return False
+            
+        # 以'/'开头的是客户端控制命令
+        if data.startswith("/"):
+            return self.handle_control(session, data)
+            
+        # 未注册的连接发来的第一行是用户名
+        if not session.username:
+            self.register_username(session, unescape_line(data.strip()))
+            return False
+        
+        if not data.strip():
+            return False
+        
+        self.relay_chat(session, data.encode("utf-8"), received)
+        return False
+        
+    def username_error(self, username):
+        """检查用户名是否可用，不可用时返回原因"""
+        error = None
+        if not username:
+            error = "用户名不能为空"
+        elif username.lower() == "server":
+            error = "用户名'server'被保留，请使用其他用户名"
+        elif ":" in username or username.startswith("/"):
+            error = "用户名不能包含':'，也不能以'/'开头"
+        elif len(username) > MAX_USERNAME_LENGTH:
+            error = f"用户名不能超过{MAX_USERNAME_LENGTH}个字符"
+        elif username in self.usernames:
+            error = f"用户名'{username}'已被使用，请使用其他用户名"
+        return error
+        
+    def register_username(self, session, username):
+        """注册用户名，注册后该会话的发送者身份固定不变"""
+        error = self.username_error(username)
+        if error:
+            self.send_to(session, f"{escape_line(error)}\n".encode("utf-8"))
+            return
+            
+        session.username = username
+        session.prefix = f"{escape_line(username)}: ".encode("utf-8")
+        self.usernames[username] = session
+        self.log(f"👤 用户 {username} 已连接")
+        # 发送确认消息
+        confirmation = f"USERNAME_OK:{escape_line(username)}\n"
+        if self.multicast_socket is not None:
+            # 告知客户端组播地址和下一条消息的序号，客户端可选择加入组播
+            with self.relay_lock:
+                group, port = self.multicast_group
+                confirmation += f"/mcast {group} {port} {self.seq + 1}\n"
+        if self.trace_enabled:
+            confirmation += "/trace on\n"
+        self.send_to(session, confirmation.encode("utf-8"))
+        self.presence_changed(username, "+")
+        
+        if username not in self.known_users:
+            self.known_users.add(username)
+            if len(username) not in self.known_lengths:
+                self.known_lengths = tuple(sorted(self.known_lengths + (len(username),), reverse=True))
+            self.queue_mail(("user", username))
+        # 离线期间收到的消息（没有信箱文件时后台线程直接跳过）
+        self.queue_mail(("deliver", session))
+        
+    def presence_changed(self, username, op):
+        """记录一次进入（+）或离开（-），由接收线程合并后广播"""
+        with self.presence_lock:
+            if self.presence_pending.get(username, op) != op and username not in self.presence_exposed:
+                # 同一广播周期内进入又离开（或离开又回来），名单没有变化
+                del self.presence_pending[username]
+            else:
+                self.presence_pending[username] = op
+        if threading.current_thread() is not self.receive_thread:
+            self.workers.wake()
+            
+    def flush_presence(self):
+        """把攒下的进出变化作为一帧增量广播给订阅的客户端: /presence <版本> +用户名:-用户名..."""
+        with self.presence_lock:
+            self.presence_flushed = time.time()
+            if not self.presence_pending:
+                return
+            # 用户名不能包含':'，用它分隔
+            changes = ":".join(op + escape_line(name) for name, op in self.presence_pending.items())
+            self.presence_pending.clear()
+            self.presence_exposed.clear()
+            self.roster_version += 1
+            frame = f"/presence {self.roster_version} {changes}\n".encode("utf-8")
+        for session in list(self.sessions):
+            if session.presence:
+                self.send_to(session, frame)
+                
+    def send_roster(self, session):
+        """订阅在线名单并发送完整名单: /roster <版本> 用户名:用户名..."""
+        with self.presence_lock:
+            session.presence = True
+            names = [escape_line(name) for name in list(self.usernames)]
+            frame = f"/roster {self.roster_version} {':'.join(names)}\n".encode("utf-8")
+            # 名单中已包含尚未广播的变化，这些用户在广播前再进出时要照常广播，否则拿到名单的客户端会留下已离开的人
+            self.presence_exposed.update(self.presence_pending)
+        # 之后的增量从版本号+1开始；客户端重复应用已包含在名单中的变化不影响结果
+        self.send_to(session, frame)
+        
+    def handle_control(self, session, data):
+        """处理客户端控制命令，返回True表示该连接是文件传输连接"""
+        args = data.split()
+        if not args:
+            return False
+        if args[0] == "/file" and len(args) >= 3 and args[1] in ("upload", "get"):
+            # 新建的文件传输连接
+            return True
+        if args[0] == "/bot" and len(args) in (2, 3) and not session.username:
+            # 机器人登录: /bot <机器人名> [令牌]
+            self.register_bot(session, args[1], args[2] if len(args) == 3 else "")
+            return False
+        if not session.username:
+            # 未注册的连接不能使用其他控制命令，按用户名处理（会被拒绝）
+            self.register_username(session, unescape_line(data.strip()))
+            return False
+        if args[0] == "/file" and len(args) >= 5 and args[1] == "put":
+            # 请求上传: /file put <请求编号> <大小> <文件名>
+            _, _, tag, size, name = data.split(" ", 4)
+            self.handle_file_put(session, tag, size, unescape_line(name))
+        elif args[0] == "/mcast" and len(args) == 2 and args[1] == "on":
+            # 客户端已加入组播，之后的聊天消息不再通过TCP发送给它
+            if self.multicast_socket is not None:
+                session.multicast = True
+        elif args[0] == "/nack" and len(args) == 3:
+            # 客户端发现组播丢包，从历史记录中补发
+            try:
+                first, last = int(args[1]), int(args[2])
+            except ValueError:
+                return
+            self.resend_history(session, first, min(last, first + MAX_NACK_RANGE - 1))
+        elif args[0] == "/ack" and len(args) == 3:
+            # 延迟追踪回执: /ack <序号> <客户端收到时间毫秒>
+            self.record_ack(session, args[1], args[2])
+        elif args[0] == "/search" and len(args) >= 2:
+            # 搜索服务器上的聊天记录: /search <条件>，在后台线程执行
+            now = time.time()
+            if now - session.last_search < SEARCH_INTERVAL:
+                self.send_to(session, "/results error 搜索太频繁，请稍后再试\n".encode("utf-8"))
+            else:
+                session.last_search = now
+                self.workers.submit(self.answer_search, session, unescape_line(data[8:]).strip())
+        elif args[0] == "/roster" and len(args) == 1:
+            # 请求完整的在线名单（第一次请求或客户端发现增量缺失时）
+            self.send_roster(session)
+        elif session.bot is not None and args[0] in ("/sub", "/unsub", "/bulk"):
+            self.handle_bot_control(session, args, data)
+        elif args[0] == "/dm" and len(args) >= 3:
+            # 私信: /dm <用户名> <内容>
+            self.send_direct(session, unescape_line(data[4:]).strip())
+        else:
+            # 未知命令不转发，告诉发送者消息没有发出
+            error = f"未知命令: {args[0]}（以'/'开头的聊天消息请写成'//'）"
+            self.send_to(session, f"{escape_line(error)}\n".encode("utf-8"))
+        return False
+            
+    def relay(self, payload, exclude=None, received=None, prefix=b"", room="local"):
+        """为消息分配序号、记入历史并转发给客户端，返回接收的客户端数
+        payload 可以是字符串或字节数据（直接拼入帧，不解码）"""
+        return self.relay_many([payload], exclude, received, prefix, room)
+        
+    def relay_many(self, payloads, exclude=None, received=None, prefix=b"", room="local"):
+        """转发同一发送者的多条消息，每个客户端只写一次；room 为消息来源（local 或来源服务器编号），用于机器人订阅"""
+        with self.relay_lock:
+            frames = []
+            for payload in payloads:
+                if isinstance(payload, str):
+                    payload = payload.encode("utf-8")
+                self.seq += 1
+                # 帧格式: /m <序号> <服务器收到时间> <服务器发出时间> <内容>（时间为毫秒时间戳）
+                sent = now_ms()
+                arrived = sent if received is None else received  # None 表示服务器自己发出的消息
+                frame = b"".join((b"/m %d %d %d " % (self.seq, arrived, sent), prefix, payload, b"\n"))
+                frames.append(frame)
+                self.history.append((sent, frame))
+                self.server_delays.append(sent - arrived)
+                self.search_pending.append(frame)
+                if self.bots:
+                    self.bot_pending.append((room, frame))
+            self.workers.submit_serial("search_index", self.index_messages)
+            
+            # 组播只发一次，已加入组播的客户端不再单独发送
+            multicast_ok = False
+            if self.multicast_socket is not None and all(len(frame) <= MAX_DATAGRAM_BYTES for frame in frames):
+                try:
+                    for frame in frames:
+                        self.multicast_socket.sendto(frame, self.multicast_group)
+                        self.multicast_sent += 1
+                    multicast_ok = True
+                except OSError as e:
+                    print(f"❌ [ERROR] 组播发送失败: {e}")
+            
+            data = frames[0] if len(frames) == 1 else b"".join(frames)
+            profile, window = self.room_transport.get(room, self.transport)
+            if profile == "throughput":
+                # 先放入合并窗口，由接收线程到截止时间后一起发出
+                now = time.perf_counter()
+                if not self.batch:
+                    self.batch_started = now
+                    self.batch_deadline = now + window
+                    if threading.current_thread() is not self.receive_thread:
+                        self.workers.wake()
+                else:
+                    self.batch_deadline = min(self.batch_deadline, now + window)
+                self.batch.append((data, len(frames), exclude, multicast_ok))
+                return len(self.usernames) - len(self.bots) - (1 if exclude is not None and exclude.username else 0)
+            if self.batch:
+                self.flush_batch()  # 先发出合并窗口中较早的消息，保证每个客户端收到的顺序与序号一致
+            sent_count = 0
+            writes = 0
+            for session in list(self.sessions):
+                # 不转发给自己和未注册的连接；机器人按订阅条件另行分发
+                if session is exclude or not session.username or session.bot is not None:
                     continue
-                except Exception as e:
-                    print(f"❌ [ERROR] receive_messages (recv): {e}")
-                    # 移除断开的连接
-                    try:
-                        self.conn[i].close()
-                    except:
-                        pass
-                    if i < len(self.conn):
-                        self.conn.pop(i)
-                        self.address.pop(i)
-                        self.usernames.pop(i)
+                if multicast_ok and session.multicast:
+                    sent_count += 1
                     continue
-                    
-
-                        
-                # 检查是否是用户名注册（客户端连接时发送用户名）
-                if i < len(self.usernames) and not self.usernames[i] and data.strip() and ":" not in data:
-                    # 这是用户名注册
-                    username = data.strip()
-                    if username.lower() == "server":
-                        self.conn[i].send("用户名'server'被保留，请使用其他用户名".encode("utf-8"))
-                    else:
-                        self.usernames[i] = username
-                        print(f"[{self.get_timestamp()}] 👤 用户 {username} 已连接")
-                        # 发送确认消息
-                        confirmation = f"USERNAME_OK:{username}"
-                        self.conn[i].send(confirmation.encode("utf-8"))
+                # 聊天消息可以被慢速客户端跳过
+                self.send_to(session, data, critical=False)
+                sent_count += 1
+                writes += 1
+            stats = self.transport_stats["latency"]
+            stats["writes"] += writes
+            stats["frames"] += writes * len(frames)
+            return sent_count
+            
+    def flush_batch(self):
+        """把合并窗口中的消息一次写给每个客户端（调用者持有 relay_lock）"""
+        batch = self.batch
+        if not batch:
+            return
+        self.batch = []
+        self.batch_deadline = None
+        stats = self.transport_stats["throughput"]
+        stats["batches"] += 1
+        stats["held"] += time.perf_counter() - self.batch_started
+        # 大多数客户端收到的是同样的数据，只有本批的发送者（不收自己的消息）和组播客户端需要单独拼接
+        senders = {exclude for _, _, exclude, _ in batch if exclude is not None}
+        multicast = any(multicast_ok for _, _, _, multicast_ok in batch)
+        data = b"".join(item[0] for item in batch)
+        count = sum(item[1] for item in batch)
+        for session in list(self.sessions):
+            if not session.username or session.bot is not None:
+                continue
+            if session in senders or (multicast and session.multicast):
+                items = [item for item in batch if item[2] is not session and not (item[3] and session.multicast)]
+                if not items:
                     continue
-                        
-                # 解析用户名和消息
-                if ":" in data:
-                    parts = data.split(":", 1)  # 只分割第一个冒号
-                    username = parts[0]
-                    message_content = parts[1] if len(parts) > 1 else ""
-                    
-                    # 检查用户名是否为server
-                    if username.lower() == "server":
-                        self.conn[i].send("用户名'server'被保留，请使用其他用户名".encode("utf-8"))
+                self.send_to(session, b"".join(item[0] for item in items), critical=False)
+                stats["frames"] += sum(item[1] for item in items)
+            else:
+                self.send_to(session, data, critical=False)
+                stats["frames"] += count
+            stats["writes"] += 1
+            
+    def index_messages(self):
+        """把新转发的消息加入搜索索引（后台线程，批量处理）"""
+        times, payloads = [], []
+        while self.search_pending:
+            # 帧格式: /m <序号> <服务器收到时间> <服务器发出时间> <发送者: 正文>\n
+            _, _, _, sent, payload = self.search_pending.popleft().split(b" ", 4)
+            times.append(int(sent))
+            payloads.append(payload)
+        # 转义后的帧内没有换行符，整批一次解码后再按行切开
+        texts = b"".join(payloads).decode("utf-8", errors="replace").split("\n")
+        messages = []
+        for sent, text in zip(times, texts):
+            sender, text = split_payload(unescape_line(text))
+            messages.append((sent, sender, text))
+        self.search_index.add(messages)
+        mentions = [message for message in messages if "@" in message[2]]
+        if mentions:
+            self.store_mentions(mentions)
+        
+    def match_username(self, text, start=0):
+        """返回 text[start:] 开头最长的注册过的用户名，没有则返回None（中文用户名后面可以不加空格）"""
+        for length in self.known_lengths:
+            name = text[start:start + length]
+            if len(name) == length and name in self.known_users:
+                return name
+        return None
+        
+    def store_mentions(self, messages):
+        """把@提到不在线用户的消息存入对方的离线信箱（后台线程）"""
+        online = set(self.usernames)
+        for sent, sender, text in messages:
+            names = set()
+            start = text.find("@")
+            while start != -1:
+                name = self.match_username(text, start + 1)
+                if name is not None:
+                    names.add(name)
+                start = text.find("@", start + 1)
+            for name in names - online - {sender}:
+                self.queue_mail(("store", name, sent, f"{sender}: {text}"))
+                
+    def send_direct(self, session, text):
+        """私信：对方在线时直接发送，不在线时存入离线信箱（只在本服务器内，不经过互联转发）"""
+        name = self.match_username(text)
+        body = text[len(name):].strip() if name else ""
+        if name is None or (len(text) > len(name) and not text[len(name)].isspace()):
+            self.send_to(session, f"{escape_line('私信失败: 找不到该用户（用法: /dm 用户名 内容）')}\n".encode("utf-8"))
+            return
+        if body and self.content_filter is not None:
+            body = self.filter_message(session, body)
+        if not body:
+            return
+        line = f"[私信] {session.username}: {body}"
+        target = self.usernames.get(name)
+        if target is not None:
+            self.send_to(target, f"{escape_line(line)}\n".encode("utf-8"))
+        else:
+            self.queue_mail(("store", name, now_ms(), line))
+            self.send_to(session, f"{escape_line(f'{name} 不在线，私信已存入离线信箱')}\n".encode("utf-8"))
+        self.log(f"✉️  私信: {session.username} → {name}")
+        
+    def bot_token_valid(self, name, token):
+        """检查机器人令牌（词表文件修改后重新读取）"""
+        try:
+            mtime = os.stat(BOT_TOKENS_FILE).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self.bot_tokens_mtime:
+            tokens = {}
+            if mtime is not None:
+                try:
+                    with open(BOT_TOKENS_FILE, encoding="utf-8-sig") as f:
+                        for line in f:
+                            parts = line.split()
+                            if len(parts) == 2 and not parts[0].startswith("#"):
+                                tokens[parts[0]] = parts[1]
+                except OSError as e:
+                    print(f"❌ [ERROR] 无法读取机器人令牌 {BOT_TOKENS_FILE}: {e}")
+            self.bot_tokens = tokens
+            self.bot_tokens_mtime = mtime
+        expected = self.bot_tokens.get(name)
+        return expected is not None and hmac.compare_digest(expected.encode("utf-8"), token.encode("utf-8"))
+        
+    def register_bot(self, session, name, token):
+        """机器人登录: 本机套接字连接不需要令牌，其他连接的令牌必须与 tf_bots.txt 一致"""
+        name = unescape_line(name)
+        error = self.username_error(name)
+        if error is None and session.address[0] != "unix" and not self.bot_token_valid(name, token):
+            error = "机器人令牌无效"
+        if error:
+            self.log(f"⛔ 机器人登录失败: {session.address} {name} ({error})")
+            self.send_to(session, f"{escape_line(error)}\n".encode("utf-8"))
+            return
+        session.username = name
+        session.prefix = f"{escape_line(name)}: ".encode("utf-8")
+        self.usernames[name] = session
+        session.bot = []
+        self.bots.append(session)
+        self.set_socket_buffers(session)
+        self.log(f"🤖 机器人 {name} 已连接")
+        self.send_to(session, f"BOT_OK:{escape_line(name)}\n".encode("utf-8"))
+        self.presence_changed(name, "+")
+        
+    def handle_bot_control(self, session, args, data):
+        """机器人命令: /sub <条件>、/unsub、/bulk [dm] <条数>"""
+        if args[0] == "/sub":
+            try:
+                session.bot.append(BotFilter(unescape_line(data[5:]), session.username))
+            except ValueError as e:
+                self.send_to(session, f"/sub error {escape_line(str(e))}\n".encode("utf-8"))
+                return
+            self.send_to(session, f"/sub ok {len(session.bot)}\n".encode("utf-8"))
+        elif args[0] == "/unsub":
+            session.bot.clear()
+            self.send_to(session, b"/sub ok 0\n")
+        else:
+            # 之后的 <条数> 行是要发送的消息（dm 时每行为 "用户名 内容"）
+            kind = "dm" if len(args) == 3 and args[1] == "dm" else "chat"
+            try:
+                count = int(args[-1])
+            except ValueError:
+                count = 0
+            if not 0 < count <= BOT_BULK_MAX or len(args) > 3 or (len(args) == 3 and kind != "dm"):
+                self.send_to(session, f"/bulk error 用法: /bulk [dm] <1-{BOT_BULK_MAX}>\n".encode("utf-8"))
+                return
+            session.bulk = [kind, count, []]
+            
+    def collect_bulk(self, session, data, received):
+        """收集批量发送的消息，收齐后一起处理: 聊天消息用一次转发发给所有客户端，私信逐条发送"""
+        kind, remaining, lines = session.bulk
+        lines.append(data)
+        session.bulk[1] = remaining - 1
+        if remaining > 1:
+            return
+        session.bulk = None
+        if kind == "dm":
+            for line in lines:
+                self.send_direct(session, unescape_line(line).strip())
+        else:
+            payloads = []
+            for line in lines:
+                if not line.strip():
+                    continue
+                if line.startswith("//"):
+                    line = line[1:]
+                if self.content_filter is not None:
+                    line = self.filter_message(session, line)
+                    if line is None:
                         continue
+                payloads.append(line.encode("utf-8"))
+            if payloads:
+                self.relay_many(payloads, exclude=session, received=received, prefix=session.prefix)
+                if self.peer_sessions:
+                    for payload in payloads:
+                        self.federate("m " + str(session.prefix + payload, "utf-8", "replace"))
+        self.log(f"🤖 机器人 {session.username} 批量发送 {len(lines)} 条{'私信' if kind == 'dm' else '消息'}")
+        self.send_to(session, f"/bulk ok {len(lines)}\n".encode("utf-8"))
+        
+    def dispatch_bots(self):
+        """按订阅条件把新消息分发给机器人（后台线程），每个机器人每批只写一次: /ev <序号> <发出时间> <聊天室> <发送者: 内容>"""
+        events = []
+        while self.bot_pending:
+            room, frame = self.bot_pending.popleft()
+            _, seq, _, sent, payload = frame.split(b" ", 4)
+            sender, text = split_payload(unescape_line(payload[:-1].decode("utf-8", errors="replace")))
+            events.append((room, sender, text, b"/ev %s %s %s %s" % (seq, sent, room.encode("utf-8"), payload)))
+        for bot in list(self.bots):
+            filters = list(bot.bot)
+            batch = [event for room, sender, text, event in events
+                     if sender != bot.username and any(f.match(room, sender, text) for f in filters)]
+            if batch:
+                self.send_to(bot, b"".join(batch), critical=False)
+                bot.bot_events += len(batch)
+                bot.bot_batches += 1
+                
+    def show_bots(self):
+        """显示已连接的机器人和订阅"""
+        print("\n=== 机器人 ===")
+        if not self.bots:
+            print(f"没有已连接的机器人（令牌写在 {BOT_TOKENS_FILE}，每行 \"机器人名 令牌\"）")
+        for bot in list(self.bots):
+            print(f"{bot.username} {bot.address} 事件 {bot.bot_events} 条 / 写入 {bot.bot_batches} 次")
+            for f in bot.bot:
+                print(f"  订阅: {f.text}")
+        print("=" * 30 + "\n")
+        
+    def filter_message(self, session, text):
+        """按敏感词表检查消息，返回要发送的文本（打码后可能是新的字符串），被拦截时返回None"""
+        content_filter = self.content_filter
+        self.filter_checked += 1
+        hits = content_filter.scan(text)
+        if not hits:
+            return text
+        actions = set()
+        for _, _, index in hits:
+            word, action = content_filter.patterns[index]
+            self.filter_hits[word] += 1
+            actions.add(action)
+        self.filter_actions.update(actions)
+        words = "、".join(sorted({content_filter.patterns[index][0] for _, _, index in hits}))
+        if "block" in actions:
+            self.log(f"🚫 已拦截 {session.username} 的消息（命中: {words}）")
+            self.send_to(session, f"{escape_line('消息包含不允许发送的内容，未发送')}\n".encode("utf-8"))
+            return None
+        if "flag" in actions:
+            self.log(f"🚩 标记 {session.username} 的消息（命中: {words}）: {text}")
+        if "mask" in actions:
+            chars = list(text)
+            for end, length, index in hits:
+                if content_filter.patterns[index][1] == "mask":
+                    chars[end - length:end] = "*" * length
+            text = "".join(chars)
+        return text
+        
+    def load_filter(self):
+        """读取并编译敏感词表（后台线程），编译完成后替换正在使用的过滤器"""
+        try:
+            mtime = os.stat(FILTER_FILE).st_mtime
+        except OSError:
+            if self.content_filter is not None:
+                self.log(f"🧹 敏感词表 {FILTER_FILE} 已删除，停止内容过滤")
+            self.content_filter = None
+            self.filter_mtime = None
+            return
+        entries = []
+        try:
+            with open(FILTER_FILE, encoding="utf-8-sig") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    action, separator, word = line.partition(":")
+                    if not separator or action.lower() not in FILTER_ACTIONS:
+                        action, word = "mask", line  # 没有动作前缀（词本身可能含':'，如 http://）
+                    if word.strip():
+                        entries.append((word.strip(), action.lower()))
+        except (OSError, UnicodeDecodeError) as e:
+            self.log(f"❌ [ERROR] 无法读取敏感词表 {FILTER_FILE}: {e}")
+            self.filter_mtime = mtime  # 文件再次修改后重试
+            return
+        start = time.perf_counter()
+        content_filter = ContentFilter(entries) if entries else None
+        elapsed = (time.perf_counter() - start) * 1000
+        self.content_filter = content_filter
+        self.filter_mtime = mtime
+        if content_filter is None:
+            self.log(f"🧹 敏感词表 {FILTER_FILE} 为空，不过滤消息")
+        else:
+            self.log(f"🧹 已加载敏感词表 {FILTER_FILE}: {len(content_filter)} 个词，"
+                     f"{len(content_filter.goto)} 个状态，编译耗时 {elapsed:.1f} ms")
+            
+    def show_filter(self):
+        """显示内容过滤的统计"""
+        content_filter = self.content_filter
+        print("\n=== 内容过滤 ===")
+        if content_filter is None:
+            print(f"未启用（在服务器目录创建 {FILTER_FILE}，每行一个词，保存后自动加载）")
+        else:
+            counts = collections.Counter(action for _, action in content_filter.patterns)
+            print(f"词表: {FILTER_FILE}，{len(content_filter)} 个词"
+                  f"（拦截 {counts['block']} / 打码 {counts['mask']} / 标记 {counts['flag']}），{len(content_filter.goto)} 个状态")
+        print(f"已检查消息: {self.filter_checked}")
+        print(f"已拦截: {self.filter_actions['block']}，已打码: {self.filter_actions['mask']}，已标记: {self.filter_actions['flag']}")
+        if self.filter_hits:
+            print("命中最多的词:")
+            for word, count in self.filter_hits.most_common(10):
+                print(f"  {word}: {count}")
+        print("=" * 30 + "\n")
+        
+    def load_mailbox(self):
+        """加载注册过的用户名，删除已过期的离线信箱"""
+        try:
+            os.makedirs(MAILBOX_DIR, exist_ok=True)
+            users_path = os.path.join(MAILBOX_DIR, MAILBOX_USERS_FILE)
+            if os.path.exists(users_path):
+                with open(users_path, encoding="utf-8") as f:
+                    self.known_users.update(unescape_line(line.rstrip("\n")) for line in f if line.strip())
+            expired = time.time() - MAILBOX_EXPIRY
+            for name in os.listdir(MAILBOX_DIR):
+                path = os.path.join(MAILBOX_DIR, name)
+                # 信箱文件最后修改时间早于期限说明其中所有消息都已过期
+                if name != MAILBOX_USERS_FILE and os.path.getmtime(path) < expired:
+                    os.remove(path)
+        except OSError as e:
+            print(f"⚠️  无法加载离线信箱: {e}")
+        self.known_lengths = tuple(sorted({len(name) for name in self.known_users}, reverse=True))
+        
+    def mailbox_path(self, username):
+        """用户的离线信箱文件（用户名可能包含文件名不允许的字符，所以用哈希）"""
+        return os.path.join(MAILBOX_DIR, hashlib.sha1(username.encode("utf-8")).hexdigest() + ".txt")
+        
+    def queue_mail(self, operation):
+        """提交离线信箱操作: ("user", 用户名) / ("store", 用户名, 时间毫秒, 消息) / ("deliver", 会话)"""
+        self.mail_pending.append(operation)
+        self.workers.submit_serial("mailbox", self.process_mail)
+        
+    def process_mail(self):
+        """按提交顺序执行离线信箱操作（后台线程）"""
+        while self.mail_pending:
+            operation = self.mail_pending.popleft()
+            try:
+                if operation[0] == "user":
+                    with open(os.path.join(MAILBOX_DIR, MAILBOX_USERS_FILE), "a", encoding="utf-8") as f:
+                        f.write(escape_line(operation[1]) + "\n")
+                elif operation[0] == "store":
+                    self.store_mail(*operation[1:])
+                else:
+                    self.deliver_mail(operation[1])
+            except OSError as e:
+                self.log(f"❌ [ERROR] 离线信箱读写失败: {e}")
+                
+    def store_mail(self, username, sent, line):
+        """把一条消息追加到用户的离线信箱，每行: <时间毫秒> <消息（已转义）>"""
+        path = self.mailbox_path(username)
+        record = f"{sent} {escape_line(line)}\n".encode("utf-8")
+        mode = "ab"
+        try:
+            info = os.stat(path)
+            if info.st_mtime < time.time() - MAILBOX_EXPIRY:
+                mode = "wb"  # 原有的消息都已过期
+            elif info.st_size + len(record) > MAILBOX_QUOTA:
+                self.mail_dropped += 1
+                return
+        except FileNotFoundError:
+            pass
+        with open(path, mode) as f:
+            f.write(record)
+        self.mail_stored += 1
+        
+    def deliver_mail(self, session):
+        """把离线信箱中未过期的消息一次发送给刚注册的用户，然后清空信箱"""
+        if session not in self.sessions:
+            return  # 投递前已断开，留到下次
+        path = self.mailbox_path(session.username)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        os.remove(path)
+        expired = now_ms() - MAILBOX_EXPIRY * 1000
+        records = []
+        for record in data.decode("utf-8", errors="replace").splitlines():
+            sent, _, line = record.partition(" ")
+            if sent.isdigit() and int(sent) >= expired:
+                records.append((int(sent), line))
+        # @提到的消息经过搜索索引的批处理后才存入，可能晚于之后的私信，按时间重新排序
+        records.sort(key=lambda record: record[0])
+        lines = [f"[{datetime.datetime.fromtimestamp(sent / 1000).strftime('%m-%d %H:%M')}] {line}" for sent, line in records]
+        if not lines:
+            return
+        header = f"📬 您不在线时有 {len(lines)} 条消息提到您或发给您:"
+        self.send_to(session, ("\n".join([header] + lines) + "\n").encode("utf-8"))
+        self.mail_delivered += len(lines)
+        self.log(f"📬 已向 {session.username} 投递 {len(lines)} 条离线消息")
+        
+    def run_search(self, query):
+        """执行搜索，返回 (匹配数, 页码, 总页数, 本页结果)；条件有误时抛出 ValueError"""
+        terms, options = parse_search_query(query)
+        results = self.search_index.search(terms, options["from"], options["after"], options["before"])
+        pages = max(1, (len(results) + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE)
+        page = min(options["page"], pages)
+        return len(results), page, pages, results[(page - 1) * SEARCH_PAGE_SIZE:page * SEARCH_PAGE_SIZE]
+        
+    def answer_search(self, session, query):
+        """回复客户端的搜索（后台线程）: /results <匹配数> <页码> <总页数> <本页条数>，之后每条 /hit <时间毫秒> <发送者: 内容>"""
+        try:
+            total, page, pages, hits = self.run_search(query)
+        except ValueError as e:
+            self.send_to(session, f"/results error {escape_line(str(e))}\n".encode("utf-8"))
+            return
+        lines = [f"/results {total} {page} {pages} {len(hits)}"]
+        lines += [f"/hit {sent} {escape_line(f'{sender}: {text}')}" for sent, sender, text in hits]
+        self.send_to(session, ("\n".join(lines) + "\n").encode("utf-8"))
+        
+    def show_search(self, query):
+        """在控制台显示搜索结果"""
+        start = time.perf_counter()
+        try:
+            total, page, pages, hits = self.run_search(query)
+        except ValueError as e:
+            print(f"❌ {e}")
+            return
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"\n=== 搜索结果: {total} 条{'（只显示最新的部分）' if total >= SEARCH_MAX_RESULTS else ''}，第 {page}/{pages} 页，耗时 {elapsed:.1f} ms ===")
+        for sent, sender, text in hits:
+            stamp = datetime.datetime.fromtimestamp(sent / 1000).strftime("%Y-%m-%d %H:%M:%S")
+            print(f"[{stamp}] {sender}: {text}")
+        if not hits:
+            print("没有找到匹配的消息")
+        elif page < pages:
+            query = " ".join(word for word in query.split() if not word.lower().startswith("page:"))
+            print(f"输入 search {query} page:{page + 1} 查看下一页")
+        print("=" * 30 + "\n")
+        
+    def resend_history(self, session, first, last):
+        """通过TCP补发序号在[first, last]之间的历史消息"""
+        with self.relay_lock:
+            oldest = self.seq - len(self.history) + 1
+            first = max(first, oldest)
+            last = min(last, self.seq)
+            if first > last:
+                return
+            frames = [self.history[seq - oldest][1] for seq in range(first, last + 1)]
+        self.send_to(session, b"".join(frames), critical=False)
+        self.nack_repairs += len(frames)
                     
-                    # 更新用户名
-                    if i < len(self.usernames):
-                        self.usernames[i] = username
-                    
-                    # 显示消息
-                    print(f"[{self.get_timestamp()}] 💬 消息: {data.strip()}")
-                    
-                    # 转发给其他客户端
-                    for j in range(len(self.conn)):
-                        if i != j:  # 不转发给自己
-                            try:
-                                self.conn[j].send(data.encode("utf-8"))
-                            except:
-                                pass
+    def accept_peer(self, session, args):
+        """处理互联握手（口令不经过网络，双方用口令对随机数做HMAC互相验证）
+        主动连接方先发 /peer <编号> <随机数> <监听端口>，被连接方回复 /peer <编号> <随机数> <监听端口> <应答>，
+        主动连接方核对应答后发 /peerauth <应答>，被连接方核对后双方建立互联"""
+        parts = args.split()
+        peer_id = parts[0] if parts else ""
+        if not peer_id or peer_id == self.server_id:
+            # 连到了自己
+            self.remove_session(session)
+            return
+        if session.peer_id:
+            return  # 已建立的互联连接上重复的握手
+        if not session.peer:
+            # 对方主动连接过来：对方的IP必须在互联地址中
+            if not self.peer_secret or len(parts) < 2 or session.address[0] not in self.peer_ips.values():
+                self.log(f"⛔ 拒绝互联: {session.address} (不是配置的互联服务器或未设置互联口令)")
+                self.remove_session(session)
+                return
+            # 记下对方的监听端口（互联地址中有对方时不再重复连接），回复本机编号、随机数和应答
+            if len(parts) >= 3 and parts[2].isdigit():
+                session.address = (session.address[0], int(parts[2]))
+            nonce = os.urandom(16).hex()
+            session.peer = True
+            session.outbox = []
+            session.peer_auth = (peer_id, self.peer_proof("dial", parts[1], nonce, peer_id, self.server_id))
+            self.peer_sessions.append(session)
+            if session.waiting:
+                # 互联连接不用排队（仍计入连接数）
+                session.waiting = False
+                try:
+                    self.waiting.remove(session)
+                except ValueError:
+                    pass
+            proof = self.peer_proof("accept", parts[1], nonce, self.server_id, peer_id)
+            self.queue_peer_frame(session, f"/peer {self.server_id} {nonce} {self.port} {proof}")
+            return
+        # 我方主动连接的，收到对方的回复：核对对方的应答后回复我方的应答
+        nonce = session.peer_auth
+        if not isinstance(nonce, str) or len(parts) < 4 or not hmac.compare_digest(
+                parts[3], self.peer_proof("accept", nonce, parts[1], peer_id, self.server_id)):
+            self.log(f"⛔ 拒绝互联: {session.address} (互联口令不一致)")
+            self.remove_session(session)
+            return
+        self.queue_peer_frame(session, f"/peerauth {self.peer_proof('dial', nonce, parts[1], self.server_id, peer_id)}")
+        self.peer_retry.pop(session.address, None)
+        self.establish_peer(session, peer_id, True)
+        
+    def finish_peer_auth(self, session, proof):
+        """被连接方核对主动连接方的应答: /peerauth <应答>"""
+        peer_id, expected = session.peer_auth
+        if not hmac.compare_digest(proof, expected):
+            self.log(f"⛔ 拒绝互联: {session.address} (互联口令不一致)")
+            self.remove_session(session)
+            return
+        self.establish_peer(session, peer_id, False)
+        
+    def establish_peer(self, session, peer_id, dialed):
+        """握手验证通过，建立互联；dialed 表示是我方主动连接的"""
+        for other in self.peer_sessions:
+            if other is not session and other.peer_id == peer_id:
+                # 双方互相连接时有两条连接，两边都只保留编号较小的服务器发起的那条
+                if (self.server_id if dialed else peer_id) == min(self.server_id, peer_id):
+                    self.remove_session(other)
                 else:
-                    # 显示消息
-                    print(f"[{self.get_timestamp()}] 💬 消息: {data.strip()}")
+                    self.remove_session(session)
+                    return
+                break
+        session.peer_auth = None
+        session.peer_id = peer_id
+        self.set_socket_buffers(session)
+        self.log(f"🌐 服务器互联已建立: {peer_id} ({session.address[0]}:{session.address[1]})")
+        
+    def peer_proof(self, role, dial_nonce, accept_nonce, sender, receiver):
+        """互联握手的应答：用互联口令对双方的随机数和编号做HMAC"""
+        text = f"{role} {dial_nonce} {accept_nonce} {sender} {receiver}"
+        return hmac.new(self.peer_secret.encode("utf-8"), text.encode("utf-8"), hashlib.sha256).hexdigest()
+        
+    @staticmethod
+    def resolve_host(host):
+        """把互联地址中的主机名解析为IP，解析失败时原样返回"""
+        try:
+            return socket.gethostbyname(host)
+        except OSError:
+            return host
+            
+    def queue_peer_frame(self, session, frame):
+        """把帧放入互联连接的发送队列，由互联线程攒批发送"""
+        with self.fed_lock:
+            session.outbox.append(frame)
+            
+    def federate(self, body, origin=None, seq=None, source=None):
+        """把互联消息发给其他服务器（不发回来源连接）: /fed <来源编号> <来源序号> <类型> <参数>"""
+        with self.fed_lock:
+            if origin is None:
+                # 本机产生的消息
+                self.fed_seq += 1
+                origin, seq = self.server_id, self.fed_seq
+            frame = f"/fed {origin} {seq} {body}"
+            for session in self.peer_sessions:
+                if session.peer_id and session is not source:
+                    session.outbox.append(frame)
                     
-                    # 转发给其他客户端
-                    for j in range(len(self.conn)):
-                        if i != j:  # 不转发给自己
-                            try:
-                                self.conn[j].send(data.encode("utf-8"))
-                            except:
-                                    pass
+    def mark_seen(self, origin, seq):
+        """记录处理过的互联消息，返回False表示已经处理过（经其他路径重复到达）"""
+        key = (origin, seq)
+        if key in self.fed_seen:
+            return False
+        self.fed_seen[key] = None
+        if len(self.fed_seen) > FED_SEEN_SIZE:
+            self.fed_seen.popitem(last=False)
+        return True
+        
+    def handle_federation(self, session, data, received):
+        """处理其他服务器发来的互联消息"""
+        parts = data.split(" ", 4)
+        if len(parts) < 4 or parts[0] != "/fed":
+            return
+        _, origin, seq, kind = parts[:4]
+        arg = parts[4] if len(parts) == 5 else ""
+        with self.fed_lock:
+            if origin == self.server_id or not self.mark_seen(origin, seq):
+                return
+        # 先转发给其他互联服务器，再在本机处理
+        self.federate(f"{kind} {arg}" if arg else kind, origin, seq, source=session)
+        if kind == "m":
+            # 聊天消息或公告，内容已是 "发送者: 正文" 的转义形式
+            if self.echo_messages:
+                self.log(f"💬 消息 [来自 {origin}]: {unescape_line(arg).strip()}")
+            self.relay(arg, received=received, room=origin)
+        elif kind == "load":
+            # 其他服务器的负载: load <ip> <端口> <已用名额> <最大连接数>
+            try:
+                ip, port, used, limit = arg.split()
+                self.peer_loads[origin] = (ip, int(port), int(used), int(limit), time.time())
+            except ValueError:
+                pass
+        elif kind in ("ban", "unban"):
+            print(f"[{self.get_timestamp()}] 🌐 服务器 {origin} 同步封禁操作: {kind} {arg}")
+            if kind == "ban":
+                self.ban_user(arg, propagate=False)
+            else:
+                self.unban_user(arg, propagate=False)
+        elif kind in ("banport", "unbanport"):
+            try:
+                ip, port = arg.split()
+                port = int(port)
+            except ValueError:
+                return
+            print(f"[{self.get_timestamp()}] 🌐 服务器 {origin} 同步封禁操作: {kind} {ip} {port}")
+            if kind == "banport":
+                self.ban_port(ip, port, propagate=False)
+            else:
+                self.unban_port(ip, port, propagate=False)
+                
+    def redirect_waiting(self, session):
+        """聊天室满员时把排队的客户端转到有空位的互联服务器，返回True表示已转走"""
+        now = time.time()
+        best = None
+        for ip, port, used, limit, updated in list(self.peer_loads.values()):
+            if now - updated > FED_LOAD_INTERVAL * 3 or used >= limit:
+                continue  # 负载信息过期或已满
+            if best is None or limit - used > best[2] - best[1]:
+                best = (ip, port, used, limit)
+        if best is None:
+            return False
+        ip, port, used, limit = best
+        self.send_to(session, f"/redirect {ip} {port}\n".encode("utf-8"))
+        # 先记上一个名额，避免在下次负载广播前把太多客户端转到同一台服务器
+        for peer_id, load in list(self.peer_loads.items()):
+            if load[:2] == (ip, port):
+                self.peer_loads[peer_id] = (ip, port, used + 1, limit, load[4])
+        self.log(f"↪️  排队连接 {session.address} 已转到 {ip}:{port}")
+        self.remove_session(session)
+        return True
+        
+    def federation_loop(self):
+        """服务器互联线程：攒批发送互联消息、广播负载、重连断开的互联"""
+        last_load = 0
+        last_retry = 0
+        last_filter_check = 0
+        while self.server_running:
+            self.profile_checkpoint()
+            time.sleep(FED_BATCH_INTERVAL)
+            now = time.time()
+            if self.bot_pending:
+                # 机器人的事件每个周期合并成一批
+                self.workers.submit_serial("bots", self.dispatch_bots)
+            if now - last_filter_check >= FILTER_CHECK_INTERVAL:
+                # 顺便检查敏感词表是否修改（修改后在后台线程重新编译）
+                last_filter_check = now
+                try:
+                    mtime = os.stat(FILTER_FILE).st_mtime
+                except OSError:
+                    mtime = None
+                if mtime != self.filter_mtime:
+                    self.workers.submit_serial("filter", self.load_filter)
+            if now - last_retry >= FED_RETRY_INTERVAL:
+                last_retry = now
+                self.connect_peers()
+            if now - last_load >= FED_LOAD_INTERVAL:
+                last_load = now
+                self.federate(f"load {self.ip} {self.port} {self.admitted_count()} {self.max_connections}")
+            for session in list(self.peer_sessions):
+                self.flush_peer(session)
                     
+    def flush_peer(self, session):
+        """把互联连接攒下的帧合并成一次发送，发不完的留到下次"""
+        with self.fed_lock:
+            frames, session.outbox = session.outbox, []
+        if frames:
+            session.unsent += ("\n".join(frames) + "\n").encode("utf-8")
+        if not session.unsent:
+            return
+        if len(session.unsent) > PEER_MAX_UNSENT:
+            # 对方服务器长时间不读取，断开互联（之后自动重连）
+            self.log(f"🐢 互联服务器 {session.peer_id} 积压 {format_size(len(session.unsent))}，已断开")
+            self.remove_session(session)
+            return
+        try:
+            sent = session.conn.send(session.unsent)
+            session.unsent = session.unsent[sent:]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.remove_session(session)
+            
+    def connect_peers(self):
+        """连接配置的互联服务器中尚未连上的（在后台线程中连接，不阻塞互联线程的攒批发送）"""
+        now = time.time()
+        for ip, port in list(self.peer_addresses):
+            address = (ip, port)
+            if address in self.peer_dialing or now < self.peer_retry.get(address, (0, 0))[0]:
+                continue
+            targets = (address, (self.peer_ips.get(ip, ip), port))
+            if any(session.address in targets for session in self.peer_sessions):
+                continue
+            self.peer_dialing.add(address)
+            self.workers.submit(self.dial_peer, address, done=lambda conn, error, address=address: self.peer_connected(address, conn))
+            
+    def dial_peer(self, address):
+        """连接一台互联服务器（后台线程），连不上时返回None"""
+        try:
+            conn = socket.create_connection(address, timeout=FED_CONNECT_TIMEOUT)
+            conn.setblocking(0)
+            self.set_nodelay(conn)
+        except OSError:
+            return None
+        return conn
+        
+    def peer_connected(self, address, conn):
+        """主动连接完成后（接收线程）发起握手；握手成功前每次重连的间隔加倍"""
+        self.peer_dialing.discard(address)
+        delay = min(self.peer_retry.get(address, (0, FED_RETRY_INTERVAL / 2))[1] * 2, FED_RETRY_MAX)
+        self.peer_retry[address] = (time.time() + delay, delay)
+        if conn is None:
+            return
+        if address not in self.peer_addresses or not self.server_running:
+            # 连接期间已被 unlink 或服务器正在关闭
+            conn.close()
+            return
+        session = Session(conn, address)
+        session.peer = True
+        session.outbox = []
+        self.set_socket_buffers(session)
+        session.peer_auth = os.urandom(16).hex()
+        session.unsent = f"/peer {self.server_id} {session.peer_auth} {self.port}\n".encode("utf-8")
+        self.peer_sessions.append(session)
+        self.add_session(session)
+        self.log(f"🌐 正在连接互联服务器 {address[0]}:{address[1]}")
+        
+    def capture(self, session, kind, data):
+        """录制开启时写入一条记录"""
+        if self.capture_file is None or session.peer:
+            return
+        if kind == CAPTURE_LINE and not session.username and bytes(data[:6]).startswith((b"/bot ", b"/peer ")):
+            data = b" ".join(bytes(data).split(b" ")[:2])  # 不录制机器人令牌和互联握手内容
+        with self.capture_lock:
+            if self.capture_file is None:
+                return
+            offset = int((time.perf_counter() - self.capture_start) * 1000000)
+            self.capture_file.write(CAPTURE_RECORD.pack(offset, session.id, kind, len(data)))
+            self.capture_file.write(data)
+            self.capture_records += 1
+            
+    def start_capture(self, path=None):
+        """开始录制客户端发来的流量"""
+        if self.capture_file is not None:
+            print(f"ℹ️  正在录制: {self.capture_path}")
+            return
+        path = path or self.diagnostics_path("capture", "tfcap")
+        try:
+            capture_file = open(path, "wb")
+            capture_file.write(CAPTURE_MAGIC)
+        except OSError as e:
+            print(f"❌ 无法创建录制文件: {e}")
+            return
+        with self.capture_lock:
+            self.capture_start = time.perf_counter()
+            self.capture_records = 0
+            self.capture_path = path
+            self.capture_file = capture_file
+        # 已经在线的连接也记一条新连接记录，重放时才能找到对应的会话
+        for session in list(self.sessions):
+            addr = session.address
+            self.capture(session, CAPTURE_OPEN, f"{addr[0]}:{addr[1]}".encode("utf-8"))
+            if session.username:
+                # 已注册的连接补记用户名
+                self.capture(session, CAPTURE_LINE, escape_line(session.username).encode("utf-8"))
+        print(f"✅ 开始录制流量: {path}")
+        
+    def stop_capture(self):
+        """停止录制并关闭文件"""
+        with self.capture_lock:
+            capture_file, self.capture_file = self.capture_file, None
+        if capture_file is None:
+            print("ℹ️  当前没有在录制")
+            return
+        capture_file.close()
+        print(f"✅ 录制已停止: {self.capture_path}（{self.capture_records} 条记录，{format_size(os.path.getsize(self.capture_path))}）")
+        
+    def profile_checkpoint(self):
+        """在服务线程的循环中调用：按 profile start/stop 开启或关闭本线程的分析器"""
+        if self.profiling:
+            name = threading.current_thread().name
+            if name not in self.active_profilers and name not in self.profile_skipped:
+                import cProfile
+                profiler = self.profilers.get(name) or cProfile.Profile()
+                try:
+                    profiler.enable()
+                except ValueError as e:
+                    # Python 3.12 起同一进程只能同时开启一个分析器，其余线程不分析，诊断出错不能影响服务线程
+                    self.profile_skipped.add(name)
+                    self.log(f"⚠️ 线程 {name} 无法开启性能分析: {e}")
+                    return
+                self.profilers[name] = profiler
+                self.active_profilers.add(name)
+        elif self.active_profilers:
+            name = threading.current_thread().name
+            if name in self.active_profilers:
+                self.profilers[name].disable()
+                self.active_profilers.discard(name)
+                
+    def diagnostics_path(self, kind, suffix):
+        """生成诊断输出文件的路径"""
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        return os.path.join(PROFILE_DIR, f"{kind}_{stamp}.{suffix}")
+        
+    def handle_profile_command(self, args):
+        """处理 profile start|stop|dump 命令"""
+        if args == "start":
+            if self.profiling:
+                print("ℹ️  性能分析已在进行中")
+                return
+            self.profilers.clear()
+            self.profile_skipped.clear()
+            self.profiling = True
+            print("✅ 已开始性能分析，稍后输入 'profile stop' 停止")
+        elif args == "stop":
+            if not self.profiling:
+                print("ℹ️  性能分析未开启")
+                return
+            self.profiling = False
+            # 等各线程在下一轮循环中关闭自己的分析器
+            deadline = time.time() + 2
+            while self.active_profilers and time.time() < deadline:
+                time.sleep(0.05)
+            print(f"✅ 已停止性能分析（{len(self.profilers)} 个线程），输入 'profile dump' 保存结果")
+        elif args == "dump":
+            if self.profiling or self.active_profilers:
+                print("❌ 错误: 请先输入 'profile stop' 停止分析")
+                return
+            if not self.profilers:
+                print("ℹ️  没有分析数据，请先 'profile start'")
+                return
+            import pstats
+            import io
+            stats = pstats.Stats(*self.profilers.values(), stream=io.StringIO())
+            path = self.diagnostics_path("profile", "prof")
+            stats.dump_stats(path)
+            # 完整报告写入文本文件，控制台只显示累计耗时最多的函数
+            with open(path[:-5] + ".txt", "w", encoding="utf-8") as f:
+                stats.stream = f
+                stats.sort_stats("cumulative").print_stats()
+            summary = io.StringIO()
+            stats.stream = summary
+            stats.sort_stats("cumulative").print_stats(15)
+            print(summary.getvalue())
+            print(f"✅ 分析结果已保存: {path}（可用 python -m pstats 查看）")
+        else:
+            print("❌ 错误: 用法 profile start|stop|dump")
+            
+    def handle_mem_command(self, args):
+        """处理 mem snapshot|diff|stop 命令"""
+        import tracemalloc
+        if args == "snapshot":
+            if not tracemalloc.is_tracing():
+                # 从现在开始跟踪，之前分配的内存不会被统计
+                tracemalloc.start(10)
+                print("ℹ️  已开始内存跟踪，只统计此后分配的内存")
+            self.mem_snapshot = tracemalloc.take_snapshot()
+            path = self.diagnostics_path("mem", "snapshot")
+            self.mem_snapshot.dump(path)
+            current, peak = tracemalloc.get_traced_memory()
+            print(f"📊 当前跟踪内存: {format_size(current)}，峰值: {format_size(peak)}")
+            for entry in self.mem_snapshot.statistics("lineno")[:10]:
+                print(f"  {entry}")
+            print(f"✅ 快照已保存: {path}")
+        elif args == "diff":
+            if self.mem_snapshot is None or not tracemalloc.is_tracing():
+                print("❌ 错误: 请先输入 'mem snapshot' 记录一次快照")
+                return
+            snapshot = tracemalloc.take_snapshot()
+            diff = snapshot.compare_to(self.mem_snapshot, "lineno")
+            path = self.diagnostics_path("mem_diff", "txt")
+            with open(path, "w", encoding="utf-8") as f:
+                for entry in diff:
+                    f.write(f"{entry}\n")
+            print("📊 与上一次快照相比增长最多的代码行:")
+            for entry in diff[:10]:
+                print(f"  {entry}")
+            self.mem_snapshot = snapshot
+            print(f"✅ 完整比较结果已保存: {path}")
+        elif args == "stop":
+            tracemalloc.stop()
+            self.mem_snapshot = None
+            print("✅ 已停止内存跟踪")
+        else:
+            print("❌ 错误: 用法 mem snapshot|diff|stop")
+            
+    def dump_threads(self):
+        """保存并显示所有线程当前的调用栈"""
+        import traceback
+        frames = sys._current_frames()
+        path = self.diagnostics_path("threads", "txt")
+        print(f"\n=== 线程 ({len(frames)}个) ===")
+        with open(path, "w", encoding="utf-8") as f:
+            for thread in threading.enumerate():
+                frame = frames.get(thread.ident)
+                if frame is None:
+                    continue
+                stack = traceback.extract_stack(frame)
+                f.write(f"--- {thread.name} (daemon={thread.daemon}) ---\n")
+                f.write("".join(traceback.format_list(stack)))
+                f.write("\n")
+                top = stack[-1]
+                print(f"  {thread.name}: {top.name} ({os.path.basename(top.filename)}:{top.lineno})")
+        print(f"✅ 完整调用栈已保存: {path}")
+        print("================\n")
+        
+    def show_peers(self):
+        """显示服务器互联状态"""
+        print("\n=== 服务器互联 ===")
+        print(f"本机编号: {self.server_id}")
+        print(f"配置的互联地址: {', '.join(f'{ip}:{port}' for ip, port in self.peer_addresses) or '无'}")
+        print(f"互联口令: {'已设置' if self.peer_secret else '未设置（不接受互联）'}")
+        links = [session for session in self.sessions if session.peer]
+        if not links:
+            print("当前没有互联连接")
+        for session in links:
+            addr = session.address
+            load = self.peer_loads.get(session.peer_id)
+            load_text = f"{load[2]}/{load[3]}" if load else "未知"
+            print(f"  {session.peer_id or '(握手中)'} - {addr[0]}:{addr[1]} 负载: {load_text} 待发送: {len(session.unsent)} 字节")
+        print("=================\n")
+        
+    def handle_link_command(self, args, add):
+        """处理 link/unlink 命令: link <ip>:<端口>"""
+        ip, _, port = args.rpartition(":")
+        try:
+            address = (ip, int(port))
+        except ValueError:
+            print("❌ 错误: 请使用 <ip>:<端口> 格式")
+            return
+        if add:
+            if not self.peer_secret:
+                print("❌ 错误: 互联需要口令，请用 --peer-secret 口令 重新启动服务器")
+                return
+            if address not in self.peer_addresses:
+                self.peer_addresses.append(address)
+                self.peer_ips[ip] = self.resolve_host(ip)
+            self.peer_retry.pop(address, None)  # 立即尝试连接
+            print(f"✅ 已添加互联服务器 {ip}:{port}，稍后自动连接（对方也要添加本机地址，并使用相同的口令）")
+        else:
+            targets = (address, (self.peer_ips.get(ip, ip), address[1]))
+            if address in self.peer_addresses:
+                self.peer_addresses.remove(address)
+                self.peer_ips = {peer_ip: self.resolve_host(peer_ip) for peer_ip, _ in self.peer_addresses}
+            self.peer_retry.pop(address, None)
+            for session in list(self.sessions):
+                if session.peer and session.address in targets:
+                    self.remove_session(session)
+            print(f"✅ 已断开互联服务器 {ip}:{port}")
+        
+    def record_ack(self, session, seq, client_ms):
+        """记录客户端的延迟追踪回执"""
+        try:
+            seq, client_ms = int(seq), int(client_ms)
+        except ValueError:
+            return
+        arrived = now_ms()
+        with self.relay_lock:
+            oldest = self.seq - len(self.history) + 1
+            if not oldest <= seq <= self.seq:
+                return
+            sent = self.history[seq - oldest][0]
+        if session.one_way is None:
+            session.one_way = collections.deque(maxlen=TRACE_SAMPLES)
+            session.round_trip = collections.deque(maxlen=TRACE_SAMPLES)
+        session.one_way.append(client_ms - sent)
+        session.round_trip.append(arrived - sent)
+        
+    def set_trace(self, enabled):
+        """开启或关闭延迟追踪，通知所有客户端是否需要回执"""
+        self.trace_enabled = enabled
+        command = f"/trace {'on' if enabled else 'off'}\n".encode("utf-8")
+        for session in list(self.sessions):
+            if session.username:
+                self.send_to(session, command)
+        print(f"✅ 延迟追踪已{'开启' if enabled else '关闭'}")
+        
+    def show_trace(self):
+        """显示每个客户端的延迟分布"""
+        print("\n=== 延迟追踪 ===")
+        print(f"状态: {'已开启' if self.trace_enabled else '未开启（使用 trace on 开启）'}")
+        print(f"服务器处理: {latency_summary(list(self.server_delays))}")
+        for session in list(self.sessions):
+            if not session.username:
+                continue
+            addr = session.address
+            one_way = list(session.one_way or ())
+            round_trip = list(session.round_trip or ())
+            print(f"\n  {session.username} ({addr[0]}:{addr[1]})")
+            print(f"    往返: {latency_summary(round_trip)}")
+            print(f"    单向: {latency_summary(one_way)}")
+            if one_way and round_trip:
+                # 单向延迟包含客户端与服务器的时钟偏差，用往返时间的一半估算
+                offset = sorted(o - r / 2 for o, r in zip(one_way, round_trip))[len(one_way) // 2]
+                print(f"    时钟偏差估计: {offset:+.0f} ms")
+        print("================\n")
+        
+    def handle_file_put(self, session, tag, size, name):
+        """检查配额并为上传分配文件编号"""
+        def reject(reason):
+            self.send_to(session, f"/file reject {tag} {escape_line(reason)}\n".encode("utf-8"))
+            
+        owner = session.username
+        try:
+            size = int(size)
+        except ValueError:
+            return reject("文件大小无效")
+        if not owner:
+            return reject("请先注册用户名")
+        if size < 0 or size > MAX_FILE_SIZE:
+            return reject(f"文件不能超过 {format_size(MAX_FILE_SIZE)}")
+        
+        with self.files_lock:
+            # 超时未开始上传的名额作废
+            now = time.time()
+            for file_id, info in list(self.files.items()):
+                if info["state"] == "pending" and now - info["created"] > UPLOAD_START_TIMEOUT:
+                    del self.files[file_id]
+            
+            room_total = sum(info["size"] for info in self.files.values())
+            user_total = sum(info["size"] for info in self.files.values() if info["owner"] == owner)
+            if user_total + size > MAX_USER_STORAGE:
+                return reject(f"您上传的文件总量不能超过 {format_size(MAX_USER_STORAGE)}")
+            if room_total + size > MAX_ROOM_STORAGE:
+                return reject("聊天室的文件存储空间已满")
+            
+            file_id = os.urandom(8).hex()
+            self.files[file_id] = {
+                "name": name,
+                "size": size,
+                "owner": owner,
+                "path": os.path.join(FILE_SPOOL_DIR, file_id),
+                "state": "pending",
+                "created": now,
+            }
+        self.send_to(session, f"/file accept {tag} {file_id}\n".encode("utf-8"))
+        
+    def start_transfer(self, session, command, initial_data):
+        """把连接从聊天会话中移出，交给文件传输线程"""
+        conn = session.conn
+        self.detach_session(session)
+        self.capture(session, CAPTURE_CLOSE, b"")
+        self.release_buffer(session)
+        if session.waiting:
+            # 排队中的客户端也可以传输文件（传输连接不占聊天室名额）
+            session.waiting = False
+            self.waiting.remove(session)
+        
+        if not self.transfer_slots.acquire(blocking=False):
+            try:
+                conn.send("ERR 服务器繁忙，请稍后再试\n".encode("utf-8"))
+                conn.close()
+            except OSError:
+                pass
+            return
+        
+        args = command.split()
+        if args[1] == "upload":
+            target = self.receive_upload
+        else:
+            target = self.send_download
+        threading.Thread(target=target, args=(conn, args[2], initial_data), name=f"{args[1]}-{args[2]}", daemon=True).start()
+        
+    def receive_upload(self, conn, file_id, initial_data):
+        """文件上传线程：分块写入暂存目录，内存占用固定"""
+        info = None
+        try:
+            with self.files_lock:
+                info = self.files.get(file_id)
+                if info is None or info["state"] != "pending":
+                    info = None
+                else:
+                    info["state"] = "uploading"
+            if info is None:
+                conn.send("ERR 上传编号无效\n".encode("utf-8"))
+                return
+            
+            conn.setblocking(True)
+            conn.settimeout(TRANSFER_TIMEOUT)
+            os.makedirs(FILE_SPOOL_DIR, exist_ok=True)
+            size = info["size"]
+            with open(info["path"], "wb") as f:
+                f.write(initial_data[:size])
+                received = min(len(initial_data), size)
+                buffer = bytearray(TRANSFER_CHUNK)
+                view = memoryview(buffer)
+                while received < size:
+                    n = conn.recv_into(view[:min(TRANSFER_CHUNK, size - received)])
+                    if n == 0:
+                        raise ConnectionError("上传中断")
+                    f.write(view[:n])
+                    received += n
+            
+            info["state"] = "done"
+            conn.sendall(b"OK\n")
+            self.log(f"📎 {info['owner']} 上传了文件 {info['name']} ({format_size(size)})")
+            # 文件消息是控制帧，聊天内容总以"用户名: "开头，客户端只把这种帧显示为下载链接
+            self.relay(escape_line(f"/file offer {file_id} {size} {info['owner']}:{info['name']}"))
+        except (OSError, ConnectionError) as e:
+            print(f"❌ [ERROR] 文件上传失败: {e}")
+            if info is not None:
+                with self.files_lock:
+                    self.files.pop(file_id, None)
+                try:
+                    os.remove(info["path"])
+                except OSError:
+                    pass
+        finally:
+            try:
+                conn.close()
+            except OSError:
+                pass
+            self.transfer_slots.release()
+            
+    def send_download(self, conn, file_id, initial_data):
+        """文件下载线程：用sendfile把暂存文件直接发给客户端"""
+        try:
+            with self.files_lock:
+                info = self.files.get(file_id)
+            conn.setblocking(True)
+            conn.settimeout(TRANSFER_TIMEOUT)
+            if info is None or info["state"] != "done":
+                conn.sendall("ERR 文件不存在或已被删除\n".encode("utf-8"))
+                return
+            with open(info["path"], "rb") as f:
+                conn.sendall(f"OK {info['size']} {escape_line(info['name'])}\n".encode("utf-8"))
+                conn.sendfile(f)
+        except OSError as e:
+            print(f"❌ [ERROR] 文件下载失败: {e}")
+        finally:
+            try:
+                conn.close()
+            except OSError:
+                pass
+            self.transfer_slots.release()
+            
+    def clear_file_spool(self):
+        """删除暂存目录中的文件"""
+        if not os.path.isdir(FILE_SPOOL_DIR):
+            return
+        for name in os.listdir(FILE_SPOOL_DIR):
+            try:
+                os.remove(os.path.join(FILE_SPOOL_DIR, name))
+            except OSError:
+                pass
+            
+    def list_files(self):
+        """显示已上传的文件"""
+        print("\n=== 文件列表 ===")
+        with self.files_lock:
+            files = [(file_id, info) for file_id, info in self.files.items() if info["state"] == "done"]
+            total = sum(info["size"] for info in self.files.values())
+        if not files:
+            print("当前没有已上传的文件")
+        for file_id, info in files:
+            print(f"  #{file_id} {info['name']} ({format_size(info['size'])}) - 上传者: {info['owner']}")
+        print(f"\n存储占用: {format_size(total)} / {format_size(MAX_ROOM_STORAGE)}")
+        print("================\n")
+        
     def handle_commands(self):
         """处理控制台命令"""
         while self.server_running:
             try:
-                cmd = input().strip().lower()
+                raw_cmd = input().strip()
+                cmd = raw_cmd.lower()
                 
                 if cmd == "help":
                     self.show_help()
@@ -251,6 +2902,52 @@ class TFServer:
                     self.clear_banned()
                 elif cmd == "status":
                     self.show_status()
+                elif cmd == "mcast":
+                    self.show_multicast()
+                elif cmd == "files":
+                    self.list_files()
+                elif cmd == "peers":
+                    self.show_peers()
+                elif cmd.startswith("profile "):
+                    self.handle_profile_command(cmd[8:].strip())
+                elif cmd.startswith("mem "):
+                    self.handle_mem_command(cmd[4:].strip())
+                elif cmd.startswith("search "):
+                    self.show_search(raw_cmd[7:].strip())
+                elif cmd in ("echo on", "echo off"):
+                    self.echo_messages = cmd == "echo on"
+                    print(f"✅ 已{'开启' if self.echo_messages else '关闭'}聊天消息显示")
+                elif cmd == "sockbuf" or cmd.startswith("sockbuf "):
+                    self.handle_sockbuf_command(cmd[7:].strip())
+                elif cmd == "transport" or cmd.startswith("transport "):
+                    self.handle_transport_command(cmd[9:].strip())
+                elif cmd == "bots":
+                    self.show_bots()
+                elif cmd == "filter":
+                    self.show_filter()
+                elif cmd == "filter reload":
+                    self.workers.submit_serial("filter", self.load_filter)
+                    print("✅ 正在重新加载敏感词表")
+                elif cmd == "threads":
+                    self.dump_threads()
+                elif cmd == "capture start" or cmd.startswith("capture start "):
+                    # 文件名保留原始大小写
+                    self.start_capture(raw_cmd[14:].strip() or None)
+                elif cmd == "capture stop":
+                    self.stop_capture()
+                elif cmd.startswith("link "):
+                    self.handle_link_command(cmd[5:].strip(), True)
+                elif cmd.startswith("unlink "):
+                    self.handle_link_command(cmd[7:].strip(), False)
+                elif cmd == "trace":
+                    self.show_trace()
+                elif cmd in ("trace on", "trace off"):
+                    self.set_trace(cmd == "trace on")
+                elif cmd == "trace reset":
+                    self.server_delays.clear()
+                    for session in list(self.sessions):
+                        session.one_way = session.round_trip = None
+                    print("✅ 已清除延迟追踪数据")
                 elif cmd == "exit" or cmd == "quit":
                     print("🛑 正在停止服务器...")
                     self.stop()
@@ -258,6 +2955,9 @@ class TFServer:
                 elif cmd.startswith("maxconn "):
                     args = cmd[8:].strip()
                     self.handle_maxconn_command(args)
+                elif cmd.startswith("ipcap "):
+                    args = cmd[6:].strip()
+                    self.handle_ipcap_command(args)
                 elif cmd == "":
                     continue
                 else:
@@ -277,9 +2977,33 @@ class TFServer:
         print("  help     - 显示此帮助信息")
         print("  list     - 显示所有连接")
         print("  status   - 显示服务器状态")
+        print("  mcast    - 显示组播分发状态")
+        print("  files    - 显示已上传的文件")
+        print("  peers    - 显示服务器互联状态")
+        print("  link <ip>:<port>   - 与另一台服务器互联（断开后自动重连）")
+        print("  unlink <ip>:<port> - 断开与另一台服务器的互联")
+        print("  trace    - 显示各客户端的延迟分布")
+        print("  trace on/off - 开启/关闭延迟追踪（客户端回执收到时间）")
+        print("  trace reset  - 清除延迟追踪数据")
+        print("  echo on/off  - 显示/不显示聊天消息（人多时关闭可减轻服务器负担）")
+        print("  bots     - 显示已连接的机器人和订阅条件")
+        print(f"  filter       - 显示内容过滤统计（词表 {FILTER_FILE} 修改后自动重新加载）")
+        print("  filter reload - 立即重新加载敏感词表")
         print("  exit/quit - 停止服务器")
+        print("\n性能诊断（结果写入 tf_profile 目录，不影响在线的连接）:")
+        print("  profile start    - 开始分析各服务线程的函数耗时（cProfile）")
+        print("  profile stop     - 停止分析")
+        print("  profile dump     - 保存分析结果并显示最耗时的函数")
+        print("  mem snapshot     - 记录一次内存快照（tracemalloc）")
+        print("  mem diff         - 与上一次快照比较，显示内存增长最多的代码行")
+        print("  mem stop         - 停止内存跟踪")
+        print("  threads          - 保存并显示所有线程当前的调用栈")
+        print("  capture start [文件] - 开始录制客户端发来的流量（用 tf_replay.py 重放）")
+        print("  capture stop     - 停止录制")
         print("\n消息命令:")
         print("  msg <text> - 发送服务器消息给所有客户端")
+        print("  search <关键词> [from:用户名] [after:时间] [before:时间] [page:页码] - 搜索聊天记录")
+        print("           时间可以是 30m/2h/3d（多久以前）、08:00（今天）、2025-09-01 或 2025-09-01T08:00")
         print("\n封禁管理:")
         print("  ban <ip>         - 封禁指定IP的所有连接")
         print("  ban <ip> <port>  - 封禁指定IP的指定端口")
@@ -288,9 +3012,16 @@ class TFServer:
         print("  banned           - 显示被封禁的IP和端口列表")
         print("  clear            - 清除所有封禁记录")
         print("\n连接数控制:")
-        print("  maxconn <number> - 设置最大连接数")
+        print(f"  maxconn <number> - 设置最大连接数（最多 {self.connection_limit}）")
         print("  maxconn show     - 显示当前最大连接数")
         print("  maxconn reset    - 重置为初始最大连接数")
+        print("  ipcap <number>   - 设置每个IP的最大连接数（0表示不限制）")
+        print("  ipcap show       - 显示当前每IP连接上限")
+        print("  sockbuf          - 显示各类连接的内核收发缓冲区大小")
+        print("  sockbuf <client|local|bot|peer> <接收> <发送> - 设置内核收发缓冲区（字节，0为系统默认）")
+        print("  transport        - 显示传输模式和合并效果（transport reset 清零统计）")
+        print("  transport <latency|throughput[:毫秒]> - 设置服务器默认传输模式")
+        print("  transport <聊天室> <latency|throughput[:毫秒]|default> - 单独设置本服务器(local)或某台互联服务器的消息")
         print("\n示例:")
         print("  ban 192.168.1.100")
         print("  ban 192.168.1.100 8080")
@@ -300,18 +3031,21 @@ class TFServer:
     def list_connections(self):
         """显示所有连接"""
         print("\n=== 当前连接列表 ===")
-        if not self.address:
+        if not self.sessions:
             print("当前没有活跃连接")
         else:
-            print(f"总连接数: {len(self.address)}")
-            for i, addr in enumerate(self.address):
-                username = self.usernames[i] if i < len(self.usernames) else "未注册"
-                print(f"  {i+1}. {addr[0]}:{addr[1]} - 用户: {username}")
+            print(f"总连接数: {len(self.sessions)}")
+            for i, session in enumerate(list(self.sessions)):
+                addr = session.address
+                state = " (排队中)" if session.waiting else " (服务器互联)" if session.peer else ""
+                if session.out_bytes > SLOW_WARN_BYTES or session.skipped:
+                    state += f" 🐢 慢速: 积压 {format_size(session.out_bytes)}, 发送速度 {format_size(session.drain_rate)}/s, 已跳过 {session.skipped} 条"
+                print(f"  {i+1}. {addr[0]}:{addr[1]} - 用户: {session.username or '未注册'}{state}")
         print("===================\n")
         
 
         
-    def ban_user(self, ip):
+    def ban_user(self, ip, propagate=True):
         """封禁用户IP"""
         if not ip:
             print("❌ 错误: 请指定要封禁的IP地址")
@@ -319,26 +3053,29 @@ class TFServer:
             
         if ip not in self.banned_ips:
             self.banned_ips.append(ip)
-            self.save_banned_ips()
+            self.save_banned_data()
             print(f"✅ 已成功封禁IP: {ip}")
+            if propagate:
+                self.federate(f"ban {ip}")
             
             # 断开该IP的所有连接
             disconnected_count = 0
-            for i, addr in enumerate(self.address):
-                if addr[0] == ip:
+            for session in list(self.sessions):
+                if session.address[0] == ip and not session.peer:
                     try:
-                        self.conn[i].send("您已被服务器封禁".encode("utf-8"))
-                        self.conn[i].close()
-                        disconnected_count += 1
+                        session.conn.send("您已被服务器封禁\n".encode("utf-8"))
                     except:
                         pass
+                    # 同时移出 selector 和会话列表，否则复用这个文件描述符的新连接无法注册
+                    self.remove_session(session)
+                    disconnected_count += 1
             
             if disconnected_count > 0:
                 print(f"🔌 已断开 {disconnected_count} 个来自该IP的连接")
         else:
             print(f"ℹ️  IP {ip} 已被封禁")
             
-    def unban_user(self, ip):
+    def unban_user(self, ip, propagate=True):
         """解封用户IP"""
         if not ip:
             print("❌ 错误: 请指定要解封的IP地址")
@@ -346,8 +3083,10 @@ class TFServer:
             
         if ip in self.banned_ips:
             self.banned_ips.remove(ip)
-            self.save_banned_ips()
+            self.save_banned_data()
             print(f"✅ 已成功解封IP: {ip}")
+            if propagate:
+                self.federate(f"unban {ip}")
         else:
             print(f"ℹ️  IP {ip} 未被封禁")
             
@@ -387,19 +3126,13 @@ class TFServer:
             print("❌ 错误: 消息内容不能为空")
             return
             
-        full_msg = f"server: {message}\n"
-        
         # 显示在控制台
         print(f"[{self.get_timestamp()}] 📢 服务器广播: {message}")
         
         # 发送给所有客户端
-        sent_count = 0
-        for conn in self.conn:
-            try:
-                conn.send(full_msg.encode("utf-8"))
-                sent_count += 1
-            except:
-                pass
+        sent_count = self.relay(f"server: {escape_line(message)}")
+        # 公告同时发到互联的其他服务器
+        self.federate(f"m server: {escape_line(message)}")
         
         if sent_count > 0:
             print(f"✅ 消息已发送给 {sent_count} 个客户端")
@@ -420,15 +3153,16 @@ class TFServer:
                 new_max = int(args)
                 if new_max < 1:
                     print("❌ 错误: 最大连接数必须大于0")
-                elif new_max > 1000:
-                    print("❌ 错误: 最大连接数不能超过1000")
+                elif new_max > self.connection_limit:
+                    hint = "" if self.high_scale else "（启动时加 --high-scale 可以设置更大的值）"
+                    print(f"❌ 错误: 最大连接数不能超过{self.connection_limit}{hint}")
                 else:
                     old_value = self.max_connections
                     self.max_connections = new_max
                     print(f"✅ 最大连接数已从 {old_value} 更改为 {new_max}")
                     
                     # 如果当前连接数超过新的最大连接数，需要断开超出的连接
-                    current_connections = len(self.conn)
+                    current_connections = self.admitted_count()
                     if current_connections > new_max:
                         excess = current_connections - new_max
                         print(f"⚠️  当前连接数({current_connections})超过新限制({new_max})，将断开{excess}个连接")
@@ -437,37 +3171,114 @@ class TFServer:
             except ValueError:
                 print("❌ 错误: 请输入有效的数字或'show'/'reset'")
 
+    def handle_sockbuf_command(self, args):
+        """设置各类连接的内核收发缓冲区: sockbuf <client|local|bot|peer> <接收字节> <发送字节>，立即应用到已有的连接"""
+        parts = args.split()
+        if not parts or parts == ["show"]:
+            print("📊 内核缓冲区（接收 / 发送，0 表示系统默认）:")
+            for kind, (rcvbuf, sndbuf) in self.socket_buffers.items():
+                count = sum(1 for session in self.sessions if self.session_class(session) == kind)
+                print(f"  {kind:<7}{rcvbuf or '默认'} / {sndbuf or '默认'}  ({count} 个连接)")
+            return
+        try:
+            kind, rcvbuf, sndbuf = parts[0], int(parts[1]), int(parts[2])
+        except (IndexError, ValueError):
+            print("❌ 用法: sockbuf <client|local|bot|peer> <接收字节> <发送字节>")
+            return
+        if kind not in self.socket_buffers or rcvbuf < 0 or sndbuf < 0:
+            print("❌ 连接类型必须是 client、local、bot 或 peer，大小不能小于0")
+            return
+        self.socket_buffers[kind] = (rcvbuf, sndbuf)
+        sessions = [session for session in list(self.sessions) if self.session_class(session) == kind]
+        for session in sessions:
+            self.set_socket_buffers(session)
+        # 改回0（系统默认）只影响之后的新连接
+        print(f"✅ {kind} 连接的内核缓冲区已设置为 {rcvbuf or '默认'} / {sndbuf or '默认'}，已应用到 {len(sessions)} 个连接")
+        
+    def handle_transport_command(self, args):
+        """设置传输模式: transport [聊天室] <latency|throughput[:毫秒]|default>，聊天室为 local 或互联服务器编号"""
+        parts = args.split()
+        if not parts or parts == ["show"]:
+            self.show_transport()
+            return
+        if parts == ["reset"]:
+            for stats in self.transport_stats.values():
+                stats.clear()
+            print("✅ 传输统计已清零")
+            return
+        room = parts[0] if len(parts) == 2 else None
+        if len(parts) > 2 or (room is None and parts[0] == "default"):
+            print("❌ 用法: transport [聊天室] <latency|throughput[:毫秒]|default>")
+            return
+        if room is not None and parts[1] == "default":
+            self.room_transport.pop(room, None)
+            print(f"✅ 聊天室 {room} 改为使用服务器默认传输模式: {format_transport(self.transport)}")
+            return
+        try:
+            transport = parse_transport(parts[-1])
+        except ValueError as e:
+            print(f"❌ {e}")
+            return
+        if room is None:
+            self.transport = transport
+            print(f"✅ 服务器默认传输模式已设置为 {format_transport(transport)}")
+        else:
+            self.room_transport[room] = transport
+            print(f"✅ 聊天室 {room} 的传输模式已设置为 {format_transport(transport)}")
+        
+    def show_transport(self):
+        """显示传输模式和各模式的效果统计"""
+        print("\n=== 传输模式 ===")
+        print(f"服务器默认: {format_transport(self.transport)}")
+        for room, transport in self.room_transport.items():
+            print(f"  聊天室 {room}: {format_transport(transport)}")
+        print("TCP_NODELAY: 所有TCP连接均已开启")
+        for profile in TRANSPORT_PROFILES:
+            stats = self.transport_stats[profile]
+            line = f"{profile}: 写入 {stats['writes']} 次，共 {stats['frames']} 帧"
+            if stats["writes"]:
+                line += f"，平均每次写入 {stats['frames'] / stats['writes']:.2f} 帧"
+            if profile == "throughput" and stats["batches"]:
+                line += f"；合并 {stats['batches']} 批，平均等待 {stats['held'] / stats['batches'] * 1000:.2f} ms"
+            print(line)
+        print("===================\n")
+        
+    def handle_ipcap_command(self, args):
+        """处理每IP连接上限命令"""
+        if args == "show":
+            print(f"📊 每IP连接上限: {self.max_per_ip or '不限制'}")
+            return
+        try:
+            new_cap = int(args)
+        except ValueError:
+            print("❌ 错误: 请输入有效的数字或'show'")
+            return
+        if new_cap < 0:
+            print("❌ 错误: 每IP连接上限不能小于0")
+            return
+        self.max_per_ip = new_cap
+        # 已有的连接不受影响，只限制之后的新连接
+        print(f"✅ 每IP连接上限已设置为 {new_cap or '不限制'}")
+        
     def disconnect_excess_connections(self, excess_count):
         """断开超出的连接"""
         disconnected = 0
         # 从最新的连接开始断开（后进先出）
-        for i in range(len(self.conn) - 1, -1, -1):
+        for session in reversed(list(self.sessions)):
             if disconnected >= excess_count:
                 break
+            if session.waiting or session.peer:
+                continue
                 
             try:
-                addr = self.address[i]
-                username = self.usernames[i]
-                self.conn[i].send("服务器已调整最大连接数，您的连接已被断开".encode("utf-8"))
-                self.conn[i].close()
-                print(f"🔌 已断开连接: {addr[0]}:{addr[1]} (用户: {username})")
-                disconnected += 1
-                
-                # 从列表中移除
-                self.conn.pop(i)
-                self.address.pop(i)
-                self.usernames.pop(i)
-                
+                addr = session.address
+                session.conn.send("服务器已调整最大连接数，您的连接已被断开\n".encode("utf-8"))
+                print(f"🔌 已断开连接: {addr[0]}:{addr[1]} (用户: {session.username})")
             except Exception as e:
                 print(f"❌ 断开连接时出错: {e}")
-                # 即使出错也移除
-                if i < len(self.conn):
-                    self.conn.pop(i)
-                if i < len(self.address):
-                    self.address.pop(i)
-                if i < len(self.usernames):
-                    self.usernames.pop(i)
-                disconnected += 1
+            # 即使出错也移除
+            self.remove_session(session)
+            disconnected += 1
         
         print(f"✅ 已成功断开 {disconnected} 个连接")
     
@@ -477,13 +3288,48 @@ class TFServer:
         print(f"\n服务器状态: {'🟢 运行中' if self.server_running else '🔴 已停止'}")
         print(f"监听地址: {self.ip}:{self.port}")
         print(f"最大连接数: {self.max_connections}")
-        print(f"当前连接数: {len(self.conn)}")
-        print(f"已注册用户: {len([name for name in self.usernames if name])}")
+        print(f"当前连接数: {self.admitted_count()}")
+        print(f"排队连接数: {len(self.waiting)} / {self.waiting_room_size}")
+        print(f"每IP连接上限: {self.max_per_ip or '不限制'}")
+        print(f"已注册用户: {len([session for session in self.sessions if session.username])}")
         print(f"完全封禁IP: {len(self.banned_ips)}")
         print(f"端口封禁数: {sum(len(ports) for ports in self.banned_ports.values())}")
+        print(f"慢速客户端: {sum(1 for session in self.sessions if session.out_bytes > SLOW_WARN_BYTES)} (已断开 {self.slow_evictions})")
+        print(f"消息序号: {self.seq}")
+        print(f"互联服务器: {sum(1 for session in self.sessions if session.peer and session.peer_id)}")
+        print(f"组播分发: {'已启用' if self.multicast_socket is not None else '未启用'}")
+        print(f"后台任务: {self.workers.summary()}")
+        print(f"搜索索引: {len(self.search_index)} 条消息，{len(self.search_index.postings)} 个索引词")
+        print(f"机器人: {len(self.bots)}")
+        stats = self.transport_stats
+        writes = stats["latency"]["writes"] + stats["throughput"]["writes"]
+        frames = stats["latency"]["frames"] + stats["throughput"]["frames"]
+        rooms = f"，{len(self.room_transport)} 个聊天室单独设置" if self.room_transport else ""
+        print(f"传输模式: {format_transport(self.transport)}{rooms}，平均每次写入 {frames / writes if writes else 0:.2f} 帧")
+        if self.content_filter is not None:
+            print(f"内容过滤: {len(self.content_filter)} 个词，已检查 {self.filter_checked} 条，"
+                  f"拦截 {self.filter_actions['block']} / 打码 {self.filter_actions['mask']} / 标记 {self.filter_actions['flag']}")
+        else:
+            print("内容过滤: 未启用")
+        mailboxes = sum(1 for name in os.listdir(MAILBOX_DIR) if name != MAILBOX_USERS_FILE) if os.path.isdir(MAILBOX_DIR) else 0
+        print(f"离线信箱: {mailboxes} 个用户有未读消息，已保存 {self.mail_stored} 条，"
+              f"已送达 {self.mail_delivered} 条，超出配额 {self.mail_dropped} 条")
         print(f"\n服务器运行时间: {self.get_uptime()}")
         print("==========================\n")
         
+    def show_multicast(self):
+        """显示组播分发状态"""
+        print("\n=== 组播分发状态 ===")
+        if self.multicast_socket is None:
+            print("组播分发未启用（启动时使用 --multicast <组播地址>:<端口> 开启）")
+        else:
+            print(f"组播地址: {self.multicast_group[0]}:{self.multicast_group[1]}")
+            print(f"组播客户端: {len([session for session in self.sessions if session.multicast])} / {len(self.sessions)}")
+            print(f"已组播消息: {self.multicast_sent}")
+            print(f"补发消息数: {self.nack_repairs}")
+            print(f"历史记录: {len(self.history)} 条 (最新序号 {self.seq})")
+        print("===================\n")
+        
     def get_uptime(self):
         """获取服务器运行时间"""
         if hasattr(self, 'start_time'):
@@ -499,6 +3345,7 @@ class TFServer:
         """加载封禁的IP和端口数据"""
         try:
             if os.path.exists("banned_data.json"):
+                import json
                 with open("banned_data.json", "r") as f:
                     data = json.load(f)
                     self.banned_ips = data.get("banned_ips", [])
@@ -508,18 +3355,23 @@ class TFServer:
             self.banned_ports = {}
             
     def save_banned_data(self):
-        """保存封禁的IP和端口数据"""
+        """保存封禁的IP和端口数据（交给后台线程写入，连续多次修改合并为一次写入）"""
+        self.workers.submit_serial("banned_data", self.write_banned_data)
+        
+    def write_banned_data(self):
+        """把当前的封禁数据写入文件（后台线程）"""
         try:
+            import json
             data = {
-                "banned_ips": self.banned_ips,
-                "banned_ports": self.banned_ports
+                "banned_ips": list(self.banned_ips),
+                "banned_ports": {ip: list(ports) for ip, ports in dict(self.banned_ports).items()}
             }
             with open("banned_data.json", "w") as f:
                 json.dump(data, f)
         except Exception as e:
             print(f"❌ 保存封禁数据失败: {e}")
             
-    def ban_port(self, ip, port):
+    def ban_port(self, ip, port, propagate=True):
         """封禁指定ip的指定端口"""
         if not ip:
             print("❌ 错误: 请指定要封禁的ip地址")
@@ -532,24 +3384,27 @@ class TFServer:
             self.banned_ports[ip].append(port)
             self.save_banned_data()
             print(f"✅ 已成功封禁 {ip}:{port}")
+            if propagate:
+                self.federate(f"banport {ip} {port}")
             
             # 断开该ip和端口的所有连接
             disconnected_count = 0
-            for i, addr in enumerate(self.address):
-                if addr[0] == ip and addr[1] == port:
+            for session in list(self.sessions):
+                if session.address[0] == ip and session.address[1] == port and not session.peer:
                     try:
-                        self.conn[i].send("您已被服务器封禁".encode("utf-8"))
-                        self.conn[i].close()
-                        disconnected_count += 1
+                        session.conn.send("您已被服务器封禁\n".encode("utf-8"))
                     except:
                         pass
+                    # 同时移出 selector 和会话列表，否则复用这个文件描述符的新连接无法注册
+                    self.remove_session(session)
+                    disconnected_count += 1
             
             if disconnected_count > 0:
                 print(f"🔌 已断开 {disconnected_count} 个来自该IP:端口的连接")
         else:
             print(f"ℹ️  {ip}:{port} 已被封禁")
             
-    def unban_port(self, ip, port):
+    def unban_port(self, ip, port, propagate=True):
         """解封指定ip的指定端口"""
         if not ip:
             print("❌ 错误: 请指定要解封的ip地址")
@@ -562,6 +3417,8 @@ class TFServer:
                 del self.banned_ports[ip]
             self.save_banned_data()
             print(f"✅ 已成功解封 {ip}:{port}")
+            if propagate:
+                self.federate(f"unbanport {ip} {port}")
         else:
             print(f"ℹ️  {ip}:{port} 未被封禁")
             
@@ -575,17 +3432,30 @@ def print_usage():
     print("TouchFish服务器 - TFserver")
     print("=" * 40)
     print("用法:")
-    print("  TFserver.exe [IP] [端口] [最大连接数]")
+    print("  TFserver.exe [IP] [端口] [最大连接数] [--startup-profile] [--multicast 组播地址:端口] [--peer IP:端口 ... --peer-secret 口令] [--capture 文件] [--unix 路径] [--sockbuf 类型=接收,发送] [--high-scale] [--backlog 长度] [--transport [聊天室=]模式] [--ipcap 数量]")
     print("")
     print("参数说明:")
     print("  IP            - 服务器IP地址 (默认: 127.0.0.1)")
     print("  端口          - 监听端口 (默认: 8080)")
-    print("  最大连接数    - 最大客户端连接数 (默认: 10)")
+    print("  最大连接数    - 最大客户端连接数 (默认: 10，最多 100；大规模模式最多 20000)")
+    print("  --startup-profile - 启动后输出导入和启动各阶段的耗时")
+    print("  --multicast   - 通过UDP组播分发消息，如 239.255.80.80:8081（仅限同一局域网）")
+    print("  --peer        - 与另一台服务器互联，如 192.168.2.100:8080（可以写多个，对方也要写上本机地址）")
+    print("  --peer-secret - 互联口令，互联的各台服务器必须相同，只接受口令一致的互联服务器")
+    print("  --capture     - 把客户端发来的流量录制到文件，可用 tf_replay.py 重放")
+    print("  --sockbuf     - 设置一类连接(client/local/bot/peer)的内核收发缓冲区，如 client=8192,16384（可以写多个）")
+    print("  --unix        - 同时在 Unix 域套接字上监听，供本机的机器人等程序连接，如 /tmp/touchfish.sock")
+    print("  --high-scale  - 大规模模式：允许上万个连接，启动时提高文件描述符上限（Linux/macOS）")
+    print("  --backlog     - 监听队列长度（默认为系统上限，大规模模式为 4096）")
+    print("  --transport   - 传输模式：latency（每条消息立即发送，默认）或 throughput[:毫秒]（合并几毫秒内的消息一次发送），")
+    print("                  写成 聊天室=模式 时只用于本服务器(local)或某台互联服务器的消息（可以写多个）")
+    print("  --ipcap       - 每个IP最多同时占用的连接数（含排队，默认: 0 即不限制）")
     print("")
     print("示例:")
     print("  TFserver.exe               # 使用默认配置")
     print("  TFserver.exe 192.168.1.100 8080 20")
     print("  TFserver.exe 0.0.0.0 1234 5")
+    print("  TFserver.exe 0.0.0.0 8080 10000 --high-scale")
     print("")
     print("启动后输入 'help' 查看服务器命令")
     print("=" * 40)
@@ -599,26 +3469,130 @@ def main():
         max_connections = 10
         
         # 处理命令行参数
-        if len(sys.argv) == 1:
+        startup_profile = "--startup-profile" in sys.argv
+        high_scale = "--high-scale" in sys.argv
+        argv = [arg for arg in sys.argv if arg not in ("--startup-profile", "--high-scale")]
+        multicast = None
+        if "--multicast" in argv:
+            index = argv.index("--multicast")
+            if index + 1 >= len(argv):
+                print_usage()
+                return
+            group, _, group_port = argv[index + 1].rpartition(":")
+            multicast = (group, int(group_port))
+            del argv[index:index + 2]
+            if socket.inet_aton(group)[0] not in range(224, 240):
+                print("错误: 组播地址必须在224.0.0.0-239.255.255.255之间")
+                return
+        socket_buffers = {}
+        while "--sockbuf" in argv:
+            # --sockbuf 类型=接收,发送，如 --sockbuf client=8192,16384
+            index = argv.index("--sockbuf")
+            if index + 1 >= len(argv):
+                print_usage()
+                return
+            kind, _, sizes = argv[index + 1].partition("=")
+            rcvbuf, _, sndbuf = sizes.partition(",")
+            if kind not in SOCKET_BUFFERS:
+                print("错误: --sockbuf 的连接类型必须是 client、local、bot 或 peer")
+                return
+            socket_buffers[kind] = (int(rcvbuf or 0), int(sndbuf or 0))
+            del argv[index:index + 2]
+        transport = {}
+        while "--transport" in argv:
+            # --transport [聊天室=]latency|throughput[:毫秒]，如 --transport throughput:5 --transport local=latency
+            index = argv.index("--transport")
+            if index + 1 >= len(argv):
+                print_usage()
+                return
+            room, _, profile = argv[index + 1].rpartition("=")
+            try:
+                transport[room or None] = parse_transport(profile)
+            except ValueError as e:
+                print(f"错误: {e}")
+                return
+            del argv[index:index + 2]
+        backlog = None
+        if "--backlog" in argv:
+            index = argv.index("--backlog")
+            if index + 1 >= len(argv):
+                print_usage()
+                return
+            backlog = int(argv[index + 1])
+            del argv[index:index + 2]
+            if backlog < 1:
+                print("错误: 监听队列长度必须大于0")
+                return
+        max_per_ip = MAX_CONNECTIONS_PER_IP
+        if "--ipcap" in argv:
+            index = argv.index("--ipcap")
+            if index + 1 >= len(argv):
+                print_usage()
+                return
+            max_per_ip = int(argv[index + 1])
+            del argv[index:index + 2]
+            if max_per_ip < 0:
+                print("错误: 每IP连接上限不能小于0")
+                return
+        unix_path = None
+        if "--unix" in argv:
+            index = argv.index("--unix")
+            if index + 1 >= len(argv):
+                print_usage()
+                return
+            unix_path = argv[index + 1]
+            del argv[index:index + 2]
+        capture = None
+        if "--capture" in argv:
+            index = argv.index("--capture")
+            if index + 1 >= len(argv):
+                print_usage()
+                return
+            capture = argv[index + 1]
+            del argv[index:index + 2]
+        peers = []
+        while "--peer" in argv:
+            index = argv.index("--peer")
+            if index + 1 >= len(argv):
+                print_usage()
+                return
+            peer_ip, _, peer_port = argv[index + 1].rpartition(":")
+            peers.append((peer_ip, int(peer_port)))
+            del argv[index:index + 2]
+        peer_secret = ""
+        if "--peer-secret" in argv:
+            index = argv.index("--peer-secret")
+            if index + 1 >= len(argv):
+                print_usage()
+                return
+            peer_secret = argv[index + 1]
+            del argv[index:index + 2]
+        if any(ch.isspace() for ch in peer_secret):
+            print("错误: 互联口令不能包含空格")
+            return
+        if peers and not peer_secret:
+            print("错误: 服务器互联需要同时用 --peer-secret 设置互联口令（各台服务器相同）")
+            return
+        if len(argv) == 1:
             # 无参数，使用默认配置
             print("TouchFish服务器启动中...")
             print("使用默认配置: 127.0.0.1:8080 (最大连接: 10)")
-        elif len(sys.argv) == 2:
+        elif len(argv) == 2:
             # 只有IP参数
-            ip = sys.argv[1]
+            ip = argv[1]
             print(f"TouchFish服务器启动中...")
             print(f"使用配置: {ip}:{port} (最大连接: {max_connections})")
-        elif len(sys.argv) == 3:
+        elif len(argv) == 3:
             # IP和端口参数
-            ip = sys.argv[1]
-            port = int(sys.argv[2])
+            ip = argv[1]
+            port = int(argv[2])
             print(f"TouchFish服务器启动中...")
             print(f"使用配置: {ip}:{port} (最大连接: {max_connections})")
-        elif len(sys.argv) == 4:
+        elif len(argv) == 4:
             # 全部参数
-            ip = sys.argv[1]
-            port = int(sys.argv[2])
-            max_connections = int(sys.argv[3])
+            ip = argv[1]
+            port = int(argv[2])
+            max_connections = int(argv[3])
             print(f"TouchFish服务器启动中...")
             print(f"使用配置: {ip}:{port} (最大连接: {max_connections})")
         else:
@@ -630,12 +3604,15 @@ def main():
             print("错误: 端口必须在1-65535之间")
             return
             
-        if max_connections < 1 or max_connections > 100:
-            print("错误: 最大连接数必须在1-100之间")
+        limit = HIGH_SCALE_MAX_CONNECTIONS if high_scale else 100
+        if max_connections < 1 or max_connections > limit:
+            hint = "" if high_scale else "（加上 --high-scale 可以设置更大的值）"
+            print(f"错误: 最大连接数必须在1-{limit}之间{hint}")
             return
             
         # 启动服务器
-        server = TFServer(ip, port, max_connections)
+        server = TFServer(ip, port, max_connections, startup_profile, multicast, peers, capture, unix_path, socket_buffers,
+                          high_scale, backlog, transport, max_per_ip, peer_secret)
         server.start()
         
     except ValueError:
@@ -662,6 +3639,8 @@ def main():
         print()
         print_usage()
 
+IMPORTS_DONE = time.perf_counter()
+
 if __name__ == "__main__":
     # 如果是直接运行exe文件，隐藏控制台窗口
     if getattr(sys, 'frozen', False):
@@ -1,12 +1,37 @@
+import time
+STARTUP_TIME = time.perf_counter()  # 用于 --startup-profile 统计导入耗时
+
 import tkinter as tk
-from tkinter import ttk, messagebox, colorchooser
+from tkinter import ttk, messagebox
 import socket
 import threading
-import platform
 import datetime
 import sys
 import re
-import time
+import os
+import queue
+import select
+import collections
+import bisect
+
+# 以下模块只在用到时才导入，减少启动时间：
+# colorchooser（选择主题色时）、sqlite3（打开本地聊天记录时）、winsound/subprocess（播放提示音时）
+sqlite3 = None
+
+STARTUP_PROFILE = "--startup-profile" in sys.argv
+
+def report_startup_profile(stages):
+    """输出启动各阶段相对脚本开始执行的耗时（--startup-profile）"""
+    lines = ["启动耗时统计:"]
+    for name, t in stages:
+        lines.append(f"  {name}: {(t - STARTUP_TIME) * 1000:.1f} ms")
+    text = "\n".join(lines)
+    if sys.stdout is not None:
+        print(text, flush=True)
+    else:
+        # 打包成无控制台的exe时写入文件
+        with open("startup_profile.txt", "a", encoding="utf-8") as f:
+            f.write(text + "\n")
 
 def calculate_contrast_color(color):
     """计算与给定颜色对比度较高的颜色"""
@@ -47,7 +72,263 @@ def darken_color(color, factor=0.2):
     
     return f'#{r:02x}{g:02x}{b:02x}'
 
+def escape_line(text):
+    """把消息编码为单行帧（转义反斜杠和换行符）"""
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+def unescape_line(line):
+    """还原escape_line编码的单行帧"""
+    return re.sub(r"\\(.)", lambda m: "\n" if m.group(1) == "n" else m.group(1), line)
+
+def escape_chat(text):
+    """把输入的一行编码为聊天帧：/dm 以外以'/'开头的消息写成'//'，服务器转发时去掉一个'/'"""
+    if text.startswith("/") and text.split(None, 1)[0] not in ("/dm",):
+        text = "/" + text
+    return escape_line(text)
+
+def format_size(size):
+    """把字节数格式化为易读的大小"""
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+def parse_file_offer(message):
+    """解析服务器发出的文件消息 /file offer <文件编号> <字节数> <上传者>:<文件名>，返回 (上传者, 文件名, 字节数, 文件编号)
+    聊天内容总以"用户名: "开头，不会被当成文件消息；不是文件消息时返回None"""
+    if not message.startswith("/file offer "):
+        return None
+    parts = message.split(" ", 4)
+    if len(parts) != 5 or not parts[3].isdigit():
+        return None
+    owner, _, name = parts[4].partition(":")
+    return owner, name, int(parts[3]), parts[2]
+
+class NotificationSound:
+    """提示音：合并突发消息，限制播放频率，同一时间最多一个播放进程
+    只在GUI线程中调用 notify；播放线程不调用Tk，没有播放器时由GUI线程直接响铃"""
+
+    WINDOWS_SOUND_FILE = r"C:\Windows\Media\Windows Notify System Generic.wav"
+    MAC_SOUND_FILE = "/System/Library/Sounds/Ping.aiff"
+    LINUX_SOUND_FILE = "/usr/share/sounds/freedesktop/stereo/message.oga"
+
+    def __init__(self, root, interval_ms=800):
+        self.root = root
+        self.interval = interval_ms / 1000
+        self.system = sys.platform
+        self.wav_data = None  # Windows下预加载的WAV数据
+        self.player = None    # 其他平台上正在播放的进程（最多一个）
+        self.last_play = 0
+        self.last_bell = 0
+        self.bell_fallback = False  # 没有可用的播放器，改用窗口系统的提示音
+        if self.system != "win32":
+            import shutil
+            self.bell_fallback = shutil.which("afplay" if self.system == "darwin" else "paplay") is None
+        self.pending = threading.Event()
+        if not self.bell_fallback:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def notify(self):
+        """请求播放一次提示音（GUI线程，连续请求会被合并）"""
+        if self.bell_fallback:
+            now = time.monotonic()
+            if now - self.last_bell >= self.interval:
+                self.last_bell = now
+                self.root.bell()
+            return
+        self.pending.set()
+
+    def run(self):
+        """播放线程主循环"""
+        self.preload()
+        while True:
+            self.pending.wait()
+            # 限频：距离上次播放不足间隔时等待，期间的请求合并为一次
+            delay = self.last_play + self.interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.pending.clear()
+            self.last_play = time.monotonic()
+            try:
+                self.play()
+            except Exception:
+                pass
+
+    def preload(self):
+        """预加载提示音数据"""
+        if self.system == "win32":
+            try:
+                with open(self.WINDOWS_SOUND_FILE, "rb") as f:
+                    self.wav_data = f.read()
+            except OSError:
+                self.wav_data = None
+
+    def play(self):
+        """在播放线程中播放提示音"""
+        if self.system == "win32":
+            import winsound
+            if self.wav_data:
+                winsound.PlaySound(self.wav_data, winsound.SND_MEMORY)
+            else:
+                winsound.Beep(1000, 200)
+            return
+
+        # 上一次的播放进程仍在运行时不再启动新进程
+        if self.player is not None and self.player.poll() is None:
+            return
+        if self.system == "darwin":
+            command = ["afplay", self.MAC_SOUND_FILE]
+        else:
+            command = ["paplay", self.LINUX_SOUND_FILE]
+        try:
+            import subprocess
+            self.player = subprocess.Popen(
+                command,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL
+            )
+        except OSError:
+            # 播放器无法启动时，之后的请求由GUI线程改用窗口系统的提示音
+            self.player = None
+            self.bell_fallback = True
+
+class MessageStore:
+    """本地聊天记录缓存（SQLite WAL模式），每个服务器一个文件，后台线程批量写入"""
+
+    BATCH_INTERVAL = 0.5  # 批量写入的攒批时间（秒）
+
+    def __init__(self, server_ip, port):
+        directory = os.path.join(os.path.expanduser("~"), ".touchfish", "history")
+        os.makedirs(directory, exist_ok=True)
+        name = re.sub(r"[^0-9A-Za-z.-]", "_", f"{server_ip}_{port}")
+        self.path = os.path.join(directory, f"{name}.db")
+        self.session = int(time.time())  # 本次会话编号（连接时间）
+        self.queue = queue.Queue()
+        self.fts = False  # 是否支持FTS5三元组全文索引
+
+        # 读连接只在GUI线程使用，写连接属于写入线程
+        self.db = self.open_db()
+        self.create_schema()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def open_db(self):
+        """打开数据库连接并启用WAL模式"""
+        db = sqlite3.connect(self.path, timeout=5)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def create_schema(self):
+        """创建表和索引"""
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "id INTEGER PRIMARY KEY, ts REAL NOT NULL, session INTEGER NOT NULL, "
+                "sender TEXT NOT NULL, content TEXT NOT NULL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages(ts)")
+        try:
+            with self.db:
+                self.db.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+                    "content, content='messages', content_rowid='id', tokenize='trigram')"
+                )
+                self.db.execute(
+                    "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN "
+                    "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END"
+                )
+            self.fts = True
+        except sqlite3.OperationalError:
+            # 旧版SQLite不支持FTS5或trigram分词，退回到LIKE查询
+            self.fts = False
+
+    def add(self, message, timestamp=None):
+        """加入一条待写入的消息（线程安全，不阻塞）"""
+        message = message.rstrip("\n")
+        sender = message.split(":", 1)[0].strip() if ":" in message else ""
+        self.queue.put((timestamp or time.time(), self.session, sender, message))
+
+    def write_loop(self):
+        """写入线程：攒批后一次事务写入"""
+        db = self.open_db()
+        running = True
+        while running:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            time.sleep(self.BATCH_INTERVAL)
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            try:
+                with db:
+                    db.executemany(
+                        "INSERT INTO messages(ts, session, sender, content) VALUES (?, ?, ?, ?)",
+                        batch
+                    )
+            except sqlite3.Error:
+                pass
+        db.close()
+
+    def recent(self, limit=50):
+        """获取最近的消息，按时间正序返回 [(id, ts, content)]"""
+        rows = self.db.execute(
+            "SELECT id, ts, content FROM messages ORDER BY id DESC LIMIT ?", (limit,)
+        ).fetchall()
+        return rows[::-1]
+
+    def before(self, message_id, limit=50):
+        """获取指定消息之前的一页消息，按时间正序返回"""
+        rows = self.db.execute(
+            "SELECT id, ts, content FROM messages WHERE id < ? ORDER BY id DESC LIMIT ?",
+            (message_id, limit)
+        ).fetchall()
+        return rows[::-1]
+
+    def search(self, text, limit=200):
+        """在所有历史会话中搜索，所有关键词都需命中，按时间倒序返回"""
+        terms = text.split()
+        if not terms:
+            return []
+        if self.fts and all(len(term) >= 3 for term in terms):
+            query = " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+            return self.db.execute(
+                "SELECT m.id, m.ts, m.content FROM messages_fts f JOIN messages m ON m.id = f.rowid "
+                "WHERE messages_fts MATCH ? ORDER BY m.id DESC LIMIT ?",
+                (query, limit)
+            ).fetchall()
+        # 三元组索引无法处理少于3个字符的关键词，改用LIKE
+        where = " AND ".join("content LIKE ? ESCAPE '\\'" for _ in terms)
+        params = [
+            "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            for term in terms
+        ]
+        return self.db.execute(
+            f"SELECT id, ts, content FROM messages WHERE {where} ORDER BY id DESC LIMIT ?",
+            (*params, limit)
+        ).fetchall()
+
+    def close(self):
+        """写完剩余消息后关闭"""
+        self.queue.put(None)
+        self.writer.join(timeout=2)
+        self.db.close()
+
 class ChatClient:
+    GAP_TIMEOUT = 1.0  # 组播丢包等待补发的最长时间（秒）
+    TRANSFER_CHUNK = 64 * 1024  # 文件传输每次读写的大小
+    PROGRESS_INTERVAL = 0.2  # 传输进度的刷新间隔（秒）
+
     def __init__(self):
         self.root = tk.Tk()
         self.root.title("聊天客户端")
@@ -58,6 +339,14 @@ class ChatClient:
         self.theme_color = "#F0FFFF"  # 默认主题色
         self.font_family = ("微软雅黑", 12)
         self.bell_enabled = False
+        self.history_enabled = True  # 是否保存本地聊天记录
+        self.store = None
+        self.history_oldest_id = None  # 已加载的最早一条历史记录
+        self.history_loading = False
+        self.search_win = None  # 打开的搜索窗口
+        self.search_page = 1
+        self.closing = False
+        self.notification_sound = None
         
         # 计算辅助色
         self.secondary_color = lighten_color(self.theme_color)
@@ -66,7 +355,7 @@ class ChatClient:
         self.accent_color = darken_color(self.theme_color)
         
         self.create_connection_window()
-        # 不在这里启动mainloop，而是在连接成功后启动聊天窗口的mainloop
+        # 不在这里启动mainloop，由调用者启动；连接成功后聊天窗口沿用同一个主循环
 
     def create_connection_window(self):
         """创建连接窗口"""
@@ -76,6 +365,7 @@ class ChatClient:
         
         frame = tk.Frame(self.root, padx=20, pady=20, bg=self.background_color)
         frame.pack(expand=True, fill="both")
+        self.connection_frame = frame
         
         # 服务器地址
         tk.Label(frame, text="服务器IP:", bg=self.background_color, fg=self.text_color).grid(row=0, column=0, sticky="w", pady=5)
@@ -124,51 +414,151 @@ class ChatClient:
             self.server_ip = self.ip_entry.get()
             self.port = int(self.port_entry.get())
             self.username = self.user_entry.get()
-            if not self.username:
-                messagebox.showerror("错误", "用户名不能为空")
-                return
-                
+        except ValueError as e:
+            messagebox.showerror("连接错误", f"无法连接到服务器:\n{str(e)}")
+            return
+        if not self.username:
+            messagebox.showerror("错误", "用户名不能为空")
+            return
+        
+        # 先打开聊天窗口显示本地历史记录，再进行可能阻塞的连接和注册
+        self.registered = False
+        self.open_message_store()
+        self.connection_frame.destroy()  # 关闭连接界面，复用同一个Tk实例
+        self.init_network_state()
+        self.create_chat_window()
+        self.show_cached_history()
+        self.chat_win.title(f"聊天室 - {self.username}（正在连接…）")
+        self.chat_win.update()
+        if STARTUP_PROFILE:
+            chat_window_built = time.perf_counter()
+        
+        try:
             self.socket = socket.socket()
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # 聊天消息很小，立即发出不等待合并
             self.socket.settimeout(10)  # 设置10秒超时
             self.socket.connect((self.server_ip, self.port))
             
             # 发送用户名进行注册
-            self.socket.send(self.username.encode("utf-8"))
+            self.socket.sendall(f"{escape_line(self.username)}\n".encode("utf-8"))
             
-            # 等待服务器确认
+            # 等待服务器确认（读到确认行为止，多读到的数据留给接收线程）
             try:
-                response = self.socket.recv(1024).decode("utf-8")
+                response = self.wait_for_registration()
             except socket.timeout:
                 messagebox.showerror("连接错误", "服务器响应超时，请检查服务器是否正常运行")
                 self.socket.close()
-                # 重新启动连接窗口的mainloop
-                self.root.mainloop()
+                self.return_to_connection_window()
                 return
             if response.startswith("USERNAME_OK:"):
                 # 用户名注册成功
                 self.socket.settimeout(None)  # 恢复阻塞模式
                 self.socket.setblocking(0)  # 设置为非阻塞模式以适应后续的消息接收
-                self.root.destroy()  # 关闭连接窗口
-                self.create_chat_window()  # 打开聊天窗口
-                # 启动消息接收线程
-                threading.Thread(target=self.receive_messages, daemon=True).start()
-
-                # 启动聊天窗口的主循环
-                self.chat_win.mainloop()
+                self.registered = True
+                # 订阅在线名单
+                self.send_control("/roster")
+                # 启动网络线程（负责接收消息和发送队列中的消息）
+                threading.Thread(target=self.network_loop, daemon=True).start()
+                
+                if STARTUP_PROFILE:
+                    self.chat_win.after_idle(lambda: report_startup_profile([
+                        ("聊天窗口创建完成", chat_window_built),
+                        ("聊天窗口首帧", time.perf_counter()),
+                    ]))
             else:
                 # 用户名注册失败
                 messagebox.showerror("连接错误", response)
                 self.socket.close()
-                # 重新启动连接窗口的mainloop
-                self.root.mainloop()
+                self.return_to_connection_window()
         except Exception as e:
             messagebox.showerror("连接错误", f"无法连接到服务器:\n{str(e)}")
-            # 重新启动连接窗口的mainloop
-            self.root.mainloop()
+            self.return_to_connection_window()
+
+    def init_network_state(self):
+        """初始化网络线程使用的状态"""
+        self.send_queue = collections.deque()
+        self.send_pending = None
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(0)
+        self.wakeup_send.setblocking(0)
+        # 组播接收状态（服务器提供组播时使用）
+        self.multicast_socket = None
+        self.next_seq = 0
+        self.pending_frames = {}
+        self.gap_since = None
+        # 延迟追踪：服务器开启后对每条消息回执收到时间
+        self.trace_echo = False
+        # 文件传输状态
+        self.upload_requests = {}  # {请求编号: 本地文件路径}
+        self.next_upload_tag = 1
+        # 服务器搜索结果: /results 之后跟着若干条 /hit
+        self.search_header = None
+        self.search_hits = []
+
+    def return_to_connection_window(self):
+        """连接失败时关闭聊天窗口，回到连接窗口"""
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+        self.history_oldest_id = None
+        self.search_win = None
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
+        for child in self.root.winfo_children():
+            child.destroy()
+        self.root.title("聊天客户端")
+        self.root.protocol("WM_DELETE_WINDOW", self.root.destroy)
+        self.create_connection_window()
+        # 保留刚才填写的连接信息
+        for entry, value in ((self.ip_entry, self.server_ip), (self.port_entry, self.port), (self.user_entry, self.username)):
+            entry.delete(0, "end")
+            entry.insert(0, str(value))
+
+    def wait_for_registration(self):
+        """读取服务器对注册的回复；服务器满员时显示排队位置并保持窗口响应"""
+        self.recv_buffer = b""
+        self.socket.settimeout(0.2)
+        deadline = time.monotonic() + 10
+        redirects = 0
+        try:
+            while True:
+                while b"\n" not in self.recv_buffer:
+                    if time.monotonic() > deadline:
+                        raise socket.timeout("服务器响应超时")
+                    try:
+                        data = self.socket.recv(1024)
+                    except socket.timeout:
+                        self.root.update()
+                        continue
+                    if not data:
+                        break
+                    self.recv_buffer += data
+                line, _, self.recv_buffer = self.recv_buffer.partition(b"\n")
+                response = unescape_line(line.decode("utf-8", errors="replace"))
+                if response.startswith("/redirect ") and redirects < 3:
+                    # 聊天室已满，服务器把我们转到互联的其他服务器: /redirect <IP> <端口>
+                    redirects += 1
+                    _, self.server_ip, port = response.split()
+                    self.port = int(port)
+                    self.socket.close()
+                    self.socket = socket.create_connection((self.server_ip, self.port), timeout=10)
+                    self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.socket.settimeout(0.2)
+                    self.socket.sendall(f"{escape_line(self.username)}\n".encode("utf-8"))
+                    self.recv_buffer = b""
+                    deadline = time.monotonic() + 10
+                    continue
+                if not response.startswith("/wait "):
+                    return response
+                # 排队中: /wait <位置>，排队期间不再限时
+                self.chat_win.title(f"聊天室 - {self.username}（服务器已满，正在排队: 第 {response.split()[1]} 位）")
+                deadline = float("inf")
+        finally:
+            self.chat_win.title(f"聊天室 - {self.username}")
 
     def create_chat_window(self):
-        """创建聊天窗口"""
-        self.chat_win = tk.Tk()
+        """创建聊天窗口（复用连接窗口的Tk实例，避免再创建一个Tcl解释器）"""
+        self.chat_win = self.root
         self.chat_win.title(f"聊天室 - {self.username}")
         self.chat_win.geometry("900x600")
         self.chat_win.minsize(600, 400)
@@ -189,7 +579,32 @@ class ChatClient:
         left_frame.rowconfigure(1, weight=0)
         left_frame.rowconfigure(2, weight=0)
         
-
+        # 右侧在线名单
+        self.roster_frame = tk.Frame(self.paned_window, bg=self.background_color)
+        self.paned_window.add(self.roster_frame, weight=0)
+        self.roster_frame.columnconfigure(0, weight=1)
+        self.roster_frame.rowconfigure(1, weight=1)
+        self.roster = []  # 排好序的在线用户名，与列表框中的顺序一致
+        self.roster_version = None  # 已应用的名单版本，收到完整名单前为None
+        self.roster_resync = False  # 已请求完整名单，等待回复
+        
+        self.roster_label = tk.Label(self.roster_frame, text="在线", font=self.font_family, bg=self.background_color, fg=self.text_color)
+        self.roster_label.grid(row=0, column=0, columnspan=2, sticky="w", padx=5, pady=(5, 0))
+        self.roster_list = tk.Listbox(
+            self.roster_frame,
+            font=self.font_family,
+            width=14,
+            activestyle="none",
+            highlightthickness=0,
+            bg=self.background_color,
+            fg=self.text_color
+        )
+        roster_scrollbar = ttk.Scrollbar(self.roster_frame, orient="vertical", command=self.roster_list.yview)
+        self.roster_list.configure(yscrollcommand=roster_scrollbar.set)
+        self.roster_list.grid(row=1, column=0, sticky="nsew", padx=(5, 0), pady=5)
+        roster_scrollbar.grid(row=1, column=1, sticky="ns", pady=5)
+        # 双击名字在输入框中@对方
+        self.roster_list.bind("<Double-Button-1>", self.mention_selected_user)
         
         # ============= 左侧消息区域 =============
         # 聊天记录框
@@ -285,9 +700,40 @@ class ChatClient:
         send_btn.bind("<Enter>", lambda e: send_btn.config(relief="raised"))
         send_btn.bind("<Leave>", lambda e: send_btn.config(relief="flat"))
         
+        # 底部按钮栏
+        button_frame = tk.Frame(left_frame, bg=self.background_color)
+        button_frame.grid(row=2, column=0, pady=5)
+        self.button_frame = button_frame
+        
+        # 搜索按钮
+        self.search_btn = tk.Button(
+            button_frame, 
+            text="搜索", 
+            command=self.open_search,
+            bg=self.accent_color,
+            fg=calculate_contrast_color(self.accent_color),
+            font=self.font_family,
+            relief="flat",
+            padx=20
+        )
+        self.search_btn.grid(row=0, column=1, padx=5)
+        
+        # 发送文件按钮
+        self.file_btn = tk.Button(
+            button_frame, 
+            text="文件", 
+            command=self.send_file,
+            bg=self.accent_color,
+            fg=calculate_contrast_color(self.accent_color),
+            font=self.font_family,
+            relief="flat",
+            padx=20
+        )
+        self.file_btn.grid(row=0, column=0, padx=5)
+        
         # 设置按钮
-        setting_btn = tk.Button(
-            left_frame, 
+        self.setting_btn = tk.Button(
+            button_frame, 
             text="设置", 
             command=self.open_settings,
             bg=self.accent_color,
@@ -296,15 +742,199 @@ class ChatClient:
             relief="flat",
             padx=20
         )
-        setting_btn.grid(row=2, column=0, pady=5)
+        self.setting_btn.grid(row=0, column=2, padx=5)
+        
+        # 文件传输进度
+        self.transfer_label = tk.Label(button_frame, text="", bg=self.background_color, fg=self.text_color)
+        self.transfer_label.grid(row=0, column=3, padx=5)
         
         # 添加鼠标移入效果
-        setting_btn.bind("<Enter>", lambda e: setting_btn.config(relief="raised"))
-        setting_btn.bind("<Leave>", lambda e: setting_btn.config(relief="flat"))
+        for btn in (self.file_btn, self.search_btn, self.setting_btn):
+            btn.bind("<Enter>", lambda e: e.widget.config(relief="raised"))
+            btn.bind("<Leave>", lambda e: e.widget.config(relief="flat"))
+        
+        # 滚动到顶部时按需加载更早的本地历史记录
+        def on_scroll(first, last):
+            scrollbar.set(first, last)
+            if float(first) <= 0.0 and self.history_oldest_id is not None and not self.history_loading:
+                self.history_loading = True
+                self.chat_win.after_idle(self.load_older_history)
         
+        self.chat_text.configure(yscrollcommand=on_scroll)
+
+    def open_message_store(self):
+        """打开本服务器对应的本地聊天记录"""
+        global sqlite3
+        try:
+            import sqlite3
+        except ImportError:
+            return
+        try:
+            self.store = MessageStore(self.server_ip, self.port)
+        except (OSError, sqlite3.Error):
+            self.store = None
+
+    def show_cached_history(self):
+        """在聊天窗口中立即显示最近的本地历史记录"""
+        if self.store is None:
+            return
+        try:
+            rows = self.store.recent()
+        except sqlite3.Error:
+            return
+        if not rows:
+            return
+        self.history_oldest_id = rows[0][0]
+        self.insert_history(rows, "end")
+        self.chat_text.config(state="normal")
+        self.chat_text.insert("end", "—— 以上为本地历史记录 ——\n", "history")
+        self.chat_text.config(state="disabled")
+        self.chat_text.see("end")
 
+    def load_older_history(self):
+        """向上滚动到顶部时加载更早的一页历史记录"""
+        try:
+            rows = self.store.before(self.history_oldest_id)
+        except sqlite3.Error:
+            rows = []
+        if not rows:
+            # 已经没有更早的记录
+            self.history_oldest_id = None
+            self.history_loading = False
+            return
+        self.history_oldest_id = rows[0][0]
+        self.insert_history(rows, "1.0")
+        # 保持原来第一行的可见位置
+        self.chat_text.yview(f"{len(rows) + 1}.0")
+        self.history_loading = False
 
+    def insert_history(self, rows, index):
+        """把历史记录插入聊天框的指定位置"""
+        lines = []
+        for _, ts, content in rows:
+            stamp = datetime.datetime.fromtimestamp(ts).strftime("%m-%d %H:%M:%S")
+            lines.append(f"[{stamp}] {content.replace(chr(10), ' ')}\n")
+        self.chat_text.config(state="normal")
+        self.chat_text.insert(index, "".join(lines), "history")
+        self.chat_text.tag_configure("history", foreground="gray")
+        self.chat_text.config(state="disabled")
 
+    def open_search(self):
+        """打开聊天记录搜索窗口：可以搜索本地聊天记录或服务器上的聊天记录"""
+        if self.search_win is not None:
+            self.search_win.lift()
+            return
+        
+        search_win = tk.Toplevel(self.chat_win)
+        search_win.title("搜索聊天记录")
+        search_win.transient(self.chat_win)
+        search_win.geometry("600x400")
+        search_win.configure(bg=self.background_color)
+        search_win.columnconfigure(0, weight=1)
+        search_win.rowconfigure(1, weight=1)
+        
+        query_entry = tk.Entry(search_win, font=self.font_family)
+        query_entry.grid(row=0, column=0, sticky="ew", padx=10, pady=10)
+        query_entry.focus_set()
+        
+        result_text = tk.Text(
+            search_win,
+            font=self.font_family,
+            state="disabled",
+            wrap="word",
+            bg=self.background_color,
+            fg=self.text_color
+        )
+        result_text.grid(row=1, column=0, columnspan=3, sticky="nsew", padx=10, pady=(0, 10))
+        
+        def do_search(event=None):
+            if self.store is None:
+                self.show_search_rows(["本地聊天记录不可用，可以点击“搜索服务器”"])
+                return
+            try:
+                rows = self.store.search(query_entry.get().strip())
+            except sqlite3.Error as e:
+                messagebox.showerror("搜索错误", str(e), parent=search_win)
+                return
+            lines = []
+            for _, ts, content in rows:
+                stamp = datetime.datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+                lines.append(f"[{stamp}] {content}")
+            self.show_search_rows(lines or ["没有找到匹配的消息"])
+            self.search_nav.grid_remove()
+        
+        def do_server_search(page=1):
+            query = query_entry.get().strip()
+            if not query:
+                return
+            # 服务器支持 from:用户名 after:时间 before:时间 条件，结果分页返回
+            self.search_query = query
+            self.send_control(f"/search {escape_line(query)} page:{page}")
+            self.wake_network_thread()
+            self.show_search_rows(["正在搜索服务器上的聊天记录…"])
+        
+        query_entry.bind("<Return>", do_search)
+        for column, (text, command) in enumerate((("搜索", do_search), ("搜索服务器", do_server_search)), 1):
+            tk.Button(
+                search_win,
+                text=text,
+                command=command,
+                bg=self.theme_color,
+                fg=calculate_contrast_color(self.theme_color),
+                font=self.font_family,
+                relief="flat",
+                padx=20
+            ).grid(row=0, column=column, padx=(0, 10), pady=10)
+        
+        # 服务器搜索结果的翻页
+        self.search_nav = tk.Frame(search_win, bg=self.background_color)
+        self.search_nav.grid(row=2, column=0, columnspan=3, pady=(0, 10))
+        self.search_prev_btn = tk.Button(self.search_nav, text="上一页", relief="flat",
+                                         command=lambda: do_server_search(self.search_page - 1))
+        self.search_prev_btn.grid(row=0, column=0, padx=5)
+        self.search_page_label = tk.Label(self.search_nav, bg=self.background_color, fg=self.text_color)
+        self.search_page_label.grid(row=0, column=1, padx=5)
+        self.search_next_btn = tk.Button(self.search_nav, text="下一页", relief="flat",
+                                         command=lambda: do_server_search(self.search_page + 1))
+        self.search_next_btn.grid(row=0, column=2, padx=5)
+        self.search_nav.grid_remove()
+        
+        self.search_win = search_win
+        self.search_result_text = result_text
+        
+        def on_close():
+            self.search_win = None
+            search_win.destroy()
+        
+        search_win.protocol("WM_DELETE_WINDOW", on_close)
+        
+    def show_search_rows(self, lines):
+        """在搜索窗口中显示结果"""
+        self.search_result_text.config(state="normal")
+        self.search_result_text.delete("1.0", "end")
+        for line in lines:
+            self.search_result_text.insert("end", line + "\n")
+        self.search_result_text.config(state="disabled")
+        
+    def show_server_results(self, total, page, pages, hits):
+        """显示服务器返回的一页搜索结果（GUI线程）"""
+        if self.search_win is None:
+            return
+        if total is None:
+            # 搜索条件有误等，hits 为错误原因
+            self.show_search_rows([f"搜索失败: {hits}"])
+            self.search_nav.grid_remove()
+            return
+        lines = []
+        for sent, content in hits:
+            stamp = datetime.datetime.fromtimestamp(sent / 1000).strftime("%Y-%m-%d %H:%M:%S")
+            lines.append(f"[{stamp}] {content}")
+        self.show_search_rows(lines or ["没有找到匹配的消息"])
+        self.search_page = page
+        self.search_page_label.config(text=f"共 {total} 条，第 {page}/{pages} 页")
+        self.search_prev_btn.config(state="normal" if page > 1 else "disabled")
+        self.search_next_btn.config(state="normal" if page < pages else "disabled")
+        self.search_nav.grid()
 
     def open_settings(self):
         """打开设置窗口"""
@@ -312,7 +942,7 @@ class ChatClient:
         settings_win.title("设置")
         settings_win.transient(self.chat_win)
         settings_win.grab_set()
-        settings_win.geometry("300x400")
+        settings_win.geometry("300x480")
         settings_win.configure(bg=self.background_color)
         
         # 创建选项卡
@@ -328,6 +958,7 @@ class ChatClient:
         theme_frame.pack(padx=10, pady=5, fill="x")
         
         def choose_color():
+            from tkinter import colorchooser
             color = colorchooser.askcolor(initialcolor=self.theme_color)[1]
             if color:
                 self.theme_color = color
@@ -370,10 +1001,22 @@ class ChatClient:
             bell_frame, 
             text="启用消息提示音",
             variable=bell_var,
-            state="normal" if platform.system() == "Windows" else "disabled"
+            state="normal" if sys.platform == "win32" else "disabled"
         )
         bell_check.pack(anchor="w")
         
+        # 聊天记录设置
+        history_frame = tk.LabelFrame(display_frame, text="聊天记录", padx=10, pady=10)
+        history_frame.pack(padx=10, pady=5, fill="x")
+        
+        history_var = tk.BooleanVar(value=self.history_enabled)
+        tk.Checkbutton(
+            history_frame,
+            text="保存本地聊天记录",
+            variable=history_var,
+            state="normal" if self.store is not None else "disabled"
+        ).pack(anchor="w")
+        
         # 确定按钮
         def apply_settings():
             try:
@@ -382,6 +1025,7 @@ class ChatClient:
                 self.font_family = (font_name, font_size)
                 
                 self.bell_enabled = bell_var.get()
+                self.history_enabled = history_var.get()
                 
                 self.chat_text.config(font=self.font_family)
                 self.msg_entry.config(font=self.font_family)
@@ -414,11 +1058,18 @@ class ChatClient:
         self.msg_entry.configure(bg=self.background_color, fg=self.text_color)
         
         # 更新按钮颜色
-        setting_btn = self.chat_text.master.master.grid_slaves(row=2, column=0)[0]
-        setting_btn.configure(bg=self.accent_color, fg=calculate_contrast_color(self.accent_color))
+        self.button_frame.configure(bg=self.background_color)
+        self.transfer_label.configure(bg=self.background_color, fg=self.text_color)
+        for btn in (self.file_btn, self.search_btn, self.setting_btn):
+            btn.configure(bg=self.accent_color, fg=calculate_contrast_color(self.accent_color))
         send_btn = input_frame.grid_slaves(row=0, column=1)[0]
         send_btn.configure(bg=self.theme_color, fg=calculate_contrast_color(self.theme_color))
         
+        # 更新在线名单颜色
+        self.roster_frame.configure(bg=self.background_color)
+        self.roster_label.configure(bg=self.background_color, fg=self.text_color)
+        self.roster_list.configure(bg=self.background_color, fg=self.text_color)
+        
 
 
     def on_enter_key(self, event):
@@ -433,58 +1084,418 @@ class ChatClient:
         return "break"  # 阻止默认行为
     
     def send_message(self):
-        """发送消息"""
+        """发送消息（放入发送队列，由网络线程按顺序发送）"""
         # 获取消息内容，排除提示文字
         content = self.msg_entry.get("1.0", "end-1c")
         if content == self.placeholder_text:
             return
         
         message = content.strip()
-        if not message:
+        if not message or not self.registered:
+            # 连接完成前保留输入框中的内容
             return
             
-        full_msg = f"{self.username}: {message}"
+        # 只发送消息正文，发送者由服务器按注册的用户名加上
+        self.send_queue.append(f"{escape_chat(message)}\n".encode("utf-8"))
+        self.wake_network_thread()
+        
+        # 立即显示自己发送的消息（私信 /dm 用户名 内容 显示为发给谁）
+        if message.startswith("/dm "):
+            self.display_message(f"[私信] {self.username} → {message[4:].strip()}")
+        else:
+            self.display_message(f"{self.username}: {message}")
+        self.msg_entry.delete("1.0", "end")
+        # 重置提示文字
+        self.msg_entry.insert("1.0", self.placeholder_text)
+        self.msg_entry.config(fg="gray")
+
+    def wake_network_thread(self):
+        """唤醒阻塞在select上的网络线程"""
         try:
-            self.socket.send(full_msg.encode("utf-8"))
-            # 立即显示自己发送的消息
-            self.display_message(full_msg)
-            self.msg_entry.delete("1.0", "end")
-            # 重置提示文字
-            self.msg_entry.insert("1.0", self.placeholder_text)
-            self.msg_entry.config(fg="gray")
-        except BlockingIOError:
-            # 非阻塞socket发送缓冲区满，稍后重试
-            self.chat_win.after(100, self.send_message)
-        except Exception as e:
-            messagebox.showerror("发送错误", f"消息发送失败:\n{str(e)}")
+            self.wakeup_send.send(b"\0")
+        except (BlockingIOError, OSError):
+            # 唤醒管道已满说明网络线程本来就会被唤醒
+            pass
 
-    def receive_messages(self):
-        """接收消息的线程函数"""
-        while True:
+    def flush_send_queue(self):
+        """尽可能多地发送队列中的消息，处理部分写入"""
+        while self.send_pending is not None or self.send_queue:
+            if self.send_pending is None:
+                self.send_pending = memoryview(self.send_queue.popleft())
             try:
-                message = self.socket.recv(1024).decode("utf-8")
+                sent = self.socket.send(self.send_pending)
+            except BlockingIOError:
+                # 发送缓冲区已满，等socket可写后继续
+                return
+            self.send_pending = self.send_pending[sent:]
+            if not self.send_pending:
+                self.send_pending = None
 
-                    
-                # 检查是否是封禁消息
-                if message == "您已被服务器封禁":
-                    self.handle_ban()
-                    break
-                    
-                # 在GUI线程更新界面
-                self.chat_win.after(0, self.display_message, message)
+    def network_loop(self):
+        """网络线程：用select等待socket可读/可写或发送队列唤醒"""
+        try:
+            # 先处理注册时多读到的数据
+            if not self.process_recv_buffer():
+                return
+            while True:
+                writable = [self.socket] if self.send_pending is not None or self.send_queue else []
+                readable = [self.socket, self.wakeup_recv]
+                if self.multicast_socket is not None:
+                    readable.append(self.multicast_socket)
+                # 有乱序等待补发的消息时定期检查是否超时
+                timeout = 0.2 if self.pending_frames else None
+                readable, writable, _ = select.select(readable, writable, [], timeout)
+                
+                if self.wakeup_recv in readable:
+                    try:
+                        while self.wakeup_recv.recv(1024):
+                            pass
+                    except BlockingIOError:
+                        pass
+                
+                if self.send_pending is not None or self.send_queue:
+                    self.flush_send_queue()
+                
+                if self.multicast_socket is not None and self.multicast_socket in readable:
+                    if not self.receive_multicast():
+                        return
                 
-                # 播放提示音
-                if self.bell_enabled and not message.startswith(f"{self.username}:"):
-                    self.play_notification_sound()
-                    
+                if self.socket in readable:
+                    try:
+                        data = self.socket.recv(4096)
+                    except BlockingIOError:
+                        continue
+                    if not data:
+                        break
+                    self.recv_buffer += data
+                    if not self.process_recv_buffer():
+                        return
+                
+                if self.pending_frames:
+                    self.check_sequence_gap()
+        except Exception as e:
+            if not self.closing:
+                self.chat_win.after(0, messagebox.showerror, "网络错误", f"与服务器的连接已断开:\n{str(e)}")
+
+    def process_recv_buffer(self):
+        """处理TCP接收缓冲区中所有完整的帧，返回False表示需要结束网络线程"""
+        *lines, self.recv_buffer = self.recv_buffer.split(b"\n")
+        for line in lines:
+            if not self.handle_incoming(unescape_line(line.decode("utf-8", errors="replace"))):
+                return False
+        return True
+
+    def receive_multicast(self):
+        """读取所有已到达的组播数据报"""
+        while True:
+            try:
+                data = self.multicast_socket.recv(65536)
             except BlockingIOError:
-                # 非阻塞socket的正常行为，继续等待数据
-                continue
-            except Exception as e:
-                break
+                return True
+            for line in data.split(b"\n"):
+                if line and not self.handle_incoming(unescape_line(line.decode("utf-8", errors="replace"))):
+                    return False
+
+    def send_control(self, command):
+        """发送控制命令（加入发送队列，和聊天消息按顺序发出）"""
+        self.send_queue.append(f"{command}\n".encode("utf-8"))
+
+    def join_multicast(self, group, port, next_seq):
+        """加入服务器提供的组播组，失败时继续只用TCP接收"""
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, "SO_REUSEPORT"):
+                # 允许同一台机器上的多个客户端同时加入
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(("", port))
+            # 在连接服务器所用的网卡上加入组播组
+            interface = self.socket.getsockname()[0]
+            membership = socket.inet_aton(group) + socket.inet_aton(interface)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            sock.setblocking(0)
+        except OSError:
+            return
+        self.multicast_socket = sock
+        self.next_seq = next_seq
+        self.send_control("/mcast on")
+
+    def handle_sequenced(self, seq, message):
+        """处理带序号的聊天消息；组播模式下按序号去重、排序，发现缺口时请求补发"""
+        if self.multicast_socket is None:
+            self.trace_ack(seq)
+            self.show_incoming(message)
+            return
+        if seq < self.next_seq or seq in self.pending_frames:
+            return  # 重复收到（TCP和组播都收到，或补发）
+        self.trace_ack(seq)
+        self.pending_frames[seq] = message
+        while self.next_seq in self.pending_frames:
+            self.show_incoming(self.pending_frames.pop(self.next_seq))
+            self.next_seq += 1
+        if not self.pending_frames:
+            self.gap_since = None
+        elif self.gap_since is None:
+            # 出现缺口，请服务器通过TCP补发
+            self.gap_since = time.monotonic()
+            self.send_control(f"/nack {self.next_seq} {min(self.pending_frames) - 1}")
+
+    def trace_ack(self, seq):
+        """延迟追踪开启时回执本机收到消息的时间（毫秒时间戳）"""
+        if self.trace_echo:
+            self.send_control(f"/ack {seq} {int(time.time() * 1000)}")
+
+    def check_sequence_gap(self):
+        """缺口等待补发超时后放弃缺失的消息，继续显示后面的消息"""
+        if self.gap_since is None or time.monotonic() - self.gap_since < self.GAP_TIMEOUT:
+            return
+        self.gap_since = None
+        self.next_seq = min(self.pending_frames)
+        self.handle_sequenced(self.next_seq, self.pending_frames.pop(self.next_seq))
+
+    def handle_incoming(self, message):
+        """处理收到的一帧，返回False表示需要结束网络线程"""
+        if message.startswith("/m "):
+            # 带序号的聊天消息: /m <序号> <服务器收到时间> <服务器发出时间> <内容>
+            _, seq, _, _, content = message.split(" ", 4)
+            self.handle_sequenced(int(seq), content)
+            return True
+        if message.startswith("/trace "):
+            # 服务器开启/关闭延迟追踪: /trace on|off
+            self.trace_echo = message == "/trace on"
+            return True
+        if message.startswith("/mcast "):
+            # 服务器提供组播: /mcast <组播地址> <端口> <下一条消息序号>
+            _, group, port, next_seq = message.split()
+            self.join_multicast(group, int(port), int(next_seq))
+            return True
+        if message.startswith("/roster ") or message.startswith("/presence "):
+            # 在线名单: /roster <版本> <完整名单>，/presence <版本> <增量变化>，用户名之间用':'分隔
+            kind, version, names = message.split(" ", 2)
+            self.chat_win.after(0, self.update_roster, kind == "/roster", int(version), names)
+            return True
+        if message.startswith("/results "):
+            # 服务器搜索结果: /results <匹配数> <页码> <总页数> <本页条数> 或 /results error <原因>
+            parts = message.split(" ", 4)
+            if parts[1] == "error":
+                self.chat_win.after(0, self.show_server_results, None, 0, 0, message.split(" ", 2)[2])
+                return True
+            total, page, pages, count = (int(part) for part in parts[1:5])
+            self.search_header = (total, page, pages, count)
+            self.search_hits = []
+        elif message.startswith("/hit ") and self.search_header is not None:
+            # 一条搜索结果: /hit <时间毫秒> <发送者: 内容>
+            _, sent, content = message.split(" ", 2)
+            self.search_hits.append((int(sent), content))
+        if message.startswith(("/results ", "/hit ")):
+            if self.search_header is not None and len(self.search_hits) == self.search_header[3]:
+                total, page, pages, _ = self.search_header
+                self.chat_win.after(0, self.show_server_results, total, page, pages, self.search_hits)
+                self.search_header = None
+            return True
+        if message.startswith("/file accept "):
+            # 服务器同意上传: /file accept <请求编号> <文件编号>
+            _, _, tag, file_id = message.split(" ", 3)
+            path = self.upload_requests.pop(tag, None)
+            if path is not None:
+                threading.Thread(target=self.upload_file, args=(path, file_id), daemon=True).start()
+            return True
+        if message.startswith("/file reject "):
+            # 服务器拒绝上传: /file reject <请求编号> <原因>
+            _, _, tag, reason = message.split(" ", 3)
+            self.upload_requests.pop(tag, None)
+            self.chat_win.after(0, messagebox.showerror, "文件发送失败", reason)
+            return True
+        if message.startswith("/"):
+            # 不认识的控制命令，忽略
+            return True
+        
+        # 检查是否是封禁消息
+        if message == "您已被服务器封禁":
+            self.handle_ban()
+            return False
+        
+        self.show_incoming(message)
+        return True
+
+    def update_roster(self, full, version, names):
+        """更新在线名单（GUI线程）：完整名单直接替换，增量按版本号顺序应用，发现缺失时重新请求完整名单"""
+        entries = [entry for entry in names.split(":") if entry]
+        if full:
+            self.roster = sorted(set(entries))
+            self.roster_version = version
+            self.roster_resync = False
+            self.roster_list.delete(0, "end")
+            self.roster_list.insert("end", *self.roster)
+        else:
+            if self.roster_version is None or version <= self.roster_version:
+                return  # 已经包含在完整名单中
+            if version != self.roster_version + 1:
+                # 中间缺了一次变化，重新获取完整名单
+                if not self.roster_resync:
+                    self.roster_resync = True
+                    self.send_control("/roster")
+                    self.wake_network_thread()
+                return
+            self.roster_version = version
+            for entry in entries:
+                op, name = entry[0], entry[1:]
+                index = bisect.bisect_left(self.roster, name)
+                present = index < len(self.roster) and self.roster[index] == name
+                if op == "+" and not present:
+                    self.roster.insert(index, name)
+                    self.roster_list.insert(index, name)
+                elif op == "-" and present:
+                    del self.roster[index]
+                    self.roster_list.delete(index)
+        self.roster_label.config(text=f"在线 ({len(self.roster)})")
+
+    def mention_selected_user(self, event):
+        """在输入框中插入 @用户名"""
+        selection = self.roster_list.curselection()
+        if not selection:
+            return
+        if self.msg_entry.get("1.0", "end-1c") == self.placeholder_text:
+            self.msg_entry.delete("1.0", "end")
+            self.msg_entry.config(fg=self.text_color)
+        self.msg_entry.insert(tk.INSERT, f"@{self.roster_list.get(selection[0])} ")
+        self.msg_entry.focus_set()
 
-    def display_message(self, message):
-        """在聊天框中显示消息"""
+    def show_incoming(self, message):
+        """显示收到的一条消息"""
+        # 文件消息显示为下载链接（只认服务器发出的文件消息帧）
+        file_link = None
+        offer = parse_file_offer(message)
+        if offer is not None:
+            owner, name, size, file_id = offer
+            message = f"{owner}: [文件] {name} ({format_size(size)})"
+            file_link = (file_id, name)
+        elif message.startswith("/"):
+            return  # 其他控制帧不显示
+        
+        # 组播会把自己发的消息也送回来，自己的消息发送时已经显示过
+        if message.startswith(f"{self.username}:"):
+            return
+        
+        # 在GUI线程更新界面
+        self.chat_win.after(0, self.display_message, message, file_link)
+        
+        # 播放提示音（在GUI线程中提交，播放线程不接触Tk）
+        if self.bell_enabled:
+            self.chat_win.after(0, self.play_notification)
+
+    def play_notification(self):
+        """请求播放提示音（GUI线程）"""
+        if self.notification_sound is None:
+            # 第一次需要提示音时才创建播放线程
+            self.notification_sound = NotificationSound(self.chat_win)
+        self.notification_sound.notify()
+
+    def send_file(self):
+        """选择文件并请求服务器允许上传"""
+        from tkinter import filedialog
+        path = filedialog.askopenfilename(parent=self.chat_win, title="选择要发送的文件")
+        if not path:
+            return
+        try:
+            size = os.path.getsize(path)
+        except OSError as e:
+            messagebox.showerror("文件发送失败", str(e))
+            return
+        tag = str(self.next_upload_tag)
+        self.next_upload_tag += 1
+        self.upload_requests[tag] = path
+        name = escape_line(os.path.basename(path))
+        self.send_control(f"/file put {tag} {size} {name}")
+        self.wake_network_thread()
+        self.set_transfer_status(f"等待服务器确认: {os.path.basename(path)}")
+
+    def open_transfer_connection(self, command):
+        """为一次文件传输单独建立连接，不占用聊天连接"""
+        sock = socket.create_connection((self.server_ip, self.port), timeout=30)
+        sock.sendall(f"{command}\n".encode("utf-8"))
+        return sock
+
+    def read_transfer_reply(self, sock):
+        """读取传输连接上服务器的一行回复，返回(回复, 多读到的数据)"""
+        data = b""
+        while b"\n" not in data:
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("服务器关闭了连接")
+            data += chunk
+        line, _, rest = data.partition(b"\n")
+        return unescape_line(line.decode("utf-8", errors="replace")), rest
+
+    def upload_file(self, path, file_id):
+        """上传线程：分块发送文件并显示进度"""
+        name = os.path.basename(path)
+        try:
+            size = os.path.getsize(path)
+            with open(path, "rb") as f, self.open_transfer_connection(f"/file upload {file_id}") as sock:
+                sent = 0
+                last_update = 0
+                while True:
+                    chunk = f.read(self.TRANSFER_CHUNK)
+                    if not chunk:
+                        break
+                    sock.sendall(chunk)
+                    sent += len(chunk)
+                    if time.monotonic() - last_update >= self.PROGRESS_INTERVAL:
+                        last_update = time.monotonic()
+                        self.set_transfer_status(f"上传 {name}: {sent * 100 // max(size, 1)}%")
+                reply, _ = self.read_transfer_reply(sock)
+            if reply != "OK":
+                raise ConnectionError(reply)
+            self.set_transfer_status(f"已发送 {name}")
+            # 服务器转发的文件消息中发送者是自己，不会再次显示，这里直接显示
+            self.chat_win.after(0, self.display_message, f"{self.username}: [文件] {name} ({format_size(size)})", (file_id, name))
+        except (OSError, ConnectionError) as e:
+            self.set_transfer_status("")
+            self.chat_win.after(0, messagebox.showerror, "文件发送失败", f"{name}:\n{str(e)}")
+
+    def download_file(self, file_id, name):
+        """选择保存位置后开始下载"""
+        from tkinter import filedialog
+        path = filedialog.asksaveasfilename(parent=self.chat_win, title="保存文件", initialfile=name)
+        if path:
+            threading.Thread(target=self.receive_file, args=(file_id, path), daemon=True).start()
+
+    def receive_file(self, file_id, path):
+        """下载线程：接收文件并显示进度"""
+        name = os.path.basename(path)
+        try:
+            with self.open_transfer_connection(f"/file get {file_id}") as sock:
+                reply, data = self.read_transfer_reply(sock)
+                if not reply.startswith("OK "):
+                    raise ConnectionError(reply[4:] if reply.startswith("ERR ") else reply)
+                size = int(reply.split(" ", 2)[1])
+                with open(path, "wb") as f:
+                    f.write(data[:size])
+                    received = len(data)
+                    last_update = 0
+                    buffer = bytearray(self.TRANSFER_CHUNK)
+                    view = memoryview(buffer)
+                    while received < size:
+                        n = sock.recv_into(view)
+                        if n == 0:
+                            raise ConnectionError("下载中断")
+                        f.write(view[:n])
+                        received += n
+                        if time.monotonic() - last_update >= self.PROGRESS_INTERVAL:
+                            last_update = time.monotonic()
+                            self.set_transfer_status(f"下载 {name}: {received * 100 // max(size, 1)}%")
+            self.set_transfer_status(f"已保存 {name}")
+        except (OSError, ConnectionError, ValueError) as e:
+            self.set_transfer_status("")
+            self.chat_win.after(0, messagebox.showerror, "文件下载失败", f"{name}:\n{str(e)}")
+
+    def set_transfer_status(self, text):
+        """更新文件传输进度（可在任意线程调用）"""
+        self.chat_win.after(0, lambda: self.transfer_label.config(text=text))
+
+    def display_message(self, message, file_link=None):
+        """在聊天框中显示消息；file_link 为 (文件编号, 文件名) 时把发送者之后的部分显示为下载链接"""
         self.chat_text.config(state="normal")
         
         # 获取当前时间并格式化
@@ -493,8 +1504,21 @@ class ChatClient:
         # 添加时间戳和换行
         formatted_message = f"[{current_time}] {message}\n"
         
+        # 检查是否是文件消息
+        if file_link is not None:
+            # 文件名显示为可点击的下载链接（用户名中没有':'）
+            file_id, name = file_link
+            link_tag = f"file-{file_id}"
+            start = message.index(": ") + 2
+            self.chat_text.insert("end", f"[{current_time}] {message[:start]}")
+            self.chat_text.insert("end", message[start:], ("file_link", link_tag))
+            self.chat_text.insert("end", "\n")
+            self.chat_text.tag_configure("file_link", foreground="#1a5fb4", underline=True)
+            self.chat_text.tag_bind(link_tag, "<Button-1>", lambda e: self.download_file(file_id, name))
+            self.chat_text.tag_bind(link_tag, "<Enter>", lambda e: self.chat_text.config(cursor="hand2"))
+            self.chat_text.tag_bind(link_tag, "<Leave>", lambda e: self.chat_text.config(cursor=""))
         # 检查是否包含@自己的消息
-        if f"@{self.username}" in message:
+        elif f"@{self.username}" in message:
             # 使用主题色突出显示
             self.chat_text.insert("end", formatted_message, "highlight")
         else:
@@ -506,6 +1530,10 @@ class ChatClient:
         # 滚动到最新消息
         self.chat_text.see("end")
         self.chat_text.config(state="disabled")
+        
+        # 写入本地聊天记录（后台批量写入）
+        if self.store is not None and self.history_enabled:
+            self.store.add(message)
 
     def handle_ban(self):
         """处理被封禁的情况"""
@@ -529,31 +1557,27 @@ class ChatClient:
         # 3秒后关闭程序
         self.chat_win.after(3000, self.on_closing)
 
-    def play_notification_sound(self):
-        """播放提示音（跨平台）"""
-        try:
-            if platform.system() == "Windows":
-                import winsound
-                winsound.Beep(1000, 200)
-            elif platform.system() == "Darwin":  # macOS
-                import os
-                os.system("afplay /System/Library/Sounds/Ping.aiff&")
-            else:  # Linux
-                import os
-                os.system("paplay /usr/share/sounds/freedesktop/stereo/message.oga&")
-        except:
-            pass
-
     def on_closing(self):
         """关闭窗口时的处理"""
+        self.closing = True
         try:
             self.socket.close()
         except:
             pass
+        if self.store is not None:
+            self.store.close()
         self.chat_win.destroy()
         sys.exit()
 
 if __name__ == "__main__":
+    imports_done = time.perf_counter()
     client = ChatClient()
+    if STARTUP_PROFILE:
+        window_built = time.perf_counter()
+        client.root.after_idle(lambda: report_startup_profile([
+            ("模块导入完成", imports_done),
+            ("连接窗口创建完成", window_built),
+            ("连接窗口首帧", time.perf_counter()),
+        ]))
     # 启动连接窗口的mainloop
     client.root.mainloop()
\ No newline at end of file
@@ -1,13 +1,51 @@
+import time
+STARTUP_TIME = time.perf_counter()  # 用于 --startup-profile 统计导入耗时
+
 import tkinter as tk
 from tkinter import messagebox
 import socket
 import threading
 import datetime
 import sys
+import re
+
+STARTUP_PROFILE = "--startup-profile" in sys.argv
+
+
+def report_startup_profile(stages):
+    """输出启动各阶段相对脚本开始执行的耗时（--startup-profile）"""
+    lines = ["启动耗时统计:"]
+    for name, t in stages:
+        lines.append(f"  {name}: {(t - STARTUP_TIME) * 1000:.1f} ms")
+    text = "\n".join(lines)
+    if sys.stdout is not None:
+        print(text, flush=True)
+    else:
+        # 打包成无控制台的exe时写入文件
+        with open("startup_profile.txt", "a", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+def escape_line(text):
+    """把消息编码为单行帧（转义反斜杠和换行符）"""
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def unescape_line(line):
+    """还原escape_line编码的单行帧"""
+    return re.sub(r"\\(.)", lambda m: "\n" if m.group(1) == "n" else m.group(1), line)
+
+
+def escape_chat(text):
+    """把输入的一行编码为聊天帧：/dm 以外以'/'开头的消息写成'//'，服务器转发时去掉一个'/'"""
+    if text.startswith("/") and text.split(None, 1)[0] not in ("/dm",):
+        text = "/" + text
+    return escape_line(text)
 
 
 class ChatClientLite:
     def __init__(self):
+        imports_done = time.perf_counter()
         self.root = tk.Tk()
         self.root.title("聊天客户端")
         self.root.geometry("400x300")
@@ -17,6 +55,13 @@ class ChatClientLite:
         self.font_family = ("微软雅黑", 10)
 
         self.create_connection_window()
+        if STARTUP_PROFILE:
+            window_built = time.perf_counter()
+            self.root.after_idle(lambda: report_startup_profile([
+                ("模块导入完成", imports_done),
+                ("连接窗口创建完成", window_built),
+                ("连接窗口首帧", time.perf_counter()),
+            ]))
         self.root.mainloop()
 
     def create_connection_window(self):
@@ -27,6 +72,7 @@ class ChatClientLite:
 
         frame = tk.Frame(self.root, padx=20, pady=20)
         frame.pack(expand=True, fill="both")
+        self.connection_frame = frame
 
         # 服务器地址
         tk.Label(frame, text="服务器IP:", font=self.font_family).grid(row=0, column=0, sticky="w", pady=5)
@@ -60,6 +106,7 @@ class ChatClientLite:
             pady=5
         )
         connect_btn.grid(row=3, columnspan=2, pady=15)
+        self.connect_btn = connect_btn
 
         # 提示
         tk.Label(frame, text="提示: Enter发送消息", font=self.font_family).grid(row=4, columnspan=2)
@@ -75,18 +122,75 @@ class ChatClientLite:
                 return
 
             self.socket = socket.socket()
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # 聊天消息很小，立即发出不等待合并
+            self.socket.settimeout(10)  # 设置10秒超时
             self.socket.connect((self.server_ip, self.port))
-            self.root.destroy()  # 关闭连接窗口
+
+            # 发送用户名进行注册，之后的消息只发送正文，发送者由服务器加上
+            self.socket.sendall(f"{escape_line(self.username)}\n".encode("utf-8"))
+
+            # 等待服务器确认（读到确认行为止，多读到的数据留给接收线程）
+            response = self.wait_for_registration()
+            if not response.startswith("USERNAME_OK:"):
+                messagebox.showerror("连接错误", response or "服务器关闭了连接")
+                self.socket.close()
+                return
+            self.socket.settimeout(None)  # 恢复阻塞模式
+
+            self.connection_frame.destroy()  # 关闭连接界面，复用同一个Tk实例
             self.create_chat_window()  # 打开聊天窗口
             # 启动消息接收线程
             threading.Thread(target=self.receive_messages, daemon=True).start()
-            self.chat_win.mainloop()
         except Exception as e:
             messagebox.showerror("连接错误", f"无法连接到服务器:\n{str(e)}")
 
+    def wait_for_registration(self):
+        """读取服务器对注册的回复；服务器满员时显示排队位置并保持窗口响应"""
+        self.recv_buffer = b""
+        self.socket.settimeout(0.2)
+        deadline = time.monotonic() + 10
+        redirects = 0
+        try:
+            while True:
+                while b"\n" not in self.recv_buffer:
+                    if time.monotonic() > deadline:
+                        raise socket.timeout("服务器响应超时")
+                    try:
+                        data = self.socket.recv(1024)
+                    except socket.timeout:
+                        self.root.update()
+                        continue
+                    if not data:
+                        break
+                    self.recv_buffer += data
+                line, _, self.recv_buffer = self.recv_buffer.partition(b"\n")
+                response = unescape_line(line.decode("utf-8", errors="replace"))
+                if response.startswith("/redirect ") and redirects < 3:
+                    # 聊天室已满，服务器把我们转到互联的其他服务器: /redirect <IP> <端口>
+                    redirects += 1
+                    _, self.server_ip, port = response.split()
+                    self.port = int(port)
+                    self.socket.close()
+                    self.socket = socket.create_connection((self.server_ip, self.port), timeout=10)
+                    self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.socket.settimeout(0.2)
+                    self.socket.sendall(f"{escape_line(self.username)}\n".encode("utf-8"))
+                    self.recv_buffer = b""
+                    deadline = time.monotonic() + 10
+                    continue
+                if not response.startswith("/wait "):
+                    return response
+                # 排队中: /wait <位置>，排队期间不再限时
+                self.connect_btn.config(state="disabled")
+                self.root.title(f"聊天客户端 - 排队中: 第 {response.split()[1]} 位")
+                deadline = float("inf")
+        finally:
+            self.connect_btn.config(state="normal")
+            self.root.title("聊天客户端")
+
     def create_chat_window(self):
-        """创建聊天窗口"""
-        self.chat_win = tk.Tk()
+        """创建聊天窗口（复用连接窗口的Tk实例，避免再创建一个Tcl解释器）"""
+        self.chat_win = self.root
         self.chat_win.title(f"聊天室 - {self.username}")
         self.chat_win.geometry("500x350")
         self.chat_win.minsize(400, 300)
@@ -186,11 +290,10 @@ class ChatClientLite:
         if not message:
             return
 
-        full_msg = f"{self.username}: {message}\n"
         try:
-            self.socket.send(full_msg.encode("utf-8"))
+            self.socket.sendall(f"{escape_chat(message)}\n".encode("utf-8"))
             # 立即显示自己发送的消息
-            self.display_message(full_msg)
+            self.display_message(f"{self.username}: {message}")
             self.msg_entry.delete("1.0", "end")
             # 重置提示文字
             self.msg_entry.insert("1.0", self.placeholder_text)
@@ -200,28 +303,48 @@ class ChatClientLite:
 
     def receive_messages(self):
         """接收消息的线程函数"""
+        buffer = b""
+        data = self.recv_buffer  # 注册时多读到的数据
         while True:
             try:
-                message = self.socket.recv(1024).decode("utf-8")
-
-                # 检查是否是封禁消息
-                if "您已被服务器封禁" in message:
-                    # 在GUI线程显示封禁消息并退出
-                    self.chat_win.after(0, self.handle_ban)
+                # 按换行符切分成完整的帧
+                buffer += data
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    message = unescape_line(line.decode("utf-8", errors="replace"))
+
+                    # 带序号的聊天消息: /m <序号> <服务器收到时间> <服务器发出时间> <内容>
+                    # 其他以'/'开头的控制命令忽略
+                    if message.startswith("/m "):
+                        message = message.split(" ", 4)[4]
+                        # 文件消息: /file offer <文件编号> <字节数> <上传者>:<文件名>（精简版不支持下载，只显示文件名）
+                        if message.startswith("/file offer "):
+                            owner, _, name = message.split(" ", 4)[-1].partition(":")
+                            message = f"{owner}: [文件] {name}"
+                    elif message.startswith("/"):
+                        continue
+
+                    # 检查是否是封禁消息
+                    if "您已被服务器封禁" in message:
+                        # 在GUI线程显示封禁消息并退出
+                        self.chat_win.after(0, self.handle_ban)
+                        return
+
+                    # 检查是否是在线状态测试
+                    if message.strip() == "TestOnlineStatus":
+                        # 发回在线状态响应
+                        try:
+                            self.socket.send("TRUE\n".encode("utf-8"))
+                        except:
+                            pass
+                        continue
+
+                    # 在GUI线程更新界面
+                    self.chat_win.after(0, self.display_message, message)
+
+                data = self.socket.recv(4096)
+                if not data:
                     break
-                    
-                # 检查是否是在线状态测试
-                if message.strip() == "TestOnlineStatus":
-                    # 发回在线状态响应
-                    try:
-                        self.socket.send("TRUE\n".encode("utf-8"))
-                    except:
-                        pass
-                    continue
-
-                # 在GUI线程更新界面
-                self.chat_win.after(0, self.display_message, message)
-
             except Exception as e:
                 break
 
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+client_term - 无图形界面的终端客户端
+不依赖tkinter，启动快、占用内存小，适合老旧机房电脑和SSH会话
+标准输入的每一行作为一条消息发送，收到的消息逐行输出到标准输出，可直接用于脚本
+"""
+
+import time
+STARTUP_TIME = time.perf_counter()  # 用于 --startup-profile 统计导入耗时
+
+import socket
+import sys
+import threading
+import re
+
+
+def escape_line(text):
+    """把消息编码为单行帧（转义反斜杠和换行符）"""
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def unescape_line(line):
+    """还原escape_line编码的单行帧"""
+    return re.sub(r"\\(.)", lambda m: "\n" if m.group(1) == "n" else m.group(1), line)
+
+
+def escape_chat(text):
+    """把输入的一行编码为聊天帧：/dm、/search 以外以'/'开头的消息写成'//'，服务器转发时去掉一个'/'"""
+    if text.startswith("/") and text.split(None, 1)[0] not in ("/dm", "/search"):
+        text = "/" + text
+    return escape_line(text)
+
+
+def report_startup_profile(stages):
+    """输出启动各阶段相对脚本开始执行的耗时（--startup-profile），写到标准错误以免干扰脚本读取"""
+    print("启动耗时统计:", file=sys.stderr)
+    for name, t in stages:
+        print(f"  {name}: {(t - STARTUP_TIME) * 1000:.1f} ms", file=sys.stderr)
+
+
+class ChatClientTerm:
+    def __init__(self, server_ip, port, username):
+        self.server_ip = server_ip
+        self.port = port
+        self.username = username
+        self.socket = None
+        self.recv_buffer = b""
+        # 输出到终端时显示时间戳，被脚本读取时只输出消息本身
+        self.show_time = sys.stdout.isatty()
+        self.running = False
+        self.trace_echo = False  # 服务器开启延迟追踪后回执收到时间
+        self.send_lock = threading.Lock()  # 接收线程发送回执，主线程发送消息
+
+    def open_socket(self):
+        """建立连接：IP 写成 unix:路径 时通过本机的 Unix 域套接字连接服务器（忽略端口）"""
+        if self.server_ip.startswith("unix:"):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(10)
+            try:
+                sock.connect(self.server_ip[5:])
+            except OSError:
+                sock.close()
+                raise
+            return sock
+        sock = socket.create_connection((self.server_ip, self.port), timeout=10)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # 每行立即发出，不等待合并
+        return sock
+        
+    def connect(self):
+        """连接服务器并注册用户名，成功返回True"""
+        self.socket = self.open_socket()
+        self.socket.sendall(f"{escape_line(self.username)}\n".encode("utf-8"))
+
+        # 等待服务器确认（读到确认行为止，多读到的数据留给接收线程）
+        # 服务器满员时先收到 /wait <位置>，排队期间不再限时；也可能被转到互联的其他服务器
+        redirects = 0
+        while True:
+            while b"\n" not in self.recv_buffer:
+                data = self.socket.recv(1024)
+                if not data:
+                    break
+                self.recv_buffer += data
+            line, _, self.recv_buffer = self.recv_buffer.partition(b"\n")
+            response = unescape_line(line.decode("utf-8", errors="replace"))
+            if response.startswith("/redirect ") and redirects < 3:
+                # 聊天室已满，服务器把我们转到互联的其他服务器: /redirect <IP> <端口>
+                redirects += 1
+                _, self.server_ip, port = response.split()
+                self.port = int(port)
+                print(f"服务器已满，转到 {self.server_ip}:{self.port}", file=sys.stderr)
+                self.socket.close()
+                self.socket = self.open_socket()
+                self.socket.sendall(f"{escape_line(self.username)}\n".encode("utf-8"))
+                self.recv_buffer = b""
+                continue
+            if not response.startswith("/wait "):
+                break
+            print(f"服务器已满，正在排队: 第 {response.split()[1]} 位", file=sys.stderr)
+            self.socket.settimeout(None)
+        if not response.startswith("USERNAME_OK:"):
+            print(f"连接错误: {response or '服务器关闭了连接'}", file=sys.stderr)
+            self.socket.close()
+            return False
+
+        self.socket.settimeout(None)
+        self.running = True
+        return True
+
+    def receive_messages(self):
+        """接收消息的线程函数"""
+        try:
+            while self.running:
+                *lines, self.recv_buffer = self.recv_buffer.split(b"\n")
+                for line in lines:
+                    self.handle_incoming(unescape_line(line.decode("utf-8", errors="replace")))
+                if not self.running:
+                    break
+                data = self.socket.recv(4096)
+                if not data:
+                    print("服务器已断开连接", file=sys.stderr)
+                    break
+                self.recv_buffer += data
+        except OSError:
+            pass
+        self.running = False
+
+    def handle_incoming(self, message):
+        """输出收到的一条消息"""
+        # 带序号的聊天消息: /m <序号> <服务器收到时间> <服务器发出时间> <内容>
+        # 服务器开启/关闭延迟追踪: /trace on|off；其他以'/'开头的控制命令忽略
+        if message.startswith("/m "):
+            seq, _, _, message = message[3:].split(" ", 3)
+            if self.trace_echo:
+                self.send_line(f"/ack {seq} {int(time.time() * 1000)}")
+            # 文件消息: /file offer <文件编号> <字节数> <上传者>:<文件名>（终端版不支持下载，只显示文件名）
+            if message.startswith("/file offer "):
+                owner, _, name = message.split(" ", 4)[-1].partition(":")
+                message = f"{owner}: [文件] {name}"
+        elif message.startswith("/trace "):
+            self.trace_echo = message == "/trace on"
+            return
+        elif message.startswith("/results "):
+            # 服务器搜索结果: /results <匹配数> <页码> <总页数> <本页条数> 或 /results error <原因>
+            parts = message.split(" ", 4)
+            if parts[1] == "error":
+                message = f"搜索失败: {message.split(' ', 2)[2]}"
+            else:
+                message = f"搜索结果: {parts[1]} 条，第 {parts[2]}/{parts[3]} 页"
+        elif message.startswith("/hit "):
+            # 一条搜索结果: /hit <时间毫秒> <发送者: 内容>
+            _, sent, message = message.split(" ", 2)
+            stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(int(sent) / 1000))
+            sys.stdout.write(f"  [{stamp}] {message}\n")
+            sys.stdout.flush()
+            return
+        elif message.startswith("/"):
+            return
+        if message == "您已被服务器封禁":
+            print("您已被服务器封禁", file=sys.stderr)
+            self.running = False
+            return
+        if self.show_time:
+            message = f"[{time.strftime('%H:%M:%S')}] {message}"
+        sys.stdout.write(message + "\n")
+        sys.stdout.flush()
+
+    def send_line(self, line):
+        """发送一帧（加锁，避免两个线程的数据交错）"""
+        with self.send_lock:
+            self.socket.sendall(f"{line}\n".encode("utf-8"))
+
+    def send_message(self, message):
+        """发送一条消息"""
+        # 只发送消息正文，发送者由服务器按注册的用户名加上
+        self.send_line(escape_chat(message))
+
+    def run(self):
+        """主循环：逐行读取标准输入并发送"""
+        threading.Thread(target=self.receive_messages, daemon=True).start()
+        try:
+            for line in sys.stdin:
+                if not self.running:
+                    break
+                message = line.rstrip("\r\n")
+                if message in ("/quit", "/exit"):
+                    break
+                if message.strip():
+                    self.send_message(message)
+        except (KeyboardInterrupt, OSError):
+            pass
+        self.running = False
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+
+
+def print_usage():
+    """显示使用说明"""
+    print("TouchFish终端客户端 - client_term")
+    print("用法:")
+    print("  client_term.py <IP> <端口> <用户名> [--startup-profile]")
+    print("")
+    print("标准输入的每一行作为一条消息发送，输入 /quit 或 EOF 退出")
+    print("输入 /search 关键词 [from:用户名] [after:2h] [page:2] 搜索服务器上的聊天记录")
+    print("输入 /dm 用户名 内容 发送私信，对方不在线时上线后收到")
+    print("示例:")
+    print("  client_term.py 192.168.1.100 8080 小明")
+    print("  echo 大家好 | client_term.py 192.168.1.100 8080 机器人")
+    print("  client_term.py unix:/tmp/touchfish.sock 0 机器人   # 在服务器所在机器上通过 --unix 套接字连接")
+
+
+def main():
+    """主函数"""
+    imports_done = time.perf_counter()
+    startup_profile = "--startup-profile" in sys.argv
+    argv = [arg for arg in sys.argv if arg != "--startup-profile"]
+    if len(argv) != 4:
+        print_usage()
+        return 2
+    try:
+        port = int(argv[2])
+    except ValueError:
+        print("错误: 端口必须是有效的整数", file=sys.stderr)
+        return 2
+    username = argv[3]
+
+    client = ChatClientTerm(argv[1], port, username)
+    try:
+        if not client.connect():
+            return 1
+    except OSError as e:
+        print(f"无法连接到服务器: {e}", file=sys.stderr)
+        return 1
+    if startup_profile:
+        report_startup_profile([
+            ("模块导入完成", imports_done),
+            ("连接并注册完成", time.perf_counter()),
+        ])
+    client.run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
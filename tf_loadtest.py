@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+tf_loadtest - 大量连接下的延迟测试
+先在只有少数连接时测一次消息延迟作为基准，再让上万个用户登录后保持在线，用同样的速率再测一次，
+比较两次的延迟，检查服务器（--high-scale）在大量连接下转发是否仍然及时
+"""
+
+import time
+import socket
+import selectors
+import sys
+try:
+    import resource  # 提高本程序的文件描述符上限，只有 Unix 有
+except ImportError:
+    resource = None
+
+CONNECT_BATCH = 500  # 每连接这么多个就处理一次服务器的注册回复
+REGISTER_TIMEOUT = 30  # 等待所有连接注册完成的秒数
+SETTLE_TIME = 1  # 连接完成后等待服务器处理完登录日志、在线名单等再开始测量
+
+
+def percentile(ordered, q):
+    """已排序样本的分位数"""
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def latency_report(samples):
+    """延迟样本（毫秒）的统计"""
+    if not samples:
+        return {"samples": 0}
+    ordered = sorted(samples)
+    return {
+        "samples": len(ordered),
+        "p50_ms": round(percentile(ordered, 0.5), 2),
+        "p90_ms": round(percentile(ordered, 0.9), 2),
+        "p99_ms": round(percentile(ordered, 0.99), 2),
+        "max_ms": round(ordered[-1], 2),
+    }
+
+
+class LoadConnection:
+    """测试用的一个客户端连接"""
+    def __init__(self, sock, username):
+        self.sock = sock
+        self.username = username
+        self.buffer = b""
+        self.registered = False
+        self.received = 0  # 收到的测试消息数
+
+
+class LoadTest:
+    def __init__(self, server_ip, port, connections, rate, duration):
+        self.server_ip = server_ip
+        self.port = port
+        self.connections = connections  # 第二轮测量时保持在线的连接数
+        self.rate = rate  # 每秒发送的测试消息数
+        self.duration = duration  # 每轮测量的秒数
+        self.idle = []  # 只在线、不发言的连接
+        self.idle_selector = selectors.DefaultSelector()
+        self.errors = []
+        self.run_id = int(time.time()) % 100000  # 用户名前缀，多次测试不会重名
+
+    def source_address(self, index):
+        """测试本机服务器时每个连接使用不同的回环地址，避免触发服务器的每IP连接上限"""
+        if not self.server_ip.startswith("127."):
+            return None
+        index += 2
+        return (f"127.{(index >> 16) & 255}.{(index >> 8) & 255}.{index & 255 or 1}", 0)
+
+    def open(self, index, username):
+        """连接服务器并发送用户名，不等待回复"""
+        sock = socket.create_connection((self.server_ip, self.port), timeout=10,
+                                        source_address=self.source_address(index))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # 与客户端相同，测试消息立即发出
+        sock.sendall(f"{username}\n".encode("utf-8"))
+        sock.setblocking(False)
+        return LoadConnection(sock, username)
+
+    def read(self, connection):
+        """读取一个连接收到的数据，返回完整的行；连接已关闭时返回None"""
+        try:
+            data = connection.sock.recv(65536)
+        except BlockingIOError:
+            return []
+        except OSError:
+            data = b""
+        if not data:
+            return None
+        *lines, connection.buffer = (connection.buffer + data).split(b"\n")
+        for line in lines:
+            if line.startswith(b"USERNAME_OK:"):
+                connection.registered = True
+            elif line.startswith(b"/m "):
+                connection.received += 1
+            elif line.startswith(b"/wait "):
+                self.errors.append(f"{connection.username}: 服务器已满，正在排队")
+            elif line and not line.startswith(b"/"):
+                self.errors.append(f"{connection.username}: {line.decode('utf-8', errors='replace')}")
+        return lines
+
+    def drain_idle(self, timeout):
+        """读取在线连接收到的数据（只在两轮测量之间和结束时读取，测量期间数据留在内核缓冲区中）"""
+        for key, _ in self.idle_selector.select(timeout):
+            connection = key.data
+            if self.read(connection) is None:
+                self.idle_selector.unregister(connection.sock)
+                connection.sock.close()
+                self.errors.append(f"{connection.username}: 服务器关闭了连接")
+
+    def wait_registered(self, connections, deadline):
+        """等待连接全部注册完成"""
+        while time.perf_counter() < deadline and not all(c.registered for c in connections):
+            self.drain_idle(0.05)
+
+    def connect_idle(self):
+        """让 self.connections 个用户登录并保持在线"""
+        start = time.perf_counter()
+        batch = []
+        for i in range(self.connections):
+            try:
+                connection = self.open(i + 2, f"lt{self.run_id}_{i}")
+            except OSError as e:
+                self.errors.append(f"第 {i + 1} 个连接失败: {e}")
+                break
+            self.idle.append(connection)
+            self.idle_selector.register(connection.sock, selectors.EVENT_READ, connection)
+            batch.append(connection)
+            if len(batch) >= CONNECT_BATCH:
+                self.wait_registered(batch, time.perf_counter() + REGISTER_TIMEOUT)
+                batch = []
+            if (i + 1) % 2000 == 0:
+                print(f"  已连接 {i + 1} 个", file=sys.stderr)
+        self.wait_registered(self.idle, time.perf_counter() + REGISTER_TIMEOUT)
+        elapsed = time.perf_counter() - start
+        registered = sum(1 for c in self.idle if c.registered)
+        return registered, elapsed
+
+    def measure(self, sender, probe, tail):
+        """按固定速率发送测试消息，统计 probe（最早登录）和 tail（最后登录）收到的延迟"""
+        selector = selectors.DefaultSelector()
+        watched = [probe] if tail is None else [probe, tail]
+        for connection in watched:
+            selector.register(connection.sock, selectors.EVENT_READ, connection)
+        sent_at = {}
+        latencies = {id(connection): [] for connection in watched}
+        total = int(self.rate * self.duration)
+        start = time.perf_counter()
+        prefix = f"{sender.username}: loadtest ".encode("utf-8")
+        sent = 0
+        while True:
+            now = time.perf_counter()
+            if sent < total and now >= start + sent / self.rate:
+                sent_at[sent] = time.perf_counter()
+                sender.sock.sendall(f"loadtest {sent}\n".encode("utf-8"))
+                sent += 1
+                continue
+            pending = sum(len(samples) < sent for samples in latencies.values())
+            if sent >= total and (not pending or now > start + self.duration + 5):
+                break
+            due = start + sent / self.rate if sent < total else now + 0.05
+            for key, _ in selector.select(max(0, min(due - now, 0.05))):
+                connection = key.data
+                arrived = time.perf_counter()
+                lines = self.read(connection)
+                if lines is None:
+                    raise OSError(f"{connection.username} 的连接被服务器关闭")
+                for line in lines:
+                    # /m <序号> <服务器收到时间> <服务器发出时间> <发送者: 正文>
+                    if line.startswith(b"/m "):
+                        payload = line.split(b" ", 4)[-1]
+                        if payload.startswith(prefix):
+                            number = int(payload[len(prefix):])
+                            latencies[id(connection)].append((arrived - sent_at[number]) * 1000)
+        selector.close()
+        result = {"messages": sent, "first": latency_report(latencies[id(probe)])}
+        if tail is not None:
+            result["last"] = latency_report(latencies[id(tail)])
+        return result
+
+    def run(self):
+        """两轮测量，返回报告"""
+        probe = self.open(0, f"lt{self.run_id}_probe")
+        sender = self.open(1, f"lt{self.run_id}_sender")
+        self.wait_probe([probe, sender])
+        report = {"connections": self.connections, "rate": self.rate, "duration": self.duration}
+        print("第一轮：只有 2 个连接", file=sys.stderr)
+        report["baseline"] = self.measure(sender, probe, None)
+
+        print(f"正在连接 {self.connections} 个用户...", file=sys.stderr)
+        registered, elapsed = self.connect_idle()
+        report["registered"] = registered
+        report["connect_seconds"] = round(elapsed, 2)
+        report["connect_rate"] = round(registered / elapsed, 1) if elapsed else 0
+        time.sleep(SETTLE_TIME)
+        self.drain_idle(0)
+        print(f"第二轮：{registered + 2} 个连接", file=sys.stderr)
+        before = [c.received for c in self.idle]
+        report["loaded"] = self.measure(sender, probe, self.idle[-1] if self.idle else None)
+
+        # 检查每个在线用户都收到了第二轮的全部消息
+        deadline = time.perf_counter() + 10
+        expected = report["loaded"]["messages"]
+        while time.perf_counter() < deadline:
+            self.drain_idle(0.1)
+            if all(c.received - old >= expected for c, old in zip(self.idle, before) if c.registered):
+                break
+        report["complete_deliveries"] = sum(
+            1 for c, old in zip(self.idle, before) if c.registered and c.received - old >= expected)
+        report["errors"] = len(self.errors)
+        for connection in [probe, sender] + self.idle:
+            connection.sock.close()
+        return report
+
+    def wait_probe(self, connections):
+        """等待测量用的两个连接注册完成"""
+        deadline = time.perf_counter() + REGISTER_TIMEOUT
+        while time.perf_counter() < deadline and not all(c.registered for c in connections):
+            for connection in connections:
+                if not connection.registered and self.read(connection) is None:
+                    raise OSError(f"{connection.username} 的连接被服务器关闭")
+            time.sleep(0.01)
+        if not all(c.registered for c in connections):
+            raise OSError("测量用的连接没有注册成功")
+
+
+def raise_fd_limit(needed):
+    """提高本程序的文件描述符上限，返回实际上限"""
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+def print_report(report):
+    """显示测试结果"""
+    print(f"负载测试（{report['rate']} 条/秒，每轮 {report['duration']} 秒）:")
+    print(f"  在线连接: {report['registered']} / {report['connections']}，"
+          f"登录耗时 {report['connect_seconds']} 秒（{report['connect_rate']} 个/秒）")
+    rows = [("2 个连接", report["baseline"]["first"]),
+            (f"{report['registered'] + 2} 个连接，最早登录的用户", report["loaded"]["first"])]
+    if "last" in report["loaded"]:
+        rows.append((f"{report['registered'] + 2} 个连接，最后登录的用户", report["loaded"]["last"]))
+    for label, stats in rows:
+        if not stats["samples"]:
+            print(f"  {label}: 没有收到消息")
+            continue
+        print(f"  {label}: 中位数 {stats['p50_ms']} ms，P90 {stats['p90_ms']} ms，"
+              f"P99 {stats['p99_ms']} ms，最大 {stats['max_ms']} ms（{stats['samples']} 条）")
+    print(f"  收到第二轮全部消息的用户: {report['complete_deliveries']} / {report['registered']}")
+    print(f"  错误/提示数: {report['errors']}")
+
+
+def print_usage():
+    """显示使用说明"""
+    print("TouchFish负载测试 - tf_loadtest")
+    print("用法:")
+    print("  tf_loadtest.py <IP> <端口> [--connections 连接数] [--rate 条/秒] [--duration 秒] [--report 报告文件]")
+    print("")
+    print("  --connections  第二轮测量时保持在线的用户数（默认 10000）")
+    print("  --rate         每秒发送的测试消息数（默认 20）")
+    print("  --duration     每轮测量的秒数（默认 10）")
+    print("  --report       把结果保存为JSON报告")
+    print("")
+    print("目标服务器应以大规模模式启动，最大连接数不少于连接数+2，例如:")
+    print("  TFserver.py 127.0.0.1 9000 10010 --high-scale")
+    print("  tf_loadtest.py 127.0.0.1 9000 --connections 10000")
+    print("测试其他机器时所有连接来自同一个IP，请先在目标服务器中输入 ipcap 0")
+
+
+def main():
+    """主函数"""
+    import json
+    argv = sys.argv[1:]
+    options = {}
+    for name in ("--connections", "--rate", "--duration", "--report"):
+        if name in argv:
+            index = argv.index(name)
+            if index + 1 >= len(argv):
+                print_usage()
+                return 2
+            options[name] = argv[index + 1]
+            del argv[index:index + 2]
+    if len(argv) != 2:
+        print_usage()
+        return 2
+    try:
+        port = int(argv[1])
+        connections = int(options.get("--connections", 10000))
+        rate = float(options.get("--rate", 20))
+        duration = float(options.get("--duration", 10))
+        if connections < 0 or rate <= 0 or duration <= 0:
+            raise ValueError
+    except ValueError:
+        print("错误: 端口和连接数必须是整数，速率和时间必须是正数", file=sys.stderr)
+        return 2
+
+    limit = raise_fd_limit(connections + 64)
+    if limit is not None and limit < connections + 64:
+        print(f"⚠️  本程序的文件描述符上限只有 {limit}，连接数改为 {limit - 64}", file=sys.stderr)
+        connections = max(0, limit - 64)
+
+    test = LoadTest(argv[0], port, connections, rate, duration)
+    try:
+        report = test.run()
+    except OSError as e:
+        print(f"测试失败: {e}", file=sys.stderr)
+        return 1
+    print_report(report)
+    for error in test.errors[:5]:
+        print(f"  ⚠️  {error}")
+    if "--report" in options:
+        with open(options["--report"], "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"报告已保存: {options['--report']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+tf_replay - 重放 TFserver 录制的流量（capture start 或 --capture）
+按录制时的时间间隔（可以加速或全速）把每个会话发来的帧重新发给一台新启动的服务器，
+统计转发吞吐量和延迟；报告可以保存下来，和另一个版本的报告比较
+"""
+
+import time
+import socket
+import selectors
+import struct
+import sys
+import collections
+
+CAPTURE_MAGIC = b"TFCAP1\n"  # 流量录制文件的文件头
+# 录制记录: 距开始录制的微秒数, 会话编号, 类型, 数据长度，后跟数据
+CAPTURE_RECORD = struct.Struct("<QIBI")
+CAPTURE_OPEN, CAPTURE_LINE, CAPTURE_CLOSE = 1, 2, 3  # 记录类型：新连接 / 收到一帧 / 连接关闭
+
+IDLE_TIMEOUT = 3  # 发送完毕后这么多秒没有收到数据就结束
+
+
+def load_capture(path):
+    """读取录制文件，返回 [(微秒, 会话编号, 类型, 数据)]"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(CAPTURE_MAGIC):
+        raise ValueError("不是TouchFish流量录制文件")
+    records = []
+    pos = len(CAPTURE_MAGIC)
+    while pos + CAPTURE_RECORD.size <= len(data):
+        offset, session_id, kind, length = CAPTURE_RECORD.unpack_from(data, pos)
+        pos += CAPTURE_RECORD.size
+        if pos + length > len(data):
+            break  # 录制时服务器异常退出，最后一条记录不完整
+        records.append((offset, session_id, kind, data[pos:pos + length]))
+        pos += length
+    return records
+
+
+def percentile(ordered, q):
+    """已排序样本的分位数"""
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class ReplayConnection:
+    """重放时的一个客户端连接"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.username = None  # 转发消息中的发送者（已转义）
+        self.buffer = b""
+        self.registered = False
+        self.seen = collections.Counter()  # {消息: 已收到次数}，用于区分内容相同的消息
+
+
+class Replayer:
+    def __init__(self, records, server_ip, port, speed, unix_path=None):
+        self.server_ip = server_ip
+        self.port = port
+        self.unix_path = unix_path  # 改为连接服务器的 Unix 域套接字（--unix），与本机TCP比较
+        self.speed = speed  # 重放倍速，None 表示全速
+        self.events = self.select_events(records)
+        self.selector = selectors.DefaultSelector()
+        self.connections = {}  # {会话编号: ReplayConnection}
+        self.sent_at = collections.defaultdict(list)  # {发送者: 正文 -> [发送时间]}
+        self.latencies = []
+        self.lines_sent = 0
+        self.frames_received = 0
+        self.errors = []
+        self.last_receive = 0
+
+    def select_events(self, records):
+        """去掉文件传输、服务器互联连接、机器人和客户端控制命令，只重放聊天流量"""
+        skipped = set()
+        registered = set()
+        for _, session_id, kind, data in records:
+            if kind == CAPTURE_LINE and session_id not in registered:
+                registered.add(session_id)
+                if data.startswith((b"/file ", b"/peer ", b"/bot ")):
+                    skipped.add(session_id)
+        return [
+            record for record in records
+            if record[1] not in skipped and not (record[2] == CAPTURE_LINE and record[3].startswith(b"/"))
+        ]
+
+    def source_address(self, session_id):
+        """重放到本机时让每个会话使用不同的回环地址，避免触发服务器的每IP连接上限"""
+        if not self.server_ip.startswith("127."):
+            return None
+        return (f"127.{(session_id >> 16) & 255}.{(session_id >> 8) & 255}.{session_id & 255 or 1}", 0)
+
+    def handle_event(self, session_id, kind, data):
+        """执行一条录制记录"""
+        if kind == CAPTURE_OPEN:
+            try:
+                if self.unix_path:
+                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    sock.connect(self.unix_path)
+                else:
+                    sock = socket.create_connection((self.server_ip, self.port), timeout=10,
+                                                    source_address=self.source_address(session_id))
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # 与客户端相同
+            except OSError as e:
+                self.errors.append(f"会话 {session_id} 连接失败: {e}")
+                return
+            connection = ReplayConnection(sock)
+            self.connections[session_id] = connection
+            self.selector.register(sock, selectors.EVENT_READ, connection)
+            return
+        connection = self.connections.get(session_id)
+        if connection is None:
+            return
+        if kind == CAPTURE_CLOSE:
+            self.close(session_id)
+            return
+        registering = connection.username is None
+        if registering:
+            # 第一行是用户名
+            connection.username = data.strip()
+        else:
+            self.sent_at[connection.username + b": " + data].append(time.perf_counter())
+        try:
+            connection.sock.sendall(data + b"\n")
+            self.lines_sent += 1
+        except OSError as e:
+            self.errors.append(f"会话 {session_id} 发送失败: {e}")
+            self.close(session_id)
+            return
+        if registering and self.speed is None:
+            # 全速时等注册完成再继续，否则别的会话的消息可能先于注册到达，每次结果不同
+            deadline = time.perf_counter() + 5
+            while not connection.registered and session_id in self.connections and time.perf_counter() < deadline:
+                self.poll(0.05)
+
+    def close(self, session_id):
+        """关闭一个重放连接"""
+        connection = self.connections.pop(session_id, None)
+        if connection is not None:
+            self.selector.unregister(connection.sock)
+            connection.sock.close()
+
+    def poll(self, timeout):
+        """接收服务器转发的消息并计算延迟"""
+        for key, _ in self.selector.select(timeout):
+            connection = key.data
+            try:
+                data = connection.sock.recv(65536)
+            except OSError:
+                data = b""
+            now = time.perf_counter()
+            if not data:
+                for session_id, other in list(self.connections.items()):
+                    if other is connection:
+                        self.close(session_id)
+                continue
+            self.last_receive = now
+            *lines, connection.buffer = (connection.buffer + data).split(b"\n")
+            for line in lines:
+                if line.startswith(b"USERNAME_OK:"):
+                    connection.registered = True
+                if not line.startswith(b"/m "):
+                    if line and not line.startswith((b"/", b"USERNAME_OK:")):
+                        # 服务器的提示（用户名被拒绝、连接数上限、网络太慢等）
+                        self.errors.append(line.decode("utf-8", errors="replace"))
+                    continue
+                # /m <序号> <服务器收到时间> <服务器发出时间> <发送者: 正文>
+                self.frames_received += 1
+                payload = line.split(b" ", 4)[-1]
+                index = connection.seen[payload]
+                connection.seen[payload] += 1
+                sent = self.sent_at.get(payload)
+                if sent and index < len(sent):
+                    self.latencies.append((now - sent[index]) * 1000)
+
+    def run(self):
+        """按录制的时间重放所有记录，返回报告"""
+        start = time.perf_counter()
+        for offset, session_id, kind, data in self.events:
+            if self.speed is None and kind == CAPTURE_CLOSE:
+                continue  # 全速时所有连接在最后一起关闭，保证收到的转发数固定
+            if self.speed is not None:
+                due = start + offset / 1000000 / self.speed
+                while True:
+                    remaining = due - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self.poll(remaining)
+            self.handle_event(session_id, kind, data)
+            # 全速时也要及时读取，否则服务器会把重放连接当作慢速客户端
+            self.poll(0)
+        sent_done = time.perf_counter()
+
+        # 等待剩余的转发消息
+        self.last_receive = max(self.last_receive, sent_done)
+        while self.connections and time.perf_counter() - self.last_receive < IDLE_TIMEOUT:
+            self.poll(0.1)
+        end = max(self.last_receive, sent_done)
+        for session_id in list(self.connections):
+            self.close(session_id)
+
+        duration = max(end - start, 1e-6)
+        ordered = sorted(self.latencies)
+        report = {
+            "speed": "max" if self.speed is None else self.speed,
+            "transport": "unix" if self.unix_path else "tcp",
+            "sessions": len({record[1] for record in self.events}),
+            "lines_sent": self.lines_sent,
+            "frames_received": self.frames_received,
+            "duration": round(duration, 3),
+            "send_rate": round(self.lines_sent / duration, 1),
+            "delivery_rate": round(self.frames_received / duration, 1),
+            "errors": len(self.errors),
+        }
+        if ordered:
+            report.update({
+                "latency_p50_ms": round(percentile(ordered, 0.5), 2),
+                "latency_p90_ms": round(percentile(ordered, 0.9), 2),
+                "latency_p99_ms": round(percentile(ordered, 0.99), 2),
+                "latency_max_ms": round(ordered[-1], 2),
+            })
+        return report
+
+
+REPORT_LABELS = [
+    ("sessions", "会话数"),
+    ("lines_sent", "发送消息数"),
+    ("frames_received", "收到转发数"),
+    ("duration", "耗时 (秒)"),
+    ("send_rate", "发送速率 (条/秒)"),
+    ("delivery_rate", "转发吞吐量 (条/秒)"),
+    ("latency_p50_ms", "延迟中位数 (ms)"),
+    ("latency_p90_ms", "延迟P90 (ms)"),
+    ("latency_p99_ms", "延迟P99 (ms)"),
+    ("latency_max_ms", "最大延迟 (ms)"),
+    ("errors", "错误/提示数"),
+]
+
+
+def print_report(report, baseline=None):
+    """显示重放结果，有基准报告时显示变化"""
+    print(f"重放结果（倍速: {report['speed']}，连接方式: {report.get('transport', 'tcp')}）:")
+    for key, label in REPORT_LABELS:
+        if key not in report:
+            continue
+        line = f"  {label}: {report[key]}"
+        if baseline is not None and key in baseline:
+            old = baseline[key]
+            change = f" ({(report[key] - old) / old * 100:+.1f}%)" if old else ""
+            line += f"  基准: {old}{change}"
+        print(line)
+
+
+def print_usage():
+    """显示使用说明"""
+    print("TouchFish流量重放 - tf_replay")
+    print("用法:")
+    print("  tf_replay.py <录制文件> <IP> <端口> [--speed 倍速|max] [--report 报告文件] [--compare 基准报告] [--unix 路径]")
+    print("")
+    print("  --speed    按录制时间的几倍速重放（默认 1），max 表示不等待、全速发送")
+    print("  --report   把结果保存为JSON报告")
+    print("  --compare  与之前保存的报告比较（例如上一个版本的服务器）")
+    print("  --unix     通过服务器的 Unix 域套接字（TFserver --unix）连接，可与本机TCP的报告比较")
+    print("")
+    print("目标服务器应是新启动的，最大连接数不少于录制中的会话数；")
+    print("重放到其他机器时请在服务器中输入 ipcap 0 关闭每IP连接上限")
+    print("示例:")
+    print("  tf_replay.py tf_profile/capture_20250101_080000.tfcap 127.0.0.1 9000 --speed max --report new.json --compare old.json")
+
+
+def main():
+    """主函数"""
+    import json
+    argv = sys.argv[1:]
+    options = {}
+    for name in ("--speed", "--report", "--compare", "--unix"):
+        if name in argv:
+            index = argv.index(name)
+            if index + 1 >= len(argv):
+                print_usage()
+                return 2
+            options[name] = argv[index + 1]
+            del argv[index:index + 2]
+    if len(argv) != 3:
+        print_usage()
+        return 2
+    try:
+        port = int(argv[2])
+        speed = options.get("--speed", "1").lower()
+        speed = None if speed == "max" else float(speed.rstrip("x"))
+        if speed is not None and speed <= 0:
+            raise ValueError
+    except ValueError:
+        print("错误: 端口必须是整数，倍速必须是正数或 max", file=sys.stderr)
+        return 2
+
+    try:
+        records = load_capture(argv[0])
+    except (OSError, ValueError) as e:
+        print(f"无法读取录制文件: {e}", file=sys.stderr)
+        return 1
+    baseline = None
+    if "--compare" in options:
+        with open(options["--compare"], encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    replayer = Replayer(records, argv[1], port, speed, options.get("--unix"))
+    report = replayer.run()
+    report["capture"] = argv[0]
+    print_report(report, baseline)
+    for error in replayer.errors[:5]:
+        print(f"  ⚠️  {error}")
+    if "--report" in options:
+        with open(options["--report"], "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"报告已保存: {options['--report']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())